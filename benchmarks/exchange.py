@@ -0,0 +1,63 @@
+"""Benchmark the formats for exchanging volumes with the inference model.
+
+Every case is written by the host, read by the model, written back as segmentation and read again by the host.
+This times that round trip for each format in `api.EXCHANGE_FORMATS`, e.g., on a tmpfs:
+
+    python benchmarks/exchange.py --tempdir /dev/shm
+
+"""
+from __future__ import annotations
+
+import argparse
+import pathlib
+import tempfile
+import time
+
+import numpy as np
+
+from musegai import api
+
+
+def roundtrip(volume, segmentation, directory, ext):
+    """Time writing and reading the input and the segmentation."""
+    timings = {}
+    start = time.perf_counter()
+    volume.save(directory / "case_0000", ext)
+    timings["write input"] = time.perf_counter() - start
+    start = time.perf_counter()
+    api.Volume.load(directory / "case_0000", ext)
+    timings["read input"] = time.perf_counter() - start
+    start = time.perf_counter()
+    segmentation.save(directory / "case", ext)
+    timings["write output"] = time.perf_counter() - start
+    start = time.perf_counter()
+    api.Volume.load(directory / "case", ext)
+    timings["read output"] = time.perf_counter() - start
+    return timings
+
+
+def main():
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--shape", type=int, nargs=3, default=[256, 256, 120], help="Shape of the volume (one side of a Dixon volume)")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of repetitions (the best is reported)")
+    parser.add_argument("--tempdir", help="Location of the exchange directory")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    metadata = {"origin": (0.0, 0.0, 0.0), "spacing": (1.0, 1.0, 5.0), "transform": (1.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 1.0)}
+    volume = api.Volume(rng.normal(100, 20, args.shape).astype("float32"), **metadata)
+    segmentation = api.Volume(rng.integers(0, 14, args.shape).astype("uint16"), **metadata)
+
+    print(f"Volume shape: {tuple(args.shape)}, exchange directory: {args.tempdir or tempfile.gettempdir()}")
+    for ext in api.EXCHANGE_FORMATS:
+        with tempfile.TemporaryDirectory(dir=args.tempdir) as tmp:
+            runs = [roundtrip(volume, segmentation, pathlib.Path(tmp), ext) for _ in range(args.repeat)]
+            size = sum(file.stat().st_size for file in pathlib.Path(tmp).iterdir())
+        timings = {key: min(run[key] for run in runs) for key in runs[0]}
+        details = ", ".join(f"{key}: {value:.3f}s" for key, value in timings.items())
+        print(f"{ext:>8}: total {sum(timings.values()):.3f}s ({details}), {size / 1e6:.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
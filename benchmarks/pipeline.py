@@ -0,0 +1,228 @@
+"""Benchmark the segmentation pipeline on synthetic Dixon volume pairs.
+
+Times loading and saving a volume for each extension of `api.Volume.EXTENSIONS` (and memory-mapping the uncompressed
+ones), loading and saving a segmentation as `.nii.gz` and in the compact label map format (`.mseg`, with its file size),
+splitting and healing a volume, and a full `api.segment_volumes` run with the `test` model, and records the
+throughput (MB of voxel data per second) and the peak memory (increase of the resident set size) of each step. The results can be stored as a baseline, and compared
+against it, e.g.:
+
+    python benchmarks/pipeline.py --size thigh --save-baseline benchmarks/baseline.json
+    python benchmarks/pipeline.py --size thigh --baseline benchmarks/baseline.json
+
+The comparison fails (exit code 1) if a step is slower than the baseline by more than `--tolerance`.
+"""
+from __future__ import annotations
+
+import argparse
+import ctypes
+import ctypes.util
+import gc
+import json
+import os
+import pathlib
+import platform
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import numpy as np
+
+from musegai import api, labelmap
+
+# shapes of a Dixon volume (both legs): a single thigh station up to a whole-leg stack
+SIZES = {
+    "thigh": (432, 216, 60),
+    "thighs": (432, 216, 120),
+    "legs": (432, 216, 320),
+}
+
+METADATA = {"origin": (0.0, 0.0, 0.0), "spacing": (1.0, 1.0, 5.0), "transform": (1.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 1.0)}
+
+
+def make_dixon_pair(shape, seed=0):
+    """Return a synthetic pair of Dixon volumes (fat and water images) with two legs."""
+    rng = np.random.default_rng(seed)
+    x, y = np.meshgrid(np.linspace(-1, 1, shape[0]), np.linspace(-1, 1, shape[1]), indexing="ij")
+    radius = np.minimum(np.hypot(x + 0.5, y), np.hypot(x - 0.5, y))[..., np.newaxis]
+    profile = np.linspace(1.0, 0.6, shape[2])  # legs narrowing along the stack
+    leg = radius < 0.4 * profile
+    muscle = radius < 0.3 * profile
+    fat = np.where(leg & ~muscle, 800, 0) + np.where(muscle, 100, 0) + rng.normal(20, 5, shape)
+    water = np.where(muscle, 600, 0) + np.where(leg & ~muscle, 50, 0) + rng.normal(20, 5, shape)
+    return [api.Volume(np.clip(image, 0, None).astype("uint16"), **METADATA) for image in [fat, water]]
+
+
+def make_segmentation(shape):
+    """Return a synthetic segmentation (as the models', `uint16`) of six muscles per leg, matching `make_dixon_pair`."""
+    x, y = np.meshgrid(np.linspace(-1, 1, shape[0]), np.linspace(-1, 1, shape[1]), indexing="ij")
+    center = np.where(x < 0, -0.5, 0.5)
+    radius = np.hypot(x - center, y)[..., np.newaxis]
+    sector = (np.arctan2(y, x - center) + np.pi) / (2 * np.pi) * 6
+    labels = 1 + sector.astype("uint16") % 6 + np.where(x < 0, 0, 6).astype("uint16")
+    muscle = radius < 0.3 * np.linspace(1.0, 0.6, shape[2])
+    return api.Volume(np.where(muscle, labels[..., np.newaxis], 0).astype("uint16"), **METADATA)
+
+
+class PeakMemory:
+    """Measure the peak increase of the resident set size (RSS) while in context.
+
+    The RSS is sampled in a background thread (Linux only), otherwise the peak memory allocated by numpy is traced.
+    """
+
+    STATM = pathlib.Path("/proc/self/statm")
+
+    @staticmethod
+    def setup():
+        """Return large blocks to the system when freed (glibc), such that the RSS does not hide re-used memory."""
+        libc = ctypes.util.find_library("c")
+        if libc and platform.system() == "Linux":
+            m_mmap_threshold = -3
+            ctypes.CDLL(libc).mallopt(m_mmap_threshold, 128 * 1024)
+
+    def __init__(self, interval=0.001):
+        """Sample every `interval` seconds."""
+        self.interval = interval
+        self.peak = 0
+        self._start = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        """Start measuring."""
+        gc.collect()
+        if not self.STATM.exists():
+            tracemalloc.start()
+            return self
+        self._start = self._rss()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        """Stop measuring."""
+        if self._thread is None:
+            self.peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            return
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self._rss() - self._start)
+
+    def _rss(self):
+        return int(self.STATM.read_text(encoding="ascii").split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, self._rss() - self._start)
+
+
+def measure(func, nbytes, repeat):
+    """Return the best time, the throughput and the largest peak memory of `repeat` calls to `func`."""
+    times, peaks = [], []
+    for _ in range(repeat):
+        with PeakMemory() as memory:
+            start = time.perf_counter()
+            result = func()
+            times.append(time.perf_counter() - start)
+            del result  # the result counts into the peak memory
+        peaks.append(memory.peak)
+    best = min(times)
+    return {"time": best, "throughput": nbytes / 1e6 / best, "memory": max(peaks)}
+
+
+def run(shape, repeat, tempdir=None):
+    """Run all benchmarks on a synthetic Dixon pair of the given shape."""
+    volumes = make_dixon_pair(shape)
+    volume = volumes[0]
+    results = {}
+    with tempfile.TemporaryDirectory(dir=tempdir) as tmp:
+        tmp = pathlib.Path(tmp)
+        for ext in api.Volume.EXTENSIONS:
+            file = tmp / f"volume{ext}"
+            results[f"save {ext}"] = measure(lambda file=file: volume.save(file), volume.nbytes, repeat)
+            results[f"load {ext}"] = measure(lambda file=file: api.Volume.load(file), volume.nbytes, repeat)
+            if ext != ".nii.gz":
+                results[f"mmap {ext}"] = measure(lambda file=file: api.Volume.load(file, mmap=True), volume.nbytes, repeat)
+            for other in tmp.iterdir():
+                other.unlink()
+
+        segmentation = make_segmentation(shape)
+        for ext in [".nii.gz", labelmap.EXTENSION]:
+            file = tmp / f"segmentation{ext}"
+            results[f"save segmentation {ext}"] = measure(lambda file=file: segmentation.save(file), segmentation.nbytes, repeat)
+            results[f"load segmentation {ext}"] = measure(lambda file=file: api.Volume.load(file), segmentation.nbytes, repeat)
+            results[f"load segmentation {ext}"]["size"] = file.stat().st_size
+
+    results["split"] = measure(lambda: api._split_volume(volume, "left+right"), volume.nbytes, repeat)  # pylint: disable=protected-access
+    left, right = api._split_volume(volume, "left+right")  # pylint: disable=protected-access
+    results["heal"] = measure(lambda: api._heal_volume(left, right), volume.nbytes, repeat)  # pylint: disable=protected-access
+    cases = {"case": volumes}
+    results["segment (test model)"] = measure(
+        lambda: api.segment_volumes(cases, "test", side="left+right", tempdir=tempdir, exchange=".nii"), sum(vol.nbytes for vol in volumes), repeat
+    )
+    return results
+
+
+def compare(results, baseline, tolerance, resolution=0.005):
+    """Print the results with their ratio to the baseline, and return the steps slower than tolerated.
+
+    Differences below `resolution` seconds are ignored, as the ratio of very short times is noise.
+    """
+    slower = []
+    for step, result in results.items():
+        line = f"{step:>26}: {result['time']:8.3f}s {result['throughput']:8.1f} MB/s {result['memory'] / 1e6:8.1f} MB"
+        if "size" in result:
+            line += f" {result['size'] / 1e3:8.1f} kB file"
+        if step in baseline:
+            ratio = result["time"] / baseline[step]["time"]
+            line += f"  ({ratio:.2f}x baseline time, {result['memory'] / max(baseline[step]['memory'], 1):.2f}x memory)"
+            if ratio > tolerance and result["time"] - baseline[step]["time"] > resolution:
+                slower.append(step)
+                line += "  SLOWER"
+        print(line)
+    return slower
+
+
+def main(argv=None):
+    """Run the benchmarks."""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", default="thigh", choices=list(SIZES), help="Size of the synthetic Dixon volumes")
+    parser.add_argument("--shape", type=int, nargs=3, help="Custom shape of the synthetic Dixon volumes (overrides --size)")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of repetitions (the best time is reported)")
+    parser.add_argument("--tempdir", help="Location for temporary files")
+    parser.add_argument("--baseline", type=pathlib.Path, help="Compare with the results stored in this file")
+    parser.add_argument("--save-baseline", type=pathlib.Path, help="Store the results in this file")
+    parser.add_argument("--tolerance", type=float, default=1.25, help="Maximum ratio of the time to the baseline's")
+    args = parser.parse_args(argv)
+
+    PeakMemory.setup()
+    shape = tuple(args.shape or SIZES[args.size])
+    key = "x".join(map(str, shape))
+    print(f"Volume shape: {shape}, {np.prod(shape) * 2 / 1e6:.1f} MB per volume")
+    results = run(shape, args.repeat, args.tempdir)
+
+    baseline = {}
+    if args.baseline is not None:
+        stored = json.loads(args.baseline.read_text())
+        if stored["machine"] != platform.machine() or stored["python"] != platform.python_version():
+            print(f"Baseline recorded on another platform: {stored['machine']}, Python {stored['python']}")
+        baseline = stored["results"].get(key, {})
+        if not baseline:
+            print(f"No baseline for shape {shape}")
+    slower = compare(results, baseline, args.tolerance)
+
+    if args.save_baseline is not None:
+        stored = json.loads(args.save_baseline.read_text()) if args.save_baseline.exists() else {"results": {}}
+        stored.update(machine=platform.machine(), python=platform.python_version())
+        stored["results"][key] = results
+        args.save_baseline.write_text(json.dumps(stored, indent=2) + "\n")
+
+    if slower:
+        print(f"Slower than the baseline: {', '.join(slower)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
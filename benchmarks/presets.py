@@ -0,0 +1,68 @@
+"""Evaluate the speed/accuracy trade-off of the inference presets on a reference case.
+
+Each preset in `api.PRESETS` segments the same pair of Dixon volumes, and its runtime and Dice coefficients are
+reported against a reference segmentation (default: the segmentation of the `full` preset), e.g.:
+
+    python benchmarks/presets.py ref_0.nii.gz ref_1.nii.gz --reference ref_seg.nii.gz
+
+"""
+from __future__ import annotations
+
+import argparse
+import time
+
+import numpy as np
+
+from musegai import api
+
+
+def dice(segmentation, reference):
+    """Return the Dice coefficient of each label of the reference."""
+    segmentation = np.asarray(segmentation).ravel()
+    reference = np.asarray(reference).ravel()
+    nlabels = int(max(segmentation.max(), reference.max())) + 1
+    # confusion matrix of all label pairs in a single pass
+    confusion = np.bincount(reference.astype(np.int64) * nlabels + segmentation, minlength=nlabels**2).reshape(nlabels, nlabels)
+    overlap = np.diag(confusion)
+    total = confusion.sum(axis=0) + confusion.sum(axis=1)
+    labels = np.flatnonzero(confusion.sum(axis=1))
+    return {int(label): float(2 * overlap[label] / total[label]) for label in labels if label}
+
+
+def main():
+    """Run the evaluation."""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("volumes", nargs=2, help="The two Dixon volumes of the reference case")
+    parser.add_argument("--reference", help="Reference segmentation (default: the segmentation of the `full` preset)")
+    parser.add_argument("--model", default="thigh-model3", help="Segmentation model")
+    parser.add_argument("--side", default="left+right", choices=api.SIDES, help="Limb's side(s)")
+    parser.add_argument("--presets", nargs="+", default=list(api.PRESETS), choices=list(api.PRESETS), help="Presets to evaluate")
+    parser.add_argument("--server", help="URL of a running inference server (excludes the model loading from the runtime)")
+    parser.add_argument("--tempdir", help="Location for temporary files")
+    args = parser.parse_args()
+
+    volumes = {"reference": [api.Volume.load(file) for file in args.volumes]}
+    results = {}
+    for preset in args.presets:
+        start = time.perf_counter()
+        segmentation, _ = api.segment_volumes(volumes, args.model, side=args.side, tempdir=args.tempdir, server=args.server, preset=preset)
+        results[preset] = (time.perf_counter() - start, segmentation["reference"])
+
+    if args.reference:
+        reference = api.Volume.load(args.reference)
+    elif "full" in results:
+        reference = results["full"][1]
+    else:
+        segmentation, _ = api.segment_volumes(volumes, args.model, side=args.side, tempdir=args.tempdir, server=args.server, preset="full")
+        reference = segmentation["reference"]
+
+    print(f"Case: {args.volumes[0]}, model: {args.model}, reference: {args.reference or 'full preset'}")
+    for preset, (runtime, segmentation) in results.items():
+        scores = dice(segmentation.array, reference.array)
+        worst = min(scores, key=scores.get) if scores else None
+        summary = f"mean Dice {np.mean(list(scores.values())):.3f}, min {scores[worst]:.3f} (label {worst})" if scores else "no labels"
+        print(f"{preset:>10}: {runtime:7.1f}s, {summary}")
+
+
+if __name__ == "__main__":
+    main()
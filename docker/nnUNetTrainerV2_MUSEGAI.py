@@ -1,11 +1,17 @@
 """Custom nnU-Net trainer allowing to ignore unsegmented image slices in a volume when computing the loss."""
 from __future__ import annotations
 
+import os
+import time
 from pathlib import Path
 
 import batchgenerators.utilities.file_and_folder_operations as ffops
 import nnunet.training.network_training.nnUNetTrainerV2 as trainerV2
+import numpy as np
+import torch
+from nnunet.training.dataloading.dataset_loading import DataLoader3D
 from nnunet.training.loss_functions.dice_loss import DC_and_CE_loss
+from sparse_sampling import index_dataset, labelled_in_patch, slice_start, voxel_start
 
 
 class DC_and_CE_loss_improved(DC_and_CE_loss):
@@ -13,19 +19,99 @@ class DC_and_CE_loss_improved(DC_and_CE_loss):
 
     The problem of the NaN arises due to a division by zero at the line 'ce_loss = ce_loss.sum() / mask.sum()'.
     In such a case, the mask.sum() is simply zero as the target consists only of ignored labels.
+    The loss is computed without checking the target on the host, which would synchronize with the GPU.
     """
 
     def forward(self, net_output, target):
         """Calculate the Dice and cross-entropy loss."""
-        if self.ignore_label is not None and target.unique().size(dim=0) == 1:
-            if self.ignore_label == target.unique():
-                return 0
-        return super().forward(net_output, target)
+        if self.ignore_label is None:
+            return super().forward(net_output, target)
+        assert target.shape[1] == 1, "not implemented for one hot encoding"
+        mask = target != self.ignore_label
+        target.masked_fill_(~mask, 0)
+        mask = mask.float()
+
+        dc_loss = self.dc(net_output, target, loss_mask=mask) if self.weight_dice != 0 else 0
+        if self.log_dice:
+            dc_loss = -torch.log(-dc_loss)
+        ce_loss = self.ce(net_output, target[:, 0].long()) if self.weight_ce != 0 else 0
+        labelled = mask.sum()
+        ce_loss = (ce_loss * mask[:, 0]).sum() / labelled.clamp(min=1)
+        result = self.weight_ce * ce_loss + self.weight_dice * dc_loss
+        return torch.where(labelled > 0, result, torch.zeros_like(result))
+
+
+class SparseAnnotationDataLoader3D(DataLoader3D):
+    """Data loader drawing patches that overlap the annotated slices of sparsely annotated volumes.
+
+    The first spatial axis is the slice axis. Each patch is placed such that an annotated slice (drawn uniformly from
+    `index`, see `index_dataset`) lies in the central half of the final patch (cropped from the larger patch by the
+    spatial augmentation), or around a voxel of a foreground class (kept inside the final patch) if oversampling the
+    foreground. The number of labelled voxels of the final patch is returned by batch item as "labelled". The patches of
+    the cases without annotated slice are drawn as by `DataLoader3D`.
+    """
+
+    def __init__(self, data, patch_size, final_patch_size, batch_size, *, index, ignore_label, **kwargs):
+        """Draw patches from the cases of `data`, with the labelled voxels per slice of `index`."""
+        super().__init__(data, patch_size, final_patch_size, batch_size, False, **kwargs)
+        self.index = index
+        self.ignore_label = ignore_label
+        self.margin = (np.array(patch_size) - np.array(final_patch_size)) // 2
+
+    def generate_train_batch(self):
+        """Return a batch of patches."""
+        selected_keys = np.random.choice(self.list_of_keys, self.batch_size, True, None)
+        data = np.zeros(self.data_shape, dtype=np.float32)
+        seg = np.zeros(self.seg_shape, dtype=np.float32)
+        labelled = np.zeros(self.batch_size, dtype=np.int64)
+        case_properties = []
+        for j, key in enumerate(selected_keys):
+            data_file = self._data[key]["data_file"]
+            properties = ffops.load_pickle(data_file[:-4] + ".pkl") if os.path.isfile(data_file[:-4] + ".pkl") else self._data[key]["properties"]
+            case_properties.append(properties)
+            npy = data_file[:-4] + ".npy"
+            case_all_data = np.load(npy, self.memmap_mode) if os.path.isfile(npy) else np.load(data_file)["data"]
+
+            # range of the patch starts, as `DataLoader3D`
+            shape = np.array(case_all_data.shape[1:])
+            patch_size = np.array(self.patch_size)
+            need_to_pad = np.maximum(self.need_to_pad, patch_size - shape)
+            lower = -need_to_pad // 2
+            upper = shape + need_to_pad // 2 + need_to_pad % 2 - patch_size
+            start = np.array([np.random.randint(low, high + 1) for low, high in zip(lower, upper)])
+            voxel = self._foreground_voxel(properties) if self.get_do_oversample(j) else None
+            annotated = np.flatnonzero(self.index[key])
+            if voxel is not None:
+                start = voxel_start(voxel, lower, upper, self.margin, self.final_patch_size)
+            elif annotated.size:
+                start[0] = slice_start(np.random.choice(annotated), lower[0], upper[0], self.margin[0], self.final_patch_size[0])
+
+            stop = start + patch_size
+            valid_start, valid_stop = np.maximum(start, 0), np.minimum(stop, shape)
+            case_all_data = np.copy(case_all_data[(slice(None),) + tuple(slice(a, b) for a, b in zip(valid_start, valid_stop))])
+            padding = [(0, 0)] + [(int(before), int(after)) for before, after in zip(valid_start - start, stop - valid_stop)]
+            data[j] = np.pad(case_all_data[:-1], padding, self.pad_mode, **self.pad_kwargs_data)
+            seg[j, 0] = np.pad(case_all_data[-1], padding[1:], "constant", constant_values=-1)
+            labelled[j] = labelled_in_patch(seg[j, 0], self.margin, self.final_patch_size, self.ignore_label)
+
+        return {"data": data, "seg": seg, "properties": case_properties, "keys": selected_keys, "labelled": labelled}
+
+    def _foreground_voxel(self, properties):
+        """Return a random voxel of a random foreground class (not the ignored label), or None."""
+        locations = properties.get("class_locations") or {}
+        classes = [label for label, voxels in locations.items() if len(voxels) and label > 0 and label != self.ignore_label]
+        if not classes:
+            return None
+        voxels = locations[np.random.choice(classes)]
+        return voxels[np.random.choice(len(voxels))]
 
 
 class nnUNetTrainerV2_MUSEGAI(trainerV2.nnUNetTrainerV2):
     """Custom nnUNetTrainer that ignores the background allowing to train a full 3-D volume segmentation with sparse annotations.
 
+    The patches are drawn around the annotated slices (see `SparseAnnotationDataLoader3D`), and the batches without
+    labelled voxels are skipped. The effective throughput (labelled voxels per second) is logged at the end of each epoch.
+
     See Also: Çiçek et al., 3D U-Net: Learning Dense Volumetric Segmentation from Sparse Annotation, MICCAI 2016, https://arxiv.org/abs/1606.06650
     """
 
@@ -61,8 +147,51 @@ class nnUNetTrainerV2_MUSEGAI(trainerV2.nnUNetTrainerV2):
             plans = {"num_classes": None}
 
         # ignore the background label for training with every n-th image slice in 3-D volumes
+        self.ignore_label = plans["num_classes"]
         self.loss = DC_and_CE_loss_improved(
             {"batch_dice": self.batch_dice, "smooth": 1e-5, "do_bg": False},
             {},
-            ignore_label=plans["num_classes"],
+            ignore_label=self.ignore_label,
         )
+        self.labelled_voxels = 0
+        self.training_time = 0.0
+
+    def get_basic_generators(self):
+        """Return the data loaders of the training and validation cases, drawing patches around the annotated slices."""
+        if not self.threeD or self.ignore_label is None:
+            return super().get_basic_generators()
+        self.load_dataset()
+        self.do_split()
+        index = index_dataset({**self.dataset_tr, **self.dataset_val}, self.ignore_label)
+        kwargs = {
+            "index": index,
+            "ignore_label": self.ignore_label,
+            "oversample_foreground_percent": self.oversample_foreground_percent,
+            "pad_mode": "constant",
+            "pad_sides": self.pad_all_sides,
+            "memmap_mode": "r",
+        }
+        dl_tr = SparseAnnotationDataLoader3D(self.dataset_tr, self.basic_generator_patch_size, self.patch_size, self.batch_size, **kwargs)
+        dl_val = SparseAnnotationDataLoader3D(self.dataset_val, self.patch_size, self.patch_size, self.batch_size, **kwargs)
+        return dl_tr, dl_val
+
+    def run_iteration(self, data_generator, do_backprop=True, run_online_evaluation=False):
+        """Run an iteration, unless the batch has no labelled voxels (according to the index of the annotated slices)."""
+        start = time.perf_counter()
+        data_dict = next(data_generator)
+        labelled = data_dict.get("labelled")
+        if labelled is not None and not np.any(labelled):
+            return np.float32(0.0)
+        loss = super().run_iteration(iter([data_dict]), do_backprop, run_online_evaluation)
+        if do_backprop and labelled is not None:
+            self.labelled_voxels += int(np.sum(labelled))
+            self.training_time += time.perf_counter() - start
+        return loss
+
+    def on_epoch_end(self):
+        """Log the labelled voxels trained on per second, and finish the epoch."""
+        if self.training_time:
+            self.print_to_log_file(f"labelled voxels per second: {self.labelled_voxels / self.training_time:.4g}")
+        self.labelled_voxels = 0
+        self.training_time = 0.0
+        return super().on_epoch_end()
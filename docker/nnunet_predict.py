@@ -2,15 +2,214 @@
 from __future__ import annotations
 
 import argparse
+import json
+import os
 import shutil
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import Pool
 from time import time
 
+import numpy as np
 import torch
-from batchgenerators.utilities.file_and_folder_operations import isdir, join, save_json
-from nnunet.inference.predict import predict_from_folder
+from batchgenerators.utilities.file_and_folder_operations import isdir, isfile, join, load_pickle, maybe_mkdir_p, save_json, subfiles, subfolders
+from nnunet.inference.predict import load_model_and_checkpoint_files, predict_from_folder, preprocess_multithreaded
+from nnunet.inference.segmentation_export import save_segmentation_nifti_from_softmax
 from nnunet.paths import default_cascade_trainer, default_plans_identifier, default_trainer, network_training_output_dir
+from nnunet.postprocessing.connected_components import load_postprocessing, load_remove_save
 from nnunet.utilities.task_name_id_conversion import convert_id_to_task_name
 
+# file formats for exchanging volumes with the host, uncompressed NIfTI files avoid the gzip (de-)compression
+EXCHANGE_FORMATS = [".nii.gz", ".nii"]
+
+
+def export_prediction(softmax, output_file, properties, export_args, postprocessing=None):
+    """Export and postprocess a prediction into a partial file, renamed into place when done.
+
+    The host reads each output as soon as it appears (see `segment_volumes(stream=True)` of the musegai package), when it
+    is complete and final.
+    """
+    folder, name = os.path.split(output_file)
+    partial = join(folder, f".partial.{name}")
+    save_segmentation_nifti_from_softmax(softmax, partial, properties, *export_args)
+    if postprocessing is not None:
+        for_which_classes, min_valid_object_size = postprocessing
+        load_remove_save(partial, partial, for_which_classes, min_valid_object_size)
+    os.replace(partial, output_file)
+
+
+class Predictor:
+    """nnU-Net predictor keeping the trainer and the fold parameters in memory between predictions.
+
+    This mirrors `nnunet.inference.predict.predict_cases`, but loads the model only once such that a long-running process
+    does not pay for CUDA initialization and checkpoint loading on every call.
+    """
+
+    def __init__(
+        self,
+        model_folder,
+        folds,
+        *,
+        num_threads_preprocessing=6,
+        num_threads_nifti_save=2,
+        do_tta=True,
+        mixed_precision=True,
+        all_in_gpu=None,
+        step_size=0.5,
+        checkpoint_name="model_final_checkpoint",
+    ):
+        """Load the trainer and the parameters of all folds."""
+        self.num_threads_preprocessing = num_threads_preprocessing
+        self.do_tta = do_tta
+        self.mixed_precision = mixed_precision
+        self.all_in_gpu = all_in_gpu
+        self.step_size = step_size
+        self.num_modalities = load_pickle(join(model_folder, "plans.pkl"))["num_modalities"]
+        if folds is None:
+            # detected automatically, as done by `load_model_and_checkpoint_files`
+            folds = sorted(int(folder[len("fold_") :]) for folder in subfolders(model_folder, prefix="fold_", join=False))
+        self.trainer, params = load_model_and_checkpoint_files(model_folder, folds, mixed_precision=mixed_precision, checkpoint_name=checkpoint_name)
+        # parameters by fold, such that requests can select a subset of the loaded folds
+        self.params = dict(zip(map(str, folds), params))
+
+        export_params = self.trainer.plans.get("segmentation_export_params", {})
+        self.force_separate_z = export_params.get("force_separate_z")
+        self.interpolation_order = export_params.get("interpolation_order", 1)
+        self.interpolation_order_z = export_params.get("interpolation_order_z", 0)
+        self.region_class_order = getattr(self.trainer, "regions_class_order", None)
+
+        postprocessing_file = join(model_folder, "postprocessing.json")
+        self.postprocessing = load_postprocessing(postprocessing_file) if isfile(postprocessing_file) else None
+        self.pool = Pool(num_threads_nifti_save)
+
+    def predict(self, input_folder, output_folder, exchange=".nii.gz", *, folds=None, disable_tta=None, step_size=None, overwrite_existing=True):
+        """Predict all cases in the input folder, exchanged as files of the given format.
+
+        The folds (a subset of the loaded folds), test time augmentation and step size default to those given at creation.
+        Existing predictions are skipped unless `overwrite_existing`.
+        """
+        folds = list(self.params) if folds is None else [str(fold) for fold in folds]
+        missing = [fold for fold in folds if fold not in self.params]
+        if missing:
+            raise ValueError(f"Folds not loaded: {missing}")
+        params = [self.params[fold] for fold in folds]
+        do_tta = self.do_tta if disable_tta is None else not disable_tta
+        step_size = self.step_size if step_size is None else step_size
+
+        maybe_mkdir_p(output_folder)
+        all_files = subfiles(input_folder, suffix=exchange, join=False, sort=True)
+        case_ids = sorted({file[: -len(exchange) - 5] for file in all_files})
+        if not overwrite_existing:
+            case_ids = [case_id for case_id in case_ids if not isfile(join(output_folder, case_id + exchange))]
+        list_of_lists = [[join(input_folder, f"{case_id}_{i:04d}{exchange}") for i in range(self.num_modalities)] for case_id in case_ids]
+        missing = [file for files in list_of_lists for file in files if not isfile(file)]
+        if missing:
+            raise RuntimeError(f"Missing input files: {missing}")
+        # the preprocessing derives names of temporary files from the output file names, which expects .nii.gz
+        output_files = {join(output_folder, case_id + ".nii.gz"): join(output_folder, case_id + exchange) for case_id in case_ids}
+
+        results = []
+        for output_file, (data, properties) in preprocess_multithreaded(self.trainer, list_of_lists, list(output_files), self.num_threads_preprocessing):
+            if isinstance(data, str):
+                # large cases are passed via a temporary .npy file
+                filename, data = data, np.load(data)
+                os.remove(filename)
+            softmax = self._predict_softmax(data, params, do_tta, step_size)
+            export_args = (self.interpolation_order, self.region_class_order, None, None, None, None, self.force_separate_z, self.interpolation_order_z)
+            results.append(self.pool.apply_async(export_prediction, (softmax, output_files[output_file], properties, export_args, self.postprocessing)))
+        for result in results:
+            result.get()
+        shutil.copy("./labels.txt", join(output_folder, "labels.txt"))
+
+    def _predict_softmax(self, data, params, do_tta, step_size):
+        """Average the softmax of the given folds."""
+        softmax = None
+        for fold_params in params:
+            self.trainer.load_checkpoint_ram(fold_params, False)
+            prediction = self.trainer.predict_preprocessed_data_return_seg_and_softmax(
+                data,
+                do_mirroring=do_tta,
+                mirror_axes=self.trainer.data_aug_params["mirror_axes"],
+                use_sliding_window=True,
+                step_size=step_size,
+                use_gaussian=True,
+                all_in_gpu=self.all_in_gpu,
+                mixed_precision=self.mixed_precision,
+            )[1]
+            softmax = prediction if softmax is None else softmax + prediction
+        softmax /= len(params)
+        transpose_backward = self.trainer.plans.get("transpose_backward")
+        if self.trainer.plans.get("transpose_forward") is not None:
+            softmax = softmax.transpose([0] + [i + 1 for i in transpose_backward])
+        return softmax
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    """Inference requests on folders relative to the mounted data directory.
+
+    `GET /health` returns the served model and the host path of the data directory,
+    `POST /predict` with `{"input": ..., "output": ..., "exchange": ..., "options": ...}` predicts all cases of the input folder,
+    where the options may override the folds (among those loaded), `disable_tta` and `step_size`.
+    """
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """Report server status."""
+        if self.path != "/health":
+            self._reply(404, {"error": f"Unknown path: {self.path}"})
+            return
+        self._reply(200, {"model": os.environ.get("MUSEGAI_MODEL"), "root": os.environ.get("MUSEGAI_ROOT", self.server.root)})
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        """Run inference."""
+        if self.path != "/predict":
+            self._reply(404, {"error": f"Unknown path: {self.path}"})
+            return
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        input_folder = os.path.realpath(join(self.server.root, request["input"]))
+        output_folder = os.path.realpath(join(self.server.root, request["output"]))
+        root = os.path.realpath(self.server.root)
+        if not all(os.path.commonpath([root, folder]) == root for folder in [input_folder, output_folder]):
+            self._reply(400, {"error": "Folders must be located inside the data directory"})
+            return
+        exchange = request.get("exchange", ".nii.gz")
+        if exchange not in EXCHANGE_FORMATS:
+            self._reply(400, {"error": f"Unknown exchange format: {exchange}"})
+            return
+        options = request.get("options", {})
+        unsupported = set(options) - {"folds", "disable_tta", "step_size"}
+        if unsupported:
+            self._reply(400, {"error": f"Unsupported inference options: {', '.join(sorted(unsupported))}"})
+            return
+        try:
+            with self.server.lock:
+                st = time()
+                self.server.predictor.predict(input_folder, output_folder, exchange, **options)
+        except ValueError as exc:
+            self._reply(400, {"error": str(exc)})
+            return
+        except Exception as exc:  # pylint: disable=broad-exception-caught
+            self._reply(500, {"error": repr(exc)})
+            return
+        self._reply(200, {"status": "done", "time": time() - st})
+
+    def _reply(self, code, content):
+        body = json.dumps(content).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve(predictor, host, port, root="./data"):
+    """Serve inference requests until interrupted."""
+    server = ThreadingHTTPServer((host, port), _RequestHandler)
+    server.predictor = predictor
+    server.root = root
+    server.lock = threading.Lock()
+    print(f"Serving inference requests on {host}:{port}")
+    server.serve_forever()
+
 
 def main():
     """Run nnU-Net inference."""
@@ -18,13 +217,13 @@ def main():
     parser.add_argument(
         "-i",
         "--input_folder",
+        required=False,
         help="Must contain all modalities for each patient in the correct"
         " order (same as training). Files must be named "
         "CASENAME_XXXX.nii.gz where XXXX is the modality "
         "identifier (0000, 0001, etc)",
-        required=True,
     )
-    parser.add_argument("-o", "--output_folder", required=True, help="folder for saving predictions")
+    parser.add_argument("-o", "--output_folder", required=False, help="folder for saving predictions")
     parser.add_argument("-t", "--task_name", help="task name or task ID, required.", default=default_plans_identifier, required=True)
 
     parser.add_argument(
@@ -155,8 +354,37 @@ def main():
         "the required vram. If you want to disable mixed precision you can set this flag. Note "
         "that this is not recommended (mixed precision is ~2x faster!)",
     )
+    parser.add_argument(
+        "--serve",
+        default=False,
+        action="store_true",
+        help="Run as a persistent inference server: the model is loaded once and folders below ./data are predicted on request. "
+        "Input and output folders are ignored in this mode",
+    )
+    parser.add_argument("--host", default="0.0.0.0", help="Host of the inference server (with --serve)")
+    parser.add_argument("--port", type=int, default=8765, help="Port of the inference server (with --serve)")
+    parser.add_argument(
+        "--exchange",
+        default=".nii.gz",
+        choices=EXCHANGE_FORMATS,
+        help="Format of the input and output files. Uncompressed .nii files avoid the gzip (de-)compression, "
+        "best combined with a data directory on a tmpfs such as /dev/shm",
+    )
 
     args = parser.parse_args()
+    if not args.serve and (args.input_folder is None or args.output_folder is None):
+        parser.error("the following arguments are required: -i/--input_folder, -o/--output_folder")
+    if args.serve or args.exchange != ".nii.gz":
+        # the predictor keeping the model in memory does not implement these options of `predict_from_folder`
+        unsupported = {
+            "--part_id/--num_parts": args.part_id != 0 or args.num_parts != 1,
+            "--save_npz": args.save_npz,
+            "--mode": args.mode != "normal",
+            "-l/--lowres_segmentations": args.lowres_segmentations != "None",
+        }
+        unsupported = [option for option, given in unsupported.items() if given]
+        if unsupported:
+            parser.error(f"not supported with --serve or --exchange other than .nii.gz: {', '.join(unsupported)}")
     input_folder = args.input_folder
     output_folder = args.output_folder
     part_id = args.part_id
@@ -186,6 +414,9 @@ def main():
     if lowres_segmentations == "None":
         lowres_segmentations = None
 
+    assert not (args.serve and model == "3d_cascade_fullres"), "the cascade is not supported in server mode"
+    assert args.exchange == ".nii.gz" or model != "3d_cascade_fullres", "the cascade only supports .nii.gz files"
+
     if isinstance(folds, list):
         if folds[0] == "all" and len(folds) == 1:
             pass
@@ -248,6 +479,26 @@ def main():
     print("using model stored in ", model_folder_name)
     assert isdir(model_folder_name), "model output folder not found. Expected: %s" % model_folder_name
 
+    if args.serve or args.exchange != ".nii.gz":
+        predictor = Predictor(
+            model_folder_name,
+            folds,
+            num_threads_preprocessing=num_threads_preprocessing,
+            num_threads_nifti_save=num_threads_nifti_save,
+            do_tta=not disable_tta,
+            mixed_precision=not args.disable_mixed_precision,
+            all_in_gpu=all_in_gpu,
+            step_size=step_size,
+            checkpoint_name=args.chk,
+        )
+        if args.serve:
+            serve(predictor, args.host, args.port)
+            return
+        st = time()
+        predictor.predict(input_folder, output_folder, args.exchange, overwrite_existing=overwrite_existing)
+        save_json(time() - st, join(output_folder, "prediction_time.txt"))
+        return
+
     st = time()
     predict_from_folder(
         model_folder_name,
@@ -0,0 +1,70 @@
+"""Patch sampling around the annotated slices of sparsely annotated volumes (numpy only, see `nnUNetTrainerV2_MUSEGAI`).
+
+The segmentations are indexed (z, y, x), with the slice axis first, -1 outside of the image, and the unannotated voxels
+set to the ignored label. A patch is cropped to its final patch (centered, of `final_patch_size`) by the spatial
+augmentation, `margin` voxels from its start along each axis.
+"""
+from __future__ import annotations
+
+import concurrent.futures
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+
+
+def labelled_voxels(seg, ignore_label):
+    """Return the number of labelled voxels (neither ignored nor outside of the image) of each slice of a segmentation (z, y, x)."""
+    labelled = (seg >= 0) & (seg != ignore_label)
+    return np.count_nonzero(labelled.reshape(seg.shape[0], -1), axis=1)
+
+
+def load_slice_index(data_file, ignore_label):
+    """Return the labelled voxels per slice of a preprocessed case, computed once and cached next to its data file."""
+    cache = Path(data_file[:-4] + "_slices.json")
+    if cache.is_file():
+        index = json.loads(cache.read_text(encoding="utf-8"))
+        if index["ignore_label"] == ignore_label:
+            return np.array(index["voxels"], dtype=np.int64)
+    npy = data_file[:-4] + ".npy"
+    data = np.load(npy, mmap_mode="r") if os.path.isfile(npy) else np.load(data_file)["data"]
+    voxels = labelled_voxels(data[-1], ignore_label)
+    # atomically, as several trainings may share the preprocessed data
+    tmp = cache.with_name(f".{cache.name}.{os.getpid()}")
+    tmp.write_text(json.dumps({"ignore_label": ignore_label, "voxels": voxels.tolist()}), encoding="utf-8")
+    os.replace(tmp, cache)
+    return voxels
+
+
+def index_dataset(dataset, ignore_label, workers=8):
+    """Return the labelled voxels per slice of the cases of a preprocessed dataset (see `load_slice_index`), by case."""
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        voxels = executor.map(lambda key: load_slice_index(dataset[key]["data_file"], ignore_label), dataset)
+        return dict(zip(dataset, voxels))
+
+
+def slice_start(index, lower, upper, margin, size, rng=np.random):
+    """Return a start of a patch along the slice axis, within `[lower, upper]`, such that the slice `index` lies in the central half of the final patch (of `size` slices)."""
+    first = max(index - margin - (size - size // 4) + 1, lower)
+    last = min(index - margin - size // 4, upper)
+    if first > last:
+        return int(np.clip(index - margin - size // 2, lower, upper))
+    return int(rng.randint(first, last + 1))
+
+
+def voxel_start(voxel, lower, upper, margin, final_patch_size):
+    """Return the start of a patch centered on a voxel, within `[lower, upper]`, and keeping the voxel inside the final patch if possible."""
+    voxel, margin, size = np.asarray(voxel), np.asarray(margin), np.asarray(final_patch_size)
+    # starts of the final patches containing the voxel
+    first = np.maximum(voxel - margin - size + 1, lower)
+    last = np.minimum(voxel - margin, upper)
+    centered = voxel - margin - size // 2
+    return np.where(first <= last, np.clip(centered, first, last), np.clip(centered, lower, upper))
+
+
+def labelled_in_patch(seg, margin, final_patch_size, ignore_label):
+    """Return the number of labelled voxels of the final patch of a segmentation patch."""
+    central = tuple(slice(start, start + size) for start, size in zip(margin, final_patch_size))
+    patch = seg[central]
+    return int(np.count_nonzero((patch >= 0) & (patch != ignore_label)))
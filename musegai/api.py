@@ -2,86 +2,441 @@
 # pylint: disable=missing-function-docstring
 from __future__ import annotations
 
+import collections
+import concurrent.futures
+import contextlib
+import functools
+import hashlib
+import heapq
+import itertools
+import json
+import multiprocessing
+import os
 import pathlib
+import queue
+import shutil
+import struct
+import sys
 import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
 import uuid
 
-import numpy as np
-import SimpleITK as sitk
+from musegai import dicom, imports, labelmap, models, tracing
 
-import docker
+# heavy dependencies, imported on first use such that the command line interface starts fast
+asyncio = imports.lazy_import("asyncio")  # pylint: disable=invalid-name
+np = imports.lazy_import("numpy")  # pylint: disable=invalid-name
+sitk = imports.lazy_import("SimpleITK")  # pylint: disable=invalid-name
+docker = imports.lazy_import("docker")  # pylint: disable=invalid-name
 
 SIDES = ["left", "right", "left+right"]
 
+# file formats for exchanging volumes with the inference model
+EXCHANGE_FORMATS = [".nii.gz", ".nii"]
+# exchange of in-memory volumes with in-process backends (no files)
+MEMORY_EXCHANGE = "memory"
+
+# inference backends by name (see `register_backend`)
+BACKENDS = {}
+
+# options of the inference model (see `nnunet_predict.py`), of which a running inference server accepts only some per request
+INFERENCE_OPTIONS = ["folds", "disable_tta", "step_size", "disable_mixed_precision", "num_threads_preprocessing", "num_threads_nifti_save"]
+REQUEST_OPTIONS = ["folds", "disable_tta", "step_size"]
+
+# speed/accuracy trade-offs: test time augmentation (mirroring) multiplies the runtime by 8, each fold adds one prediction
+PRESETS = {
+    "fast": {"folds": [0], "disable_tta": True, "step_size": 0.7},
+    "balanced": {"folds": [0, 1, 2, 3, 4], "disable_tta": True, "step_size": 0.5},
+    "full": {"folds": [0, 1, 2, 3, 4], "disable_tta": False, "step_size": 0.5},
+}
+
+# margin (mm) around the limbs when cropping the volumes to their bounding boxes
+CROP_MARGIN = 10.0
+
+# overlap (slices) of the slabs tiling long volumes along the slice axis (see `segment_volumes(slab_size=...)`)
+SLAB_OVERLAP = 8
+
+# downsampling factor of the in-plane axes of the volumes in preview mode (see `segment_volumes(preview=...)`)
+PREVIEW_FACTOR = 2
+
+# seconds between the polls of the outputs written during inference (see `segment_volumes(stream=True)`)
+STREAM_INTERVAL = 1.0
+
+# voxels (at most) of the volumes hashed in the fingerprints of the cases of a resumable run (see `segment_volumes(workdir=...)`)
+FINGERPRINT_VOXELS = 1 << 20
+
 
 def list_models():
     """List available models."""
-    return ["thigh-model3"]
+    return models.list_models()
 
 
-def segment_volumes(volumes, model, *, side="left,right", tempdir=None):
-    """Segment volumes with specified model."""
-    input_type, volumes = _setup_volumes(volumes)
+def scan_dicom(directory, *, workers=dicom.WORKERS):
+    """Find the in-phase and out-of-phase DICOM series of a directory (and its subdirectories), reading their headers only.
 
-    # check model
-    models = list_models()
-    if model not in models + ["test"]:
-        raise ValueError(f"Unknown model: {model}")
+    Return the headers of the pairs of series by name (see `dicom.pair_series`), whose voxel data is decoded on load.
+    """
+    pairs = dicom.pair_series(dicom.index_directory(directory, workers=workers))
+    return {name: [_dicom_header(series, name) for series in pair] for name, pair in pairs.items()}
 
-    _pull_if_not_exists(model)
 
-    # prepare volumes
-    to_segment = {}
-    volume_parts = {}
-    for name, vols in volumes.items():
-        # checks
+def segment_volumes(
+    volumes,
+    model,
+    *,
+    side="left,right",
+    tempdir=None,
+    server=None,
+    batch_size=None,
+    max_memory=None,
+    callback=None,
+    exchange=".nii.gz",
+    cache=None,
+    io_workers=None,
+    io_executor="thread",
+    workers=1,
+    devices=None,
+    preset=None,
+    options=None,
+    crop=False,
+    slab_size=None,
+    slab_overlap=SLAB_OVERLAP,
+    preview=False,
+    backend=None,
+    stream=False,
+    workdir=None,
+    tracer=None,
+):
+    """Segment volumes with specified model.
+
+    If `server` (default: the `MUSEGAI_SERVER` environment variable) is the URL of a running inference server
+    serving `model`, the inference is delegated to it instead of starting a new container.
+
+    The cases are segmented in chunks of at most `batch_size` cases and `max_memory` bytes of input voxel data
+    (default: all cases at once). Writing the inputs of the next chunk and reading back the outputs of the previous
+    chunk overlap with the inference of the current chunk. If `callback` is given, each segmentation is passed to
+    `callback(name, volume)` (from a worker thread) as soon as its chunk is done instead of being returned, such that
+    the memory usage does not grow with the number of cases.
+
+    The volumes are exchanged with the inference model as `exchange` files (see `EXCHANGE_FORMATS`). Uncompressed
+    `.nii` files avoid the (single-threaded) gzip compression, and work best with a tmpfs `tempdir` such as `/dev/shm`.
+
+    The model runs on the inference `backend` (see `BACKENDS`, default: "docker", or "test" for the dummy model `test`).
+    The in-process backends ("torch", "test") also exchange the volumes in memory without writing files
+    (`exchange=MEMORY_EXCHANGE`), with a single worker.
+
+    If `cache` (a `musegai.cache.SegmentationCache`) is given, cached cases are served without inference, identical
+    cases are segmented only once, and new segmentations are added to the cache.
+
+    Volume files are read and written by a pool of `io_workers` workers (default: sequentially), either threads or
+    processes (`io_executor`). The files of a chunk are all processed even if some fail, and failures are reported per file.
+
+    The cases of a chunk are split into `workers` shards of balanced size (number of voxels), segmented by concurrent
+    inference containers. `devices` lists the GPU ids assigned to the workers in turn (default: all GPUs for every
+    worker), use `"cpu"` for workers without GPU.
+
+    The speed/accuracy trade-off of the inference is set by a `preset` (see `PRESETS`, default: the model's defaults,
+    i.e., "full"), and by `options` (see `INFERENCE_OPTIONS`) overriding those of the preset.
+
+    If `crop` is set, each limb is cropped to its bounding box (with a margin of `CROP_MARGIN`), split from the other
+    limb at the gap between the legs, and its segmentation is pasted back into a full-size volume. The inference does
+    not process the background, which often fills most of the field of view.
+
+    If `slab_size` is set, each limb longer than `slab_size` slices is tiled into slabs of `slab_size` slices along the
+    slice (last) axis, overlapping by at least `slab_overlap` slices, which are segmented as separate cases and stitched
+    back, such that the memory of the inference does not grow with the length of the volumes (e.g., multi-station
+    acquisitions). The overlaps are split halfway between the slabs, away from their borders lacking context.
+
+    If `preview` is set (`True` for `PREVIEW_FACTOR`, or a downsampling factor), the volumes are downsampled in-plane
+    (by averaging blocks of voxels) before inference, with the "fast" preset unless given another, and the segmentations
+    are upsampled back to the geometry of the volumes (nearest neighbour): a coarse segmentation for quality control,
+    e.g., followed by a full-resolution call with the same (loaded) volumes.
+
+    If `stream` is set (with `callback`), the outputs of the model are polled during inference (every `STREAM_INTERVAL`
+    seconds), and each segmentation is passed to `callback` as soon as its outputs are written, rather than when its
+    chunk is done (see also `segment_volumes_iter`). The Docker backend streams the outputs with the exchange format
+    `.nii` or with an inference server only, as nnU-Net postprocesses `.nii.gz` outputs once all are written.
+
+    The files are exchanged in a temporary directory in `tempdir`, or in the persistent working directory `workdir`. If
+    a run in `workdir` is interrupted (e.g., the container died), calling `segment_volumes` again with the same
+    arguments resumes it: the cases already segmented by the model are not segmented again, unless their volumes changed
+    (their geometry and a sample of their voxels are recorded). Resuming requires named cases (a dict of volumes). The
+    working directory is emptied when the run is done.
+
+    If `tracer` (a `musegai.tracing.Tracer`) is given, it records the time spent in each stage, per chunk, case and file,
+    with the bytes read and written.
+    """
+    input_type, volumes = _setup_volumes(volumes)
+    if workdir is not None and input_type != "dict":
+        raise ValueError("A run in a working directory resumes cases by name: pass the volumes as a dict")
+    factor = _check_preview(preview)
+    options = _inference_options(preset or ("fast" if factor else None), options)
+    backend = _check_model(model, exchange, backend)
+    tracer = tracer or tracing.NO_TRACER
+    with tracer.span("connect", model=model):
+        server = _connect(model, server, options, backend)
+    store, ext = _exchange(exchange, server, workers)
+    if server is not None:
+        # exchange files through the directory shared with the server
+        tempdir = server["root"]
+        _check_workdir(workdir, tempdir)
+    stream = stream and callback is not None and store is None and (server is not None or backend != "docker" or exchange != ".nii.gz")
+
+    # checks
+    for vols in volumes.values():
         _check_volumes(vols)
+    tiling = _check_slabs(slab_size, slab_overlap)
+    if factor:
+        # segment the downsampled volumes, and upsample their segmentations
+        volumes, upsample = _preview_volumes(volumes, factor)
+        callback = None if callback is None else _upsampling_callback(callback, upsample)
+        tiling = {**tiling, "preview": factor}
+    chunks = _make_chunks(volumes, batch_size=batch_size, max_memory=max_memory)
 
-        for i, vol in enumerate(vols):
-            # split into left and right
-            left, right = _split_volume(vol, side)
-            volume_parts[name] = []
-            if left is not None:
-                volume_parts[name].append("left")
-                to_segment[f"{name}_left_{i:04d}"] = left
-            if right is not None:
-                volume_parts[name].append("right")
-                to_segment[f"{name}_right_{i:04d}"] = right
-
-    # save into temporary directory, and segment
+    # save into temporary directory, and segment chunk by chunk
+    lookup = None if cache is None else _CacheLookup(cache, model, side, {**options, "crop": True, **tiling} if crop else {**options, **tiling})
     segmented = {}
-    with tempfile.TemporaryDirectory(dir=tempdir) as tmp:
+    labels = None
+    with (
+        _working_directory(workdir, tempdir) as tmp,
+        concurrent.futures.ThreadPoolExecutor(max_workers=3) as executor,
+        _io_pool(io_workers, io_executor) as io_pool,
+    ):
         tmp = pathlib.Path(tmp)
+        resumed = None
+        if workdir is not None:
+            resumed = _resume(tmp, {"model": model, "side": side, "exchange": exchange, "options": options, "crop": crop, **tiling}, ext, io_pool=io_pool)
+        prepare = functools.partial(_prepare_chunk, side=side, ext=ext, lookup=lookup, io_pool=io_pool, store=store, crop=crop, tiling=tiling, resumed=resumed, tracer=tracer)
+        collect = functools.partial(_collect_chunk, callback=callback, ext=ext, lookup=lookup, io_pool=io_pool, store=store, tracer=tracer)
+        preparing = executor.submit(prepare, {name: volumes[name] for name in chunks[0]}, chunkdir=tmp / "chunk0000")
+        collecting = None
+        for index in range(len(chunks)):
+            chunkdir, volume_parts, cached, crops, slabs = preparing.result()
+            if index + 1 < len(chunks):
+                # save the next chunk during inference
+                preparing = executor.submit(prepare, {name: volumes[name] for name in chunks[index + 1]}, chunkdir=tmp / f"chunk{index + 1:04d}")
 
-        # make input and output directories
-        indir = tmp / "in"
-        indir.mkdir()
-        outdir = tmp / "out"
-        outdir.mkdir()
+            # run model (unless all cases of the chunk are cached, or resumed)
+            streaming = None
+            if (volume_parts or lookup is None) and not _all_resumed(chunkdir, store):
+                done = threading.Event()
+                if stream:
+                    streaming = executor.submit(
+                        _stream_chunk,
+                        chunkdir,
+                        volume_parts,
+                        done,
+                        callback=callback,
+                        ext=ext,
+                        crops=crops,
+                        slabs=slabs,
+                        keep=lookup is not None,
+                        tracer=tracer,
+                    )
+                try:
+                    with tracer.span("inference", chunk=chunkdir.name, cases=len(volume_parts)):
+                        _run_workers(
+                            model,
+                            chunkdir / "in",
+                            chunkdir / "out",
+                            workers=workers,
+                            devices=devices,
+                            server=server,
+                            exchange=exchange,
+                            options=options,
+                            backend=backend,
+                            store=store,
+                            tracer=tracer,
+                        )
+                finally:
+                    done.set()
 
-        # save input data
-        for name, vol in to_segment.items():
-            vol.save(indir / name, ".nii.gz")
+            # recover outputs of the previous chunk, and start recovering the current one
+            if collecting is not None:
+                chunk_segmented, chunk_labels = collecting.result()
+                segmented.update(chunk_segmented)
+                labels = chunk_labels or labels
+            streamed = None if streaming is None else streaming.result()
+            collecting = executor.submit(collect, chunkdir, volume_parts, cached=cached, crops=crops, slabs=slabs, streamed=streamed)
+        chunk_segmented, chunk_labels = collecting.result()
+        segmented.update(chunk_segmented)
+        labels = chunk_labels or labels
+        if workdir is not None:
+            _finish(tmp)
 
-        # run model
-        _run_model(model, indir, outdir)
+    if callback is not None:
+        return None, labels
+    if factor:
+        segmented = {name: upsample(name, vol) for name, vol in segmented.items()}
+    return _format_results(input_type, volumes, segmented), labels
 
-        # recover outputs
 
-        labels = Labels.load(outdir / "labels.txt")
-        for name, parts in volume_parts.items():
-            if "left" in parts:
-                left = Volume.load(outdir / f"{name}_left", ".nii.gz")
-            if "right" in parts:
-                right = Volume.load(outdir / f"{name}_right", ".nii.gz")
-            vol = _heal_volume(left, right)
-            segmented[name] = vol
+def segment_volumes_iter(volumes, model, **kwargs):
+    """Segment volumes with specified model, and yield `(name, volume)` pairs as soon as each case is segmented.
+
+    The arguments are those of `segment_volumes` (without `callback`), which runs in a background thread with `stream`
+    set. If the generator is closed early, the run stops after the inference of the current chunk.
+    """
+    results = queue.Queue()
+    closed = threading.Event()
+
+    def callback(name, vol):
+        if closed.is_set():
+            raise _StreamClosed()
+        results.put((name, vol))
+
+    def run():
+        try:
+            segment_volumes(volumes, model, callback=callback, stream=True, **kwargs)
+        except _StreamClosed:
+            pass
+        except BaseException as exc:  # pylint: disable=broad-exception-caught  # raised by the generator
+            results.put(exc)
+        results.put(None)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    try:
+        while (result := results.get()) is not None:
+            if isinstance(result, BaseException):
+                raise result
+            yield result
+    finally:
+        closed.set()
+        thread.join()
+
+
+class _StreamClosed(Exception):
+    """Stop the segmentation of a closed `segment_volumes_iter` generator."""
 
-    if input_type == "dict":
-        return segmented, labels
-    if input_type == "single":
-        return next(segmented.values()), labels
-    return [segmented[name] for name in volumes], labels
+
+async def segment_volumes_async(
+    volumes,
+    model,
+    *,
+    side="left,right",
+    tempdir=None,
+    server=None,
+    batch_size=None,
+    max_memory=None,
+    callback=None,
+    exchange=".nii.gz",
+    cache=None,
+    io_workers=None,
+    io_executor="thread",
+    workers=1,
+    devices=None,
+    preset=None,
+    options=None,
+    crop=False,
+    slab_size=None,
+    slab_overlap=SLAB_OVERLAP,
+    preview=False,
+    backend=None,
+    workdir=None,
+    concurrency=1,
+    poll_interval=1.0,
+    tracer=None,
+):
+    """Segment volumes with specified model without blocking the event loop.
+
+    This is the asyncio counterpart of `segment_volumes`, with the same arguments (except `stream`). The Docker calls, the
+    requests to the inference server and the file I/O run in worker threads, and the inference containers are polled
+    every `poll_interval` seconds.
+
+    Up to `concurrency` chunks are segmented concurrently. To limit the number of concurrent inferences of several calls,
+    pass the same `asyncio.Semaphore` to all of them instead. If the call is cancelled, its running containers are
+    stopped, and its temporary files are removed. A request to an inference server cannot be cancelled, the call waits
+    for it to finish before removing the temporary files.
+    """
+    input_type, volumes = _setup_volumes(volumes)
+    if workdir is not None and input_type != "dict":
+        raise ValueError("A run in a working directory resumes cases by name: pass the volumes as a dict")
+    factor = _check_preview(preview)
+    options = _inference_options(preset or ("fast" if factor else None), options)
+    backend = _check_model(model, exchange, backend)
+    tracer = tracer or tracing.NO_TRACER
+    with tracer.span("connect", model=model):
+        server = await asyncio.to_thread(_connect, model, server, options, backend)
+    store, ext = _exchange(exchange, server, workers)
+    if server is not None:
+        # exchange files through the directory shared with the server
+        tempdir = server["root"]
+        _check_workdir(workdir, tempdir)
+
+    # checks
+    for vols in volumes.values():
+        _check_volumes(vols)
+    tiling = _check_slabs(slab_size, slab_overlap)
+    if factor:
+        # segment the downsampled volumes, and upsample their segmentations
+        volumes, upsample = _preview_volumes(volumes, factor)
+        callback = None if callback is None else _upsampling_callback(callback, upsample)
+        tiling = {**tiling, "preview": factor}
+    chunks = _make_chunks(volumes, batch_size=batch_size, max_memory=max_memory)
+
+    # limit the inferences, and the chunks saved ahead of their inference
+    if isinstance(concurrency, asyncio.Semaphore):
+        limiter, slots = concurrency, 2
+    else:
+        limiter, slots = asyncio.Semaphore(concurrency), concurrency + 1
+    pending = asyncio.Semaphore(slots)
+
+    lookup = None if cache is None else _CacheLookup(cache, model, side, {**options, "crop": True, **tiling} if crop else {**options, **tiling})
+    stack = contextlib.ExitStack()
+    try:
+        tmp = pathlib.Path(stack.enter_context(_working_directory(workdir, tempdir)))
+        executor = stack.enter_context(concurrent.futures.ThreadPoolExecutor(max_workers=slots))
+        # blocking inference calls writing into the temporary directory
+        runner = stack.enter_context(concurrent.futures.ThreadPoolExecutor())
+        io_pool = stack.enter_context(_io_pool(io_workers, io_executor))
+        resumed = None
+        if workdir is not None:
+            run = {"model": model, "side": side, "exchange": exchange, "options": options, "crop": crop, **tiling}
+            resumed = await asyncio.to_thread(_resume, tmp, run, ext, io_pool=io_pool)
+        prepare = functools.partial(_prepare_chunk, side=side, ext=ext, lookup=lookup, io_pool=io_pool, store=store, crop=crop, tiling=tiling, resumed=resumed, tracer=tracer)
+        collect = functools.partial(_collect_chunk, callback=callback, ext=ext, lookup=lookup, io_pool=io_pool, store=store, tracer=tracer)
+        run = functools.partial(
+            _run_workers_async,
+            model,
+            workers=workers,
+            devices=devices,
+            server=server,
+            exchange=exchange,
+            options=options,
+            backend=backend,
+            store=store,
+            poll_interval=poll_interval,
+            executor=runner,
+        )
+
+        async def segment_chunk(index, names):
+            async with pending:
+                preparing = executor.submit(prepare, {name: volumes[name] for name in names}, chunkdir=tmp / f"chunk{index:04d}")
+                chunkdir, volume_parts, cached, crops, slabs = await asyncio.wrap_future(preparing)
+                if (volume_parts or lookup is None) and not _all_resumed(chunkdir, store):
+                    async with limiter:
+                        with tracer.span("inference", chunk=chunkdir.name, cases=len(volume_parts)):
+                            await run(chunkdir / "in", chunkdir / "out")
+                return await asyncio.wrap_future(executor.submit(collect, chunkdir, volume_parts, cached=cached, crops=crops, slabs=slabs))
+
+        results = await _gather_or_cancel(segment_chunk(index, names) for index, names in enumerate(chunks))
+        if workdir is not None:
+            await asyncio.to_thread(_finish, tmp)
+    finally:
+        # wait for the file operations, and remove the temporary files (in a thread, as this blocks)
+        await asyncio.to_thread(stack.close)
+
+    segmented = {name: vol for chunk_segmented, _ in results for name, vol in chunk_segmented.items()}
+    labels = next((chunk_labels for _, chunk_labels in reversed(results) if chunk_labels), None)
+    if callback is not None:
+        return None, labels
+    if factor:
+        segmented = {name: upsample(name, vol) for name, vol in segmented.items()}
+    return _format_results(input_type, volumes, segmented), labels
 
 
 #
@@ -108,7 +463,9 @@ class Labels:
 class Volume:
     """Image container."""
 
+    # file formats of the volumes, and of the segmentations, which may be saved in the compact label map format
     EXTENSIONS = [".mha", ".mhd", ".hdr", ".nii", ".nii.gz"]
+    SEGMENTATION_EXTENSIONS = EXTENSIONS + [labelmap.EXTENSION]
 
     def __init__(self, obj, **meta):
         try:
@@ -131,6 +488,10 @@ class Volume:
     def ndim(self):
         return self.array.ndim
 
+    @property
+    def nbytes(self):
+        return self.array.nbytes
+
     @property
     def metadata(self):
         return {
@@ -141,33 +502,87 @@ class Volume:
         }
 
     def save(self, file, ext=None):
+        """Save the volume file.
+
+        Segmentations can be saved in the compact label map format (`.mseg`, see `labelmap`).
+        """
         file = pathlib.Path(file)
-        im = sitk.GetImageFromArray(self.array.T)
+        if not file.suffix and ext:
+            file = pathlib.Path(file).with_suffix(ext)
+        if file.name.endswith(labelmap.EXTENSION):
+            labelmap.save(self.array, file, origin=self.origin, spacing=self.spacing, transform=self.transform)
+            return
+        im = _array_to_image(self.array)
         im.SetSpacing(self.spacing)
         im.SetOrigin(self.origin)
         im.SetDirection(self.transform)
-        if not file.suffix and ext:
-            file = pathlib.Path(file).with_suffix(ext)
         sitk.WriteImage(im, file)
 
     @classmethod
-    def load(cls, file, ext=None):
+    def load(cls, file, ext=None, *, mmap=False):
+        """Load the volume file.
+
+        If `mmap`, the voxel data of uncompressed files (`.mha`, `.mhd`, `.hdr`, `.nii`) is memory-mapped (copy on write)
+        instead of read: the pages of the file are read on first access, e.g., not by slicing.
+
+        A DICOM series is loaded from one of its slice files, or from a directory with a single series (see `dicom`).
+        """
         file = pathlib.Path(file)
         if not file.suffix and ext:
             file = pathlib.Path(file).with_suffix(ext)
+        if _is_dicom(file):
+            return _dicom_header(dicom.find_series(file), file.name).load()
         name, ext = cls.check_file(file)
+        if ext == labelmap.EXTENSION:
+            array, header = labelmap.load(file)
+            return cls(array, **_labelmap_geometry(header), extension=ext, name=name)
+        if mmap and ext in [".mha", ".mhd", ".hdr", ".nii"]:
+            header = cls.load_header(file)
+            layout = _raw_layout(file, ext, header)
+            if layout is not None:
+                data_file, offset = layout
+                # (z, y, x) as stored, to (x, y, z)
+                array = np.memmap(data_file, dtype=header.dtype, mode="c", offset=offset, shape=header.shape[::-1]).T
+                return cls(array, **header.metadata)
         im = sitk.ReadImage(file)
-        array = sitk.GetArrayFromImage(im).T
+        array = _image_to_array(im)
         spacing = im.GetSpacing()
         origin = im.GetOrigin()
         transform = im.GetDirection()
         info = {"extension": ext, "name": name}
         return cls(array, origin=origin, spacing=spacing, transform=transform, **info)
 
+    @classmethod
+    def load_header(cls, file, ext=None):
+        """Read the image header only, without loading the voxel data."""
+        file = pathlib.Path(file)
+        if not file.suffix and ext:
+            file = pathlib.Path(file).with_suffix(ext)
+        if _is_dicom(file):
+            return _dicom_header(dicom.find_series(file), file.name)
+        name, ext = cls.check_file(file)
+        if ext == labelmap.EXTENSION:
+            header = labelmap.load_header(file)
+            return VolumeHeader(file, shape=header["shape"], dtype="uint8", **_labelmap_geometry(header), extension=ext, name=name)
+        reader = sitk.ImageFileReader()
+        reader.SetFileName(str(file))
+        reader.ReadImageInformation()
+        pixel = sitk.Image([1] * reader.GetDimension(), reader.GetPixelID(), reader.GetNumberOfComponents())
+        info = {"extension": ext, "name": name}
+        return VolumeHeader(
+            file,
+            shape=reader.GetSize(),
+            dtype=sitk.GetArrayViewFromImage(pixel).dtype,
+            origin=reader.GetOrigin(),
+            spacing=reader.GetSpacing(),
+            transform=reader.GetDirection(),
+            **info,
+        )
+
     @classmethod
     def check_file(cls, filename):
         filename = pathlib.Path(filename)
-        for ext in cls.EXTENSIONS:
+        for ext in cls.SEGMENTATION_EXTENSIONS:
             if str(filename).endswith(ext):
                 name = filename.name.split(ext)[0]
                 break
@@ -176,19 +591,564 @@ class Volume:
         return name, ext
 
 
+class VolumeHeader:
+    """Image header of a volume file, whose voxel data is loaded on demand."""
+
+    def __init__(self, file, *, shape, dtype, origin, spacing, transform, **info):
+        self.file = pathlib.Path(file)
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.origin = origin
+        self.spacing = spacing
+        self.transform = transform
+        self.info = info
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def nbytes(self):
+        return int(np.prod(self.shape)) * self.dtype.itemsize
+
+    @property
+    def metadata(self):
+        return {
+            "origin": self.origin,
+            "spacing": self.spacing,
+            "transform": self.transform,
+            "info": self.info,
+        }
+
+    def load(self, *, mmap=True):
+        if "dicom" in self.info:
+            # the slices were indexed with the header
+            return Volume(dicom.load(self.info["dicom"]), **self.metadata)
+        return Volume.load(self.file, mmap=mmap)
+
+
 #
 # private functions
 
 
-def _split_volume(volume, side, axis=0):
-    """Split volumes according to side."""
+class _ImageBuffer:  # pylint: disable=too-few-public-methods
+    """Writable array interface to the pixel buffer of a SimpleITK image, which is kept alive by the arrays using it."""
+
+    def __init__(self, image):
+        self.image = image
+        interface = dict(sitk.GetArrayViewFromImage(image).__array_interface__)
+        interface["data"] = (interface["data"][0], False)
+        self.__array_interface__ = interface
+
+
+def _labelmap_geometry(header):
+    """Return the geometry of a label map file, from its header."""
+    return {"origin": tuple(header["origin"]), "spacing": tuple(header["spacing"]), "transform": tuple(header["transform"])}
+
+
+def _raw_layout(file, ext, header):
+    """Return the file and the offset of the raw voxel data of an uncompressed volume file, or None.
+
+    The volume files in native byte order without compression, scaling or multiple components can be memory-mapped.
+    """
+    layout = _metaimage_layout(file) if ext in [".mha", ".mhd"] else _nifti_layout(file, ext)
+    if layout is None:
+        return None
+    data_file, offset, big_endian = layout
+    if big_endian != (sys.byteorder == "big") or header.dtype.kind not in "iuf":
+        return None
+    if not data_file.is_file() or data_file.stat().st_size < offset + header.nbytes:
+        # truncated: reported by SimpleITK
+        return None
+    return data_file, offset
+
+
+def _metaimage_layout(file):
+    """Return the data file, the offset and the byte order of a MetaImage file, or None if not memory-mappable."""
+    fields = {}
+    with open(file, "rb") as fp:
+        for line in fp:
+            key, _, value = line.decode("latin-1").partition("=")
+            fields[key.strip()] = value.strip()
+            if key.strip() == "ElementDataFile":
+                offset = fp.tell()
+                break
+        else:
+            return None
+    if fields.get("CompressedData", "False") != "False" or fields.get("BinaryData", "True") != "True" or fields.get("ElementNumberOfChannels", "1") != "1":
+        return None
+    big_endian = "True" in [fields.get("BinaryDataByteOrderMSB"), fields.get("ElementByteOrderMSB")]
+    if fields["ElementDataFile"] == "LOCAL":
+        return pathlib.Path(file), offset, big_endian
+    if fields["ElementDataFile"].startswith("LIST") or "%" in fields["ElementDataFile"] or fields.get("HeaderSize", "0") != "0":
+        return None
+    return pathlib.Path(file).parent / fields["ElementDataFile"], 0, big_endian
+
+
+# NIfTI-1 data types with several components per voxel: RGB24, RGBA32
+_NIFTI_MULTICOMPONENT = [128, 2304]
+
+
+def _nifti_layout(file, ext):
+    """Return the data file, the offset and the byte order of a NIfTI-1 file (or pair), or None if not memory-mappable."""
+    with open(file, "rb") as fp:
+        header = fp.read(348)
+    if len(header) < 348 or header[344:348] != (b"ni1\0" if ext == ".hdr" else b"n+1\0"):
+        # not NIfTI-1 (e.g., Analyze)
+        return None
+    for order, big_endian in [("<", False), (">", True)]:
+        if struct.unpack(f"{order}i", header[:4])[0] == 348:
+            break
+    else:
+        return None
+    dim = struct.unpack(f"{order}8h", header[40:56])
+    intent, datatype = struct.unpack(f"{order}2h", header[68:72])
+    if dim[0] != 3 or intent or datatype in _NIFTI_MULTICOMPONENT:
+        # not a plain 3-D scalar image (e.g., a time series, a vector or RGB image)
+        return None
+    vox_offset, slope, intercept = struct.unpack(f"{order}3f", header[108:120])
+    if slope not in [0.0, 1.0] or intercept:
+        # scaled voxel values
+        return None
+    if ext == ".hdr":
+        return pathlib.Path(file).with_suffix(".img"), int(vox_offset), big_endian
+    return pathlib.Path(file), int(vox_offset), big_endian
+
+
+def _is_dicom(file):
+    """Return whether a path is a DICOM series: a directory, or a DICOM file (not of the volume file formats)."""
+    return file.is_dir() or (not any(str(file).endswith(ext) for ext in Volume.SEGMENTATION_EXTENSIONS) and dicom.is_dicom(file))
+
+
+def _dicom_header(series, name):
+    """Return the header of a DICOM series, whose segmentation is saved as `dicom.OUTPUT_EXTENSION` by default."""
+    return VolumeHeader(
+        series.files[0],
+        shape=series.shape,
+        dtype=series.dtype,
+        origin=series.origin,
+        spacing=series.spacing,
+        transform=series.transform,
+        extension=dicom.OUTPUT_EXTENSION,
+        name=name,
+        dicom=series,
+    )
+
+
+def _image_to_array(image):
+    """Return the (x, y, z)-indexed array sharing the pixel buffer of the image (no copy)."""
+    return np.asarray(_ImageBuffer(image)).T
+
+
+def _array_to_image(array):
+    """Return an image with the array's data, copied once directly into the image's pixel buffer."""
+    pixel_id = sitk.GetImageFromArray(np.zeros([1] * array.ndim, dtype=array.dtype)).GetPixelID()
+    image = sitk.Image(array.shape, pixel_id)
+    _image_to_array(image)[...] = array
+    return image
+
+
+def _make_chunks(volumes, *, batch_size=None, max_memory=None):
+    """Group cases into chunks of at most `batch_size` cases and `max_memory` bytes."""
+    chunks = [[]]
+    nbytes = 0
+    for name, vols in volumes.items():
+        size = sum(vol.nbytes for vol in vols)
+        full = (batch_size and len(chunks[-1]) >= batch_size) or (max_memory and nbytes + size > max_memory)
+        if chunks[-1] and full:
+            chunks.append([])
+            nbytes = 0
+        chunks[-1].append(name)
+        nbytes += size
+    return chunks
+
+
+def _prepare_chunk(volumes, side, chunkdir, *, ext=".nii.gz", lookup=None, io_pool=None, store=None, crop=False, tiling=None, resumed=None, tracer=tracing.NO_TRACER):
+    """Load, split (or crop, and tile) and save the volumes of a chunk into `chunkdir` (or into `store`), except cached and duplicate cases.
+
+    The outputs of the cases segmented by an interrupted run (`resumed`, see `_resume`) are moved into the chunk instead,
+    if the volumes of the case did not change. The fingerprints of the cases are saved with the chunk.
+    """
+    with tracer.span("prepare chunk", chunk=chunkdir.name, cases=len(volumes)):
+        return _prepare_chunk_files(
+            volumes, side, chunkdir, ext=ext, lookup=lookup, io_pool=io_pool, store=store, crop=crop, tiling=tiling or {}, resumed=resumed, tracer=tracer
+        )
+
+
+def _prepare_chunk_files(volumes, side, chunkdir, *, ext, lookup, io_pool, store, crop, tiling, resumed, tracer):  # pylint: disable=too-many-locals
+    indir = chunkdir / "in"
+    indir.mkdir(parents=True)
+    (chunkdir / "out").mkdir()
+
+    # load volumes
+    headers = {(name, i): vol for name, vols in volumes.items() for i, vol in enumerate(vols) if isinstance(vol, VolumeHeader)}
+    loaded = _map_files(io_pool, "load", [(header.file, header.load) for header in headers.values()], tracer=tracer)
+    loaded = dict(zip(headers, loaded))
+
+    volume_parts = {}
+    cached = {}
+    crops = {}  # name -> bounding boxes of the parts, and shape of the volumes
+    slabs = {}  # name -> ranges of the slabs of the tiled parts
+    to_save = []
+    voxels = [0, 0]  # voxels cropped out, of all voxels
+    outputs_resumed, fingerprints_resumed = resumed or ({}, {})
+    fingerprints = {}
+    for name, vols in volumes.items():
+        vols = [loaded.get((name, i), vol) for i, vol in enumerate(vols)]
+        if lookup is not None:
+            with tracer.span("cache lookup", case=name):
+                to_segment, cached[name] = lookup.lookup(name, vols)
+            if not to_segment:
+                continue
+        with tracer.span("split", case=name) as span:
+            boxes = _crop_boxes(vols, side) if crop else None
+            case_files = []
+            for i, vol in enumerate(vols):
+                # split into left and right
+                parts = dict(zip(["left", "right"], _split_volume(vol, side, boxes=boxes)))
+                parts = {part: half for part, half in parts.items() if half is not None}
+                if "slabs" in tiling:
+                    ranges = {part: _slab_ranges(half.shape[-1], *tiling["slabs"]) for part, half in parts.items()}
+                    ranges = {part: part_ranges for part, part_ranges in ranges.items() if len(part_ranges) > 1}
+                    if ranges:
+                        slabs[name] = ranges
+                    parts = _tile_parts(parts, ranges)
+                for part, half in parts.items():
+                    file = indir / f"{name}_{part}_{i:04d}{ext}"
+                    case_files.append((file, half))
+            outputs = [f"{name}_{part}{ext}" for part in parts]
+            if resumed is not None:
+                fingerprints[name] = _fingerprint(vols)
+            if fingerprints_resumed.get(name) == fingerprints.get(name) and all(output in outputs_resumed for output in outputs):
+                for output in outputs:
+                    outputs_resumed.pop(output).replace(chunkdir / "out" / output)
+                if "labels.txt" in outputs_resumed:
+                    shutil.copy(outputs_resumed["labels.txt"], chunkdir / "out" / "labels.txt")
+            else:
+                to_save += case_files
+            if crop:
+                crops[name] = (boxes, vols[0].shape)
+                size = sum(vol.array.size for vol in vols)
+                saved = size - len(vols) * sum(int(np.prod([index.stop - index.start for index in box])) for box in boxes.values())
+                span["cropped voxels"] = saved
+                voxels[0] += saved
+                voxels[1] += size
+        volume_parts[name] = list(parts)
+
+    if resumed is not None:
+        (chunkdir / "cases.json").write_text(json.dumps(fingerprints), encoding="utf-8")
+    if voxels[1]:
+        print(f"Cropping: {voxels[0]} of {voxels[1]} voxels ({100 * voxels[0] / voxels[1]:.0f}%) not sent to the model")
+
+    # save volume parts
+    if store is None:
+        _map_files(io_pool, "save", [(file, half.save, file) for file, half in to_save], tracer=tracer)
+    else:
+        store.update(to_save)
+    cached = {name: result for name, result in cached.items() if result is not None}
+    return chunkdir, volume_parts, cached, crops, slabs
+
+
+def _collect_chunk(
+    chunkdir,
+    volume_parts,
+    *,
+    callback=None,
+    ext=".nii.gz",
+    cached=None,
+    crops=None,
+    slabs=None,
+    streamed=None,
+    lookup=None,
+    io_pool=None,
+    store=None,
+    tracer=tracing.NO_TRACER,
+):
+    """Load (or take from `store`) and heal (or stitch, and paste back the cropped) segmentations of a chunk, and remove its files.
+
+    The segmentations `streamed` during inference (see `_stream_chunk`) were already passed to the callback.
+    """
+    with tracer.span("collect chunk", chunk=chunkdir.name, cases=len(volume_parts)):
+        return _collect_chunk_files(
+            chunkdir,
+            volume_parts,
+            callback=callback,
+            ext=ext,
+            cached=cached,
+            crops=crops or {},
+            slabs=slabs or {},
+            streamed=streamed or {},
+            lookup=lookup,
+            io_pool=io_pool,
+            store=store,
+            tracer=tracer,
+        )
+
+
+def _collect_chunk_files(chunkdir, volume_parts, *, callback, ext, cached, crops, slabs, streamed, lookup, io_pool, store, tracer):
+    segmented = {}
+
+    def add(name, vol):
+        if callback is None:
+            segmented[name] = vol
+        else:
+            callback(name, vol)
+
+    labels = None
+    for name, (vol, cached_labels) in (cached or {}).items():
+        add(name, vol)
+        labels = cached_labels
+
+    outdir = chunkdir / "out"
+    if volume_parts:
+        labels = Labels.load(outdir / "labels.txt") if store is None else store.pop(outdir / "labels.txt")
+    files = [outdir / f"{name}_{part}{ext}" for name, parts in volume_parts.items() if name not in streamed for part in parts]
+    if store is None:
+        loaded = dict(zip(files, _map_files(io_pool, "load", [(file, Volume.load, file) for file in files], tracer=tracer)))
+    else:
+        loaded = {file: store.pop(file) for file in files}
+    for name, parts in volume_parts.items():
+        if name in streamed:
+            vol = streamed[name]
+        else:
+            outputs = {part: loaded.pop(outdir / f"{name}_{part}{ext}") for part in parts}
+            with tracer.span("heal", case=name):
+                vol = _heal_parts(outputs, crops.get(name), slabs.get(name))
+            add(name, vol)
+        if lookup is not None:
+            with tracer.span("cache store", case=name):
+                duplicates = lookup.store(name, vol, labels)
+            for duplicate in duplicates:
+                add(duplicate, Volume(vol.array, **vol.metadata))
+    shutil.rmtree(chunkdir)
+    return segmented, labels
+
+
+def _stream_chunk(chunkdir, volume_parts, done, *, callback, ext=".nii.gz", crops=None, slabs=None, keep=False, tracer=tracing.NO_TRACER):
+    """Pass the segmentations of a chunk to `callback` as soon as their outputs are written, until `done` is set.
+
+    An output is read once its size and modification time did not change between two polls, and it loads. Return the
+    streamed segmentations by name (None unless `keep`).
+    """
+    crops = crops or {}
+    slabs = slabs or {}
+    pending = dict(volume_parts)
+    stats = {}
+    streamed = {}
+    while pending and not done.wait(STREAM_INTERVAL):
+        # the outputs of the sharded cases are moved into the output directory of the chunk once all are written
+        found = {}
+        for outdir in [chunkdir / "out", *chunkdir.glob("shard*/out")]:
+            with contextlib.suppress(FileNotFoundError):
+                found.update((entry.name, entry.path) for entry in os.scandir(outdir))
+        for name, parts in list(pending.items()):
+            files = {part: found.get(f"{name}_{part}{ext}") for part in parts}
+            if None in files.values():
+                continue
+            try:
+                stat = [(info.st_size, info.st_mtime_ns) for info in map(os.stat, files.values())]
+                if stats.get(name) != stat:
+                    stats[name] = stat
+                    continue
+                outputs = {part: Volume.load(file) for part, file in files.items()}
+            except (OSError, RuntimeError):
+                # moved, or still being written
+                continue
+            with tracer.span("heal", case=name):
+                vol = _heal_parts(outputs, crops.get(name), slabs.get(name))
+            callback(name, vol)
+            streamed[name] = vol if keep else None
+            del pending[name]
+    return streamed
+
+
+def _working_directory(workdir=None, tempdir=None):
+    """Return the context of the working directory: the persistent `workdir`, or a temporary directory in `tempdir`."""
+    if workdir is None:
+        return tempfile.TemporaryDirectory(dir=tempdir)
+    pathlib.Path(workdir).mkdir(parents=True, exist_ok=True)
+    return contextlib.nullcontext(workdir)
+
+
+def _check_workdir(workdir, root):
+    """Check that the working directory is shared with the inference server (in its `root` directory)."""
+    if workdir is not None and not pathlib.Path(workdir).resolve().is_relative_to(pathlib.Path(root).resolve()):
+        raise ValueError(f"The working directory must be in the directory shared with the inference server: {root}")
+
+
+def _resume(workdir, run, ext=".nii.gz", *, io_pool=None):
+    """Start or resume the run described by `run` in `workdir`, and return the outputs left by an interrupted run (by file name), with the fingerprints of their cases.
+
+    The readable outputs of the chunks of the interrupted run are moved into `workdir/resumed`, and its chunks are removed.
+    The fingerprints of the cases of the chunks (see `_fingerprint`) are recorded in `workdir/run.json`.
+    """
+    file = workdir / "run.json"
+    run = json.loads(json.dumps(run))
+    cases = {}
+    if file.is_file():
+        previous = json.loads(file.read_text(encoding="utf-8"))
+        cases = previous.pop("cases", {})
+        if previous != run:
+            raise ValueError(f"Working directory of another run: {workdir} ({previous})")
+
+    resumed = workdir / "resumed"
+    resumed.mkdir(exist_ok=True)
+    for chunkdir in sorted(workdir.glob("chunk*")):
+        if (chunkdir / "cases.json").is_file():
+            cases.update(json.loads((chunkdir / "cases.json").read_text(encoding="utf-8")))
+        for outdir in [chunkdir / "out", *chunkdir.glob("shard*/out")]:
+            for output in outdir.iterdir():
+                if not output.name.startswith("."):
+                    output.replace(resumed / output.name)
+        shutil.rmtree(chunkdir)
+    # atomically, as the chunks are removed
+    tmp = file.with_name(f".{file.name}")
+    tmp.write_text(json.dumps({**run, "cases": cases}), encoding="utf-8")
+    os.replace(tmp, file)
+    outputs = [output for output in resumed.glob(f"*{ext}") if not output.name.startswith(".")]
+    readable = _map_files(io_pool, "check", [(output, _readable, output) for output in outputs])
+    for output in itertools.compress(outputs, [not ok for ok in readable]):
+        output.unlink()
+    outputs = {output.name: output for output in itertools.compress(outputs, readable)}
+    if (resumed / "labels.txt").is_file():
+        outputs["labels.txt"] = resumed / "labels.txt"
+    if outputs:
+        print(f"Resuming: {len(outputs)} output(s) of an interrupted run in {workdir}")
+    return outputs, cases
+
+
+def _fingerprint(vols):
+    """Return the fingerprint of the volumes of a case: their geometry, and a hash of a regular sample of their voxels."""
+    digest = hashlib.sha256()
+    for vol in vols:
+        array = np.asarray(vol.array)
+        step = max(1, round((array.size / FINGERPRINT_VOXELS) ** (1 / array.ndim)))
+        digest.update(array.dtype.str.encode())
+        # in (x-fastest) SimpleITK order, as `cache.Cache.key`
+        digest.update(np.ascontiguousarray(array[(slice(None, None, step),) * array.ndim].T).data)
+    return {
+        "shape": [int(size) for size in vols[0].shape],
+        "spacing": [float(value) for value in vols[0].spacing],
+        "origin": [float(value) for value in vols[0].origin],
+        "hash": digest.hexdigest(),
+    }
+
+
+def _readable(file):
+    """Whether the volume file loads (e.g., it was not truncated by an interrupted run)."""
+    try:
+        Volume.load(file)
+    except (OSError, RuntimeError):
+        return False
+    return True
+
+
+def _all_resumed(chunkdir, store=None):
+    """Whether all cases of a chunk were resumed from an interrupted run, with their labels."""
+    return store is None and (chunkdir / "out" / "labels.txt").is_file() and not any((chunkdir / "in").iterdir())
+
+
+def _finish(workdir):
+    """Empty the working directory of a finished run."""
+    (workdir / "run.json").unlink()
+    shutil.rmtree(workdir / "resumed")
+
+
+def _io_pool(workers=None, executor="thread"):
+    """Return a pool of `workers` threads or processes for reading and writing files, or a null context if sequential."""
+    if not workers:
+        return contextlib.nullcontext()
+    if executor == "thread":
+        return concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+    if executor == "process":
+        # not forking, as the pool is started from a multi-threaded process
+        return concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+    raise ValueError(f"Invalid executor: {executor}")
+
+
+def _map_files(pool, action, tasks, *, tracer=tracing.NO_TRACER):
+    """Run `func(*args)` for each `(file, func, *args)` task with the pool (if any), and return the results in order.
+
+    All tasks are run even if some fail, and the failures are reported per file.
+    If a tracer is given, it records a span per file, with the size of the file.
+    """
+    if tracer.enabled:
+        timed = _map_files(pool, action, [(file, tracing.timed, func, *args) for file, func, *args in tasks])
+        for (file, *_), (_, start, end, pid, tid) in zip(tasks, timed):
+            tracer.add(f"{action} file", start, end, pid=pid, tid=tid, file=str(file), bytes=os.path.getsize(file) if os.path.isfile(file) else None)
+        return [result for result, *_ in timed]
+
+    if pool is None:
+        futures = []
+        for file, func, *args in tasks:
+            future = concurrent.futures.Future()
+            try:
+                future.set_result(func(*args))
+            except Exception as exc:  # pylint: disable=broad-exception-caught
+                future.set_exception(exc)
+            futures.append((file, future))
+    else:
+        futures = [(file, pool.submit(func, *args)) for file, func, *args in tasks]
+
+    results, errors = [], []
+    for file, future in futures:
+        try:
+            results.append(future.result())
+        except Exception as exc:  # pylint: disable=broad-exception-caught
+            errors.append(f"{file}: {exc}")
+    if errors:
+        raise RuntimeError(f"Failed to {action} {len(errors)} file(s):\n" + "\n".join(errors))
+    return results
+
+
+class _CacheLookup:  # pylint: disable=too-many-instance-attributes
+    """Lookup of cached and duplicate cases, shared by the chunk workers of `segment_volumes`."""
+
+    def __init__(self, cache, model, side, options=None):
+        self.cache = cache
+        self.model = model
+        self.side = side
+        self.options = options
+        self.lock = threading.Lock()
+        self.keys = {}  # name -> key of the cases being segmented
+        self.pending = {}  # key -> name of the case being segmented
+        self.duplicates = {}  # name -> names of identical cases
+
+    def lookup(self, name, vols):
+        """Return whether the case needs to be segmented, and its cached segmentation and labels (if any)."""
+        key = self.cache.key(vols, self.model, self.side, self.options)
+        with self.lock:
+            if key in self.pending:
+                self.duplicates.setdefault(self.pending[key], []).append(name)
+                with self.cache._lock:  # pylint: disable=protected-access
+                    self.cache.hits += 1
+                return False, None
+            cached = self.cache.get(key)
+            if cached is None:
+                self.keys[name] = key
+                self.pending[key] = name
+            return cached is None, cached
+
+    def store(self, name, vol, labels):
+        """Add a segmentation to the cache, and return the names of the identical cases."""
+        key = self.keys.pop(name)
+        self.cache.put(key, vol, labels)
+        with self.lock:
+            del self.pending[key]
+            return self.duplicates.pop(name, [])
+
+
+def _split_volume(volume, side, axis=0, boxes=None):
+    """Split volumes according to side, or crop them to the bounding boxes of `_crop_boxes`."""
+    if boxes is not None:
+        return tuple(_crop_volume(volume, boxes[part]) if part in boxes else None for part in ["left", "right"])
     side = side.lower()
     size = volume.shape[axis]
     if "left" in side and "right" in side:
-        # split into left and right parts
-        indices = np.arange(size // 2)
-        left = Volume(np.take(volume, axis=axis, indices=indices + size // 2), **volume.metadata)
-        right = Volume(np.take(volume, axis=axis, indices=indices), **volume.metadata)
+        # split into left and right parts (views, no copy)
+        index = (slice(None),) * axis
+        left = Volume(volume.array[index + (slice(size // 2, None),)], **volume.metadata)
+        right = Volume(volume.array[index + (slice(None, size // 2),)], **volume.metadata)
     elif "left" in side:
         # do nothing
         left = volume
@@ -202,9 +1162,94 @@ def _split_volume(volume, side, axis=0):
     return left, right
 
 
-def _heal_volume(left, right, *, axis=0):
+def _crop_boxes(volumes, side, *, axis=0, margin=CROP_MARGIN):
+    """Return the bounding box (slices) of each limb in the volumes of a case, with a margin of `margin` mm.
+
+    The foreground of all volumes is thresholded, and the left and right limbs are separated at the least-filled
+    position in the central half of `axis`, i.e., the gap between the legs. A limb without foreground is not cropped.
+    """
+    side = side.lower()
+    shape = volumes[0].shape
+    foreground = np.zeros(shape, dtype=bool)
+    for vol in volumes:
+        # threshold relative to a robust maximum, estimated on a subsample
+        threshold = 0.1 * np.percentile(vol.array[(slice(None, None, 4),) * vol.ndim], 99)
+        foreground |= vol.array > threshold
+
+    size = shape[axis]
+    if "left" in side and "right" in side:
+        filled = np.count_nonzero(foreground, axis=tuple(dim for dim in range(len(shape)) if dim != axis))
+        central = filled[size // 4 : size - size // 4]
+        gap = np.flatnonzero(central == central.min())
+        split = size // 4 + int(gap[len(gap) // 2])
+        ranges = {"left": (split, size), "right": (0, split)}
+    elif "left" in side:
+        ranges = {"left": (0, size)}
+    elif "right" in side:
+        ranges = {"right": (0, size)}
+    else:
+        raise ValueError(f"Invalid side: {side}")
+
+    pad = np.ceil(margin / np.asarray(volumes[0].spacing)).astype(int)
+    boxes = {}
+    for part, (start, stop) in ranges.items():
+        mask = foreground[(slice(None),) * axis + (slice(start, stop),)]
+        bounds = [(0, length) for length in shape]
+        bounds[axis] = (start, stop)
+        box = []
+        for dim, (lower, upper) in enumerate(bounds):
+            indices = np.flatnonzero(np.any(mask, axis=tuple(other for other in range(mask.ndim) if other != dim)))
+            if not indices.size:
+                box = [slice(*limits) for limits in bounds]
+                break
+            first, last = indices[[0, -1]] + lower
+            box.append(slice(max(first - pad[dim], lower), min(last + 1 + pad[dim], upper)))
+        boxes[part] = tuple(box)
+    return boxes
+
+
+def _crop_volume(volume, box):
+    """Return the view of the volume in the bounding box (slices), with the origin of the box."""
+    start = np.array([index.start for index in box])
+    direction = np.reshape(volume.transform, (volume.ndim, volume.ndim))
+    origin = np.asarray(volume.origin) + direction @ (start * np.asarray(volume.spacing))
+    return Volume(volume.array[box], **{**volume.metadata, "origin": tuple(origin.tolist())})
+
+
+def _uncrop_volume(parts, boxes, shape):
+    """Paste the cropped volumes into a single full-size volume (zero outside the boxes), with the original origin."""
+    part = next(iter(parts.values()))
+    array = np.zeros(shape, dtype=np.result_type(*(vol.array for vol in parts.values())), order="F")
+    for name, vol in parts.items():
+        array[boxes[name]] = vol.array
+    start = np.array([index.start for index in boxes[next(iter(parts))]])
+    direction = np.reshape(part.transform, (part.ndim, part.ndim))
+    origin = np.asarray(part.origin) - direction @ (start * np.asarray(part.spacing))
+    return Volume(array, **{**part.metadata, "origin": tuple(origin.tolist())})
+
+
+def _heal_volume(left, right, *, axis=0, boxes=None, shape=None, slabs=None):
+    """Merge the segmentations of the left and right parts, pasted into a volume of the given shape if cropped with `boxes`.
+
+    A part tiled into slabs is given as the list of the segmentations of its slabs, with their ranges along the slice
+    axis in `slabs` (by part, see `_slab_ranges`), and stitched first.
+    """
+    if slabs:
+        left, right = (_stitch_slabs(half, slabs[part]) if part in slabs else half for part, half in [("left", left), ("right", right)])
+    if boxes is not None:
+        parts = {name: vol for name, vol in [("left", left), ("right", right)] if vol is not None}
+        if not parts:
+            raise ValueError("Something went wrong")
+        return _uncrop_volume(parts, boxes, shape)
     if left is not None and right is not None:
-        return Volume(np.concatenate([right, left], axis=axis), **left.metadata)
+        # copy both parts into a single output, in the (x-fastest) memory layout of SimpleITK images
+        shape = list(right.shape)
+        shape[axis] += left.shape[axis]
+        array = np.empty(shape, dtype=np.result_type(right.array, left.array), order="F")
+        index = (slice(None),) * axis
+        array[index + (slice(None, right.shape[axis]),)] = right.array
+        array[index + (slice(right.shape[axis], None),)] = left.array
+        return Volume(array, **left.metadata)
     if left is not None:
         return left
     if right is not None:
@@ -212,6 +1257,129 @@ def _heal_volume(left, right, *, axis=0):
     raise ValueError("Something went wrong")
 
 
+def _heal_parts(outputs, crop=None, slabs=None):
+    """Heal the segmentation of a case from those of its parts (by part name), cropped to `crop` and tiled into `slabs`."""
+    halves = {}
+    for part in ["left", "right"]:
+        if slabs and part in slabs:
+            halves[part] = [outputs[_slab_part(part, index)] for index in range(len(slabs[part]))]
+        else:
+            halves[part] = outputs.get(part)
+    boxes, shape = crop or (None, None)
+    return _heal_volume(halves["left"], halves["right"], boxes=boxes, shape=shape, slabs=slabs)
+
+
+def _check_slabs(slab_size=None, slab_overlap=SLAB_OVERLAP):
+    """Check the size and overlap of the slabs, and return the tiling recorded with the cached and resumed segmentations."""
+    if slab_size is None:
+        return {}
+    if not 0 <= slab_overlap < slab_size:
+        raise ValueError(f"The overlap of the slabs must be smaller than their size: {slab_overlap} >= {slab_size}")
+    return {"slabs": [slab_size, slab_overlap]}
+
+
+def _slab_ranges(size, slab_size, overlap=SLAB_OVERLAP):
+    """Return the ranges `(start, stop)` of the slabs of `slab_size` slices tiling `size` slices, overlapping by at least `overlap`."""
+    if size <= slab_size:
+        return [(0, size)]
+    stride = slab_size - overlap
+    count = -(-(size - overlap) // stride)
+    # the last slab ends with the volume
+    return [(start, start + slab_size) for start in (min(index * stride, size - slab_size) for index in range(count))]
+
+
+def _slab_part(part, index):
+    """Return the name of a slab of a part."""
+    return f"{part}_z{index}"
+
+
+def _tile_parts(parts, ranges):
+    """Return the parts, those with `ranges` tiled into slabs (views) along the slice axis, by part name."""
+    tiled = {}
+    for part, half in parts.items():
+        if part not in ranges:
+            tiled[part] = half
+            continue
+        for index, (start, stop) in enumerate(ranges[part]):
+            box = tuple(slice(0, length) for length in half.shape[:-1]) + (slice(start, stop),)
+            tiled[_slab_part(part, index)] = _crop_volume(half, box)
+    return tiled
+
+
+def _stitch_slabs(slabs, ranges):
+    """Stitch the segmentations of the slabs with the given ranges along the slice axis, splitting the overlaps halfway."""
+    size = ranges[-1][1]
+    array = np.empty(slabs[0].shape[:-1] + (size,), dtype=np.result_type(*(vol.array for vol in slabs)), order="F")
+    cuts = [0] + [(start + previous_stop) // 2 for (start, _), (_, previous_stop) in zip(ranges[1:], ranges[:-1])] + [size]
+    for vol, (start, _), lower, upper in zip(slabs, ranges, cuts[:-1], cuts[1:]):
+        array[..., lower:upper] = vol.array[..., lower - start : upper - start]
+    # the first slab has the origin of the part
+    return Volume(array, **slabs[0].metadata)
+
+
+def _check_preview(preview=False):
+    """Return the downsampling factor of a preview (0 if none)."""
+    if preview is True:
+        return PREVIEW_FACTOR
+    if not preview:
+        return 0
+    if not isinstance(preview, int) or preview < 2:
+        raise ValueError(f"Expecting True or a downsampling factor of at least 2 for the preview, not: {preview!r}")
+    return preview
+
+
+def _preview_volumes(volumes, factor):
+    """Return the volumes downsampled in-plane by `factor` (headers loaded on demand), and the function upsampling their segmentations."""
+    geometry = {name: (vols[0].shape, vols[0].origin, vols[0].spacing) for name, vols in volumes.items()}
+    downsampled = {name: [_PreviewHeader(vol, factor) if isinstance(vol, VolumeHeader) else _downsample(vol, factor) for vol in vols] for name, vols in volumes.items()}
+
+    def upsample(name, vol):
+        shape, origin, spacing = geometry[name]
+        # nearest neighbour: each voxel takes the label of its block
+        index = np.ix_(np.arange(shape[0]) // factor, np.arange(shape[1]) // factor, np.arange(shape[2]))
+        array = np.empty(shape, dtype=vol.array.dtype, order="F")
+        array[...] = vol.array[index]
+        return Volume(array, **{**vol.metadata, "origin": origin, "spacing": spacing})
+
+    return downsampled, upsample
+
+
+def _upsampling_callback(callback, upsample):
+    """Return a callback passing the upsampled segmentations to `callback`."""
+    return lambda name, vol: callback(name, upsample(name, vol))
+
+
+def _preview_geometry(shape, origin, spacing, transform, factor):
+    """Return the shape, origin and spacing of a volume downsampled in-plane by `factor` (the origin is the center of the first block)."""
+    shape = (-(-shape[0] // factor), -(-shape[1] // factor), *shape[2:])
+    offset = np.reshape(transform, (3, 3)) @ [(factor - 1) / 2 * spacing[0], (factor - 1) / 2 * spacing[1], 0.0]
+    return shape, tuple((np.asarray(origin) + offset).tolist()), (spacing[0] * factor, spacing[1] * factor, *spacing[2:])
+
+
+def _downsample(volume, factor):
+    """Return the volume downsampled in-plane by averaging blocks of `factor` x `factor` voxels (the edges are repeated to fill the last blocks)."""
+    shape, origin, spacing = _preview_geometry(volume.shape, volume.origin, volume.spacing, volume.transform, factor)
+    padding = [(0, size * factor - length) for size, length in zip(shape[:2], volume.shape[:2])] + [(0, 0)] * (volume.ndim - 2)
+    array = np.pad(volume.array, padding, mode="edge") if any(after for _, after in padding) else volume.array
+    # in Fortran order, the voxels of a block along an axis are consecutive: (x, ...) to (x % factor, x // factor, ...)
+    blocks = array.reshape(factor, shape[0], factor, shape[1], *shape[2:], order="F")
+    array = np.asfortranarray(blocks.mean(axis=(0, 2), dtype=np.float32))
+    return Volume(array, **{**volume.metadata, "origin": origin, "spacing": spacing})
+
+
+class _PreviewHeader(VolumeHeader):
+    """Header of a volume file, loaded downsampled in-plane by `factor`."""
+
+    def __init__(self, header, factor):
+        shape, origin, spacing = _preview_geometry(header.shape, header.origin, header.spacing, header.transform, factor)
+        super().__init__(header.file, shape=shape, dtype=np.float32, origin=origin, spacing=spacing, transform=header.transform, **header.info)
+        self.header = header
+        self.factor = factor
+
+    def load(self, *, mmap=True):
+        return _downsample(self.header.load(mmap=mmap), self.factor)
+
+
 def _check_volumes(volumes, *, nvolumes=2):
     """Safety checks."""
     if not len(volumes) == nvolumes:
@@ -220,6 +1388,15 @@ def _check_volumes(volumes, *, nvolumes=2):
         raise ValueError("All volumes must have the same shape")
 
 
+def _format_results(input_type, volumes, segmented):
+    """Return the segmentations in the same format and order as the input volumes."""
+    if input_type == "dict":
+        return {name: segmented[name] for name in volumes}
+    if input_type == "single":
+        return next(iter(segmented.values()))
+    return [segmented[name] for name in volumes]
+
+
 def _setup_volumes(volumes):
     if isinstance(volumes, dict) and all(isinstance(values, (tuple, list)) for values in volumes.values()):
         input_type = "dict"
@@ -233,7 +1410,7 @@ def _setup_volumes(volumes):
         volumes = {str(uuid.uuid1()): vol for vol in volumes}
     else:
         raise ValueError("`volumes` should be a (dict of) list of ndarrays")
-    volumes = {name: [Volume(vol) for vol in vols] for name, vols in volumes.items()}
+    volumes = {name: [vol if isinstance(vol, VolumeHeader) else Volume(vol) for vol in vols] for name, vols in volumes.items()}
     return input_type, volumes
 
 
@@ -242,33 +1419,332 @@ def _setup_volumes(volumes):
 
 def _get_image(model):
     """Get docker image name."""
-    return f"fabianbalsiger/museg:{model}"
+    return models.get_model(model)["image"]
 
 
-def _run_model(model, indir, outdir):
-    """Run inference."""
-    if model == "test":
-        print("Running dummy inference model (no docker)")
-        # dummy segmentation model
-        with open(outdir / "labels.txt", "w", encoding="utf-8") as fp:
-            fp.write("labels")
-        for file in indir.glob("*0000.nii.gz"):
-            name = str(file.name).split("0000.nii.gz", maxsplit=1)[0]
-            vol = Volume.load(file)
-            roi = (vol.array > np.percentile(np.unique(vol), 10)).astype("uint16")
-            roi = Volume(roi, **vol.metadata)
-            roi.save(outdir / name, ".nii.gz")
+def _check_model(model, exchange, backend=None):
+    """Check the model, the exchange format and the backend, and return the name of the backend."""
+    if model not in list_models() + ["test"]:
+        raise ValueError(f"Unknown model: {model}")
+    backend = _backend_name(model, backend)
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend: {backend}")
+    if model == "test" and backend != "test":
+        raise ValueError("The dummy model `test` runs only on the `test` backend")
+    if exchange == MEMORY_EXCHANGE:
+        if not BACKENDS[backend].in_memory:
+            raise ValueError(f"The {backend} backend does not exchange volumes in memory")
+    elif exchange not in EXCHANGE_FORMATS:
+        raise ValueError(f"Unknown exchange format: {exchange}")
+    return backend
+
+
+def _backend_name(model, backend=None):
+    """Return the name of the backend running the model (default: "docker", or "test" for the dummy model)."""
+    if backend is not None:
+        return backend
+    return "test" if model == "test" else "docker"
+
+
+def _exchange(exchange, server=None, workers=1):
+    """Return the store of in-memory volumes (None if exchanged as files), and the extension of the exchanged files."""
+    if exchange != MEMORY_EXCHANGE:
+        return None, exchange
+    if server is not None or workers > 1:
+        raise ValueError("Volumes are exchanged in memory with a single in-process worker, without inference server")
+    return {}, ""
+
+
+def _connect(model, server=None, options=None, backend="docker"):
+    """Return the running inference server to use (if any), or make sure that the model's image is available."""
+    server = _find_server(model, server)
+    if server is None:
+        if backend == "docker":
+            _pull_if_not_exists(model)
+        return None
+    fixed = set(options or {}) - set(REQUEST_OPTIONS)
+    if fixed:
+        raise ValueError(f"Inference option(s) fixed when the server starts: {', '.join(sorted(fixed))}")
+    return server
+
+
+def _run_workers(model, indir, outdir, *, workers=1, devices=None, **kwargs):
+    """Run inference with concurrent workers, each on a shard of the cases of `indir`."""
+    devices = devices or [None]
+    if workers <= 1:
+        _run_model(model, indir, outdir, device=devices[0], **kwargs)
+        return
+
+    # run and wait for all workers
+    shard_dirs = _shard_cases(indir, workers, kwargs.get("exchange", ".nii.gz"))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(shard_dirs)) as executor:
+        running = [
+            executor.submit(_run_model, model, shard_dir / "in", shard_dir / "out", device=devices[index % len(devices)], **kwargs)
+            for index, shard_dir in enumerate(shard_dirs)
+        ]
+    _map_files(None, "segment", [(shard_dir / "in", future.result) for shard_dir, future in zip(shard_dirs, running)])
+    _gather_shards(shard_dirs, outdir)
+
+
+async def _run_workers_async(model, indir, outdir, *, workers=1, devices=None, **kwargs):
+    """Run inference like `_run_workers`, without blocking the event loop."""
+    devices = devices or [None]
+    if workers <= 1:
+        await _run_model_async(model, indir, outdir, device=devices[0], **kwargs)
         return
 
+    executor = kwargs["executor"]
+    shard_dirs = await asyncio.wrap_future(executor.submit(_shard_cases, indir, workers, kwargs.get("exchange", ".nii.gz")))
+    running = [
+        asyncio.ensure_future(_run_model_async(model, shard_dir / "in", shard_dir / "out", device=devices[index % len(devices)], **kwargs))
+        for index, shard_dir in enumerate(shard_dirs)
+    ]
+    # all workers finish (or are cancelled together)
+    await asyncio.gather(*running, return_exceptions=True)
+    _map_files(None, "segment", [(shard_dir / "in", task.result) for shard_dir, task in zip(shard_dirs, running)])
+    await asyncio.wrap_future(executor.submit(_gather_shards, shard_dirs, outdir))
+
+
+async def _gather_or_cancel(coroutines):
+    """Run coroutines concurrently, and cancel all of them if one fails or if cancelled."""
+    tasks = [asyncio.ensure_future(coroutine) for coroutine in coroutines]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+def _shard_cases(indir, nshards, exchange=".nii.gz"):
+    """Move the cases of `indir` into the input directories of at most `nshards` balanced shards, and return the shard directories."""
+    # balance the shards by number of voxels
+    cases = {file.name[: -len(f"_0000{exchange}")]: file for file in indir.glob(f"*_0000{exchange}")}
+    sizes = {case: int(np.prod(Volume.load_header(file).shape)) for case, file in cases.items()}
+    shards = [shard for shard in _balance(sizes, nshards) if shard]
+
+    # move the cases into the input directory of their shard
+    shard_dirs = [indir.parent / f"shard{index:02d}" for index in range(len(shards))]
+    for shard, shard_dir in zip(shards, shard_dirs):
+        (shard_dir / "in").mkdir(parents=True)
+        (shard_dir / "out").mkdir()
+        for case in shard:
+            for file in indir.glob(f"{case}_[0-9][0-9][0-9][0-9]{exchange}"):
+                file.rename(shard_dir / "in" / file.name)
+    return shard_dirs
+
+
+def _gather_shards(shard_dirs, outdir):
+    """Move the outputs of the shards into `outdir`, and remove the shard directories."""
+    for shard_dir in shard_dirs:
+        for file in (shard_dir / "out").iterdir():
+            file.replace(outdir / file.name)
+        shutil.rmtree(shard_dir)
+
+
+def _balance(sizes, nshards):
+    """Assign cases to shards, the largest cases first to the least loaded shard."""
+    shards = [[] for _ in range(nshards)]
+    loads = [(0, index) for index in range(nshards)]
+    for case in sorted(sizes, key=lambda case: sizes[case], reverse=True):
+        load, index = heapq.heappop(loads)
+        shards[index].append(case)
+        heapq.heappush(loads, (load + sizes[case], index))
+    return shards
+
+
+def _inference_options(preset=None, options=None):
+    """Return the inference options of a preset, updated with `options`."""
+    if preset is not None and preset not in PRESETS:
+        raise ValueError(f"Unknown preset: {preset}")
+    options = {**PRESETS.get(preset, {}), **(options or {})}
+    unknown = set(options) - set(INFERENCE_OPTIONS)
+    if unknown:
+        raise ValueError(f"Unknown inference option(s): {', '.join(sorted(unknown))}")
+    return options
+
+
+def _model_arguments(options):
+    """Convert inference options to command line arguments of the inference model."""
+    arguments = []
+    for option, value in options.items():
+        if isinstance(value, bool):
+            arguments += [f"--{option}"] if value else []
+        elif isinstance(value, (list, tuple)):
+            arguments += [f"--{option}", *map(str, value)]
+        else:
+            arguments += [f"--{option}", str(value)]
+    return arguments
+
+
+def _run_model(model, indir, outdir, *, server=None, exchange=".nii.gz", device=None, options=None, backend=None, store=None, tracer=tracing.NO_TRACER):
+    """Run inference (on GPU `device`, default: all, or on "cpu") with the given inference options and backend."""
+    options = options or {}
+    if server is not None:
+        _request_server(server, indir, outdir, exchange, options)
+        return
+    backend = BACKENDS[_backend_name(model, backend)]
+    kwargs = {"store": store} if exchange == MEMORY_EXCHANGE else {}
+    backend.run(model, indir, outdir, exchange=exchange, device=device, options=options, tracer=tracer, **kwargs)
+
+
+#
+# inference backends
+
+Backend = collections.namedtuple("Backend", ["run", "in_memory"])
+
+
+def register_backend(name, run, *, in_memory=False):
+    """Register the inference backend `name`.
+
+    `run(model, indir, outdir, *, exchange, device, options, tracer)` segments the cases of `indir` into `outdir`, in the
+    file layout of nnU-Net: `{case}_{modality:04d}{exchange}` inputs, `{case}{exchange}` outputs, and `labels.txt`.
+    The function of an `in_memory` backend also takes the argument `store` with `exchange=MEMORY_EXCHANGE`: the dict of the
+    input volumes by file path (without extension), to which it adds the output volumes and the `Labels`.
+    """
+    BACKENDS[name] = Backend(run, in_memory)
+
+
+def _run_dummy(_model, indir, outdir, *, exchange=".nii.gz", device=None, options=None, tracer=tracing.NO_TRACER, store=None):  # pylint: disable=unused-argument
+    """Segment with a dummy model, thresholding the first volume of each case."""
+    print("Running dummy inference model (no docker)")
+    for name, files in _exchanged_cases(indir, exchange, store).items():
+        vols = _receive_volumes(files, store)
+        roi = (vols[0].array > np.percentile(np.unique(vols[0]), 10)).astype("uint16")
+        _send_volume(Volume(roi, **vols[0].metadata), outdir / f"{name}{exchange if store is None else ''}", store)
+    _send_volume(Labels("labels"), outdir / "labels.txt", store)
+
+
+def _run_torch(model, indir, outdir, *, exchange=".nii.gz", device=None, options=None, tracer=tracing.NO_TRACER, store=None):
+    """Run nnU-Net in this process, with the models loaded once per process and device (see `musegai.nnunet`).
+
+    The options `num_threads_preprocessing` and `num_threads_nifti_save` have no effect, the cases are preprocessed and
+    exported in the calling thread.
+    """
+    from musegai import nnunet  # pylint: disable=import-outside-toplevel  # requires torch and nnU-Net
+
+    options = options or {}
+    folder = nnunet.model_folder(model)
+    with tracer.span("load model", model=model, device=device):
+        predictor = nnunet.get_predictor(folder, device, mixed_precision=not options.get("disable_mixed_precision", False))
+    for name, files in _exchanged_cases(indir, exchange, store).items():
+        vols = _receive_volumes(files, store)
+        with tracer.span("predict", case=name):
+            array = predictor.predict(vols, folds=options.get("folds"), disable_tta=options.get("disable_tta"), step_size=options.get("step_size"))
+        _send_volume(Volume(array, **vols[0].metadata), outdir / f"{name}{exchange if store is None else ''}", store)
+    _send_volume(Labels.load(folder / "labels.txt"), outdir / "labels.txt", store)
+
+
+def _exchanged_cases(indir, exchange=".nii.gz", store=None):
+    """Return the input files of each case of `indir` (keys of `store` if exchanged in memory), in order of modality."""
+    ext = exchange if store is None else ""
+    files = sorted(indir.glob(f"*_[0-9][0-9][0-9][0-9]{ext}")) if store is None else sorted(file for file in list(store) if file.parent == indir)
+    cases = {}
+    for file in files:
+        cases.setdefault(file.name[: -len(f"_0000{ext}")], []).append(file)
+    return cases
+
+
+def _receive_volumes(files, store=None):
+    """Load the exchanged volumes (or take them from `store`)."""
+    return [Volume.load(file) for file in files] if store is None else [store.pop(file) for file in files]
+
+
+def _send_volume(obj, file, store=None):
+    """Save the volume or labels (or add them to `store`).
+
+    The file is renamed into place once saved, such that the outputs can be read as soon as they appear.
+    """
+    if store is None:
+        partial = file.with_name(f".partial.{file.name}")
+        obj.save(partial)
+        partial.replace(file)
+    else:
+        store[file] = obj
+
+
+def _run_docker(model, indir, outdir, *, exchange=".nii.gz", device=None, options=None, tracer=tracing.NO_TRACER):
+    """Inference in a Docker container of the model's image."""
     client = docker.from_env()
     image = _get_image(model)
     print(f"Running inference model '{model}' (`{image}`)")
-    client.containers.run(
-        image,
-        remove=True,
-        device_requests=[docker.types.DeviceRequest(device_ids=["all"], capabilities=[["gpu"]])],
-        volumes={indir.parent: {"bind": "/data", "mode": "rw"}},
-    )
+    arguments = _container_arguments(indir, outdir, exchange=exchange, device=device, options=options)
+    with tracer.span("start container", image=image, device=device):
+        container = client.containers.run(image, detach=True, **arguments)
+    try:
+        with tracer.span("run container", image=image, device=device) as span:
+            status = container.wait()["StatusCode"]
+            if tracer.enabled and (outdir / "prediction_time.txt").is_file():
+                # time of the prediction, without loading the model
+                span["prediction_time"] = float((outdir / "prediction_time.txt").read_text(encoding="utf-8"))
+        if status:
+            raise docker.errors.ContainerError(container, status, arguments["command"], image, container.logs(stdout=False, stderr=True))
+    finally:
+        _remove_container(container)
+
+
+register_backend("docker", _run_docker)
+register_backend("torch", _run_torch, in_memory=True)
+register_backend("test", _run_dummy, in_memory=True)
+
+
+async def _run_model_async(model, indir, outdir, *, executor, server=None, exchange=".nii.gz", device=None, options=None, backend=None, store=None, poll_interval=1.0):
+    """Run inference like `_run_model`, polling the container without blocking the event loop, and stopping it if cancelled.
+
+    Requests to an inference server and the in-process backends cannot be cancelled, they run in `executor` such that
+    its shutdown waits for them.
+    """
+    if server is not None or _backend_name(model, backend) != "docker":
+        running = executor.submit(_run_model, model, indir, outdir, server=server, exchange=exchange, device=device, options=options, backend=backend, store=store)
+        await asyncio.wrap_future(running)
+        return
+
+    client = docker.from_env()
+    image = _get_image(model)
+    print(f"Running inference model '{model}' (`{image}`)")
+    arguments = _container_arguments(indir, outdir, exchange=exchange, device=device, options=options or {})
+    starting = asyncio.ensure_future(asyncio.to_thread(client.containers.run, image, detach=True, **arguments))
+    try:
+        container = await asyncio.shield(starting)
+    except asyncio.CancelledError:
+        # the container starts anyway, stop it as soon as it is started (unless it failed to start)
+        with contextlib.suppress(Exception):
+            await asyncio.to_thread(_remove_container, await starting)
+        raise
+    try:
+        while True:
+            await asyncio.sleep(poll_interval)
+            await asyncio.to_thread(container.reload)
+            if container.status not in ["created", "running", "restarting"]:
+                break
+        status = (await asyncio.to_thread(container.wait))["StatusCode"]
+        if status:
+            stderr = await asyncio.to_thread(container.logs, stdout=False, stderr=True)
+            raise docker.errors.ContainerError(container, status, arguments["command"], image, stderr)
+    finally:
+        await asyncio.to_thread(_remove_container, container)
+
+
+def _container_arguments(indir, outdir, *, exchange=".nii.gz", device=None, options=None):
+    """Return the arguments of an inference container on `indir`."""
+    command = None
+    if exchange != ".nii.gz" or options:
+        # replaces the default command of the image
+        command = ["-i", f"./data/{indir.name}", "-o", f"./data/{outdir.name}", "--exchange", exchange, *_model_arguments(options)]
+    device_requests = []
+    if device != "cpu":
+        device_requests = [docker.types.DeviceRequest(device_ids=[device or "all"], capabilities=[["gpu"]])]
+    return {"command": command, "device_requests": device_requests, "volumes": {indir.parent: {"bind": "/data", "mode": "rw"}}}
+
+
+def _remove_container(container):
+    """Stop a container if still running, and remove it."""
+    try:
+        container.stop(timeout=10)
+        container.remove()
+    except docker.errors.NotFound:
+        pass
 
 
 def _pull_if_not_exists(model: str):
@@ -279,4 +1755,80 @@ def _pull_if_not_exists(model: str):
     image = _get_image(model)
     if not client.images.list(name=image):
         print(f"Pulling image `{image}`, this may take a while...")
-        client.images.pull(f"fabianbalsiger/museg:{model}")
+        client.images.pull(image)
+
+
+def start_server(model, root, *, port=8765, timeout=600, options=None):
+    """Start a persistent inference server container and return its URL.
+
+    The container loads the model once and predicts folders below `root` on request.
+    Pass the returned URL to `segment_volumes` (or set `MUSEGAI_SERVER`) to reuse it.
+    The inference `options` (see `INFERENCE_OPTIONS`) are the server's defaults, and only the folds loaded at start
+    can be requested later.
+    """
+    url = f"http://localhost:{port}"
+    if _find_server(model, url) is not None:
+        return url
+
+    _pull_if_not_exists(model)
+    root = pathlib.Path(root).resolve()
+    client = docker.from_env()
+    image = _get_image(model)
+    print(f"Starting inference server for model '{model}' (`{image}`) on port {port}")
+    client.containers.run(
+        image,
+        command=["--serve", "--port", str(port), *_model_arguments(_inference_options(options=options))],
+        detach=True,
+        remove=True,
+        device_requests=[docker.types.DeviceRequest(device_ids=["all"], capabilities=[["gpu"]])],
+        volumes={root: {"bind": "/data", "mode": "rw"}},
+        ports={f"{port}/tcp": ("127.0.0.1", port)},
+        environment={"MUSEGAI_MODEL": model, "MUSEGAI_ROOT": str(root)},
+        labels={"musegai.model": model},
+    )
+
+    # wait until the model is loaded
+    start = time.monotonic()
+    while _find_server(model, url) is None:
+        if time.monotonic() - start > timeout:
+            raise RuntimeError(f"Inference server did not start within {timeout} seconds")
+        time.sleep(1)
+    return url
+
+
+def _find_server(model, url=None):
+    """Return the description of a running inference server serving `model`, or None."""
+    url = url or os.environ.get("MUSEGAI_SERVER")
+    if not url:
+        return None
+    url = url.rstrip("/")
+    try:
+        with urllib.request.urlopen(f"{url}/health", timeout=2) as response:
+            info = json.load(response)
+    except (OSError, ValueError):
+        return None
+    if info.get("model") != model:
+        return None
+    return {"url": url, "model": model, "root": info["root"]}
+
+
+def _request_server(server, indir, outdir, exchange=".nii.gz", options=None):
+    """Run inference with a running inference server."""
+    root = pathlib.Path(server["root"]).resolve()
+    request = {
+        "input": str(pathlib.Path(indir).resolve().relative_to(root)),
+        "output": str(pathlib.Path(outdir).resolve().relative_to(root)),
+        "exchange": exchange,
+        "options": options or {},
+    }
+    print(f"Running inference model '{server['model']}' (server: {server['url']})")
+    request = urllib.request.Request(
+        f"{server['url']}/predict",
+        data=json.dumps(request).encode(),
+        headers={"Content-Type": "application/json"},
+    )
+    try:
+        with urllib.request.urlopen(request) as response:
+            json.load(response)
+    except urllib.error.HTTPError as exc:
+        raise RuntimeError(f"Inference server error: {exc.read().decode()}") from exc
@@ -0,0 +1,113 @@
+"""Content-addressed cache of segmentations."""
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import pathlib
+import shutil
+import tempfile
+import threading
+
+from musegai import api
+
+np = api.np  # pylint: disable=invalid-name
+
+
+class SegmentationCache:
+    """On-disk cache of segmentations with least recently used (LRU) eviction.
+
+    Entries are keyed by a hash of the input arrays, their geometry, the model, the side and the inference options, such that
+    re-submitted cases are served without inference. Each entry is a directory holding the healed segmentation and its labels.
+    The least recently used entries are evicted once the cache exceeds `max_size` bytes.
+    The cache can be shared by several processes.
+    """
+
+    def __init__(self, directory, *, max_size=None):
+        """Open (or create) the cache in `directory`."""
+        self.directory = pathlib.Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(volumes, model, side, options=None):
+        """Return the hash of the input volumes, their geometry, the model, the side and the inference options."""
+        digest = hashlib.sha256()
+        digest.update(json.dumps({"model": model, "side": side}).encode())
+        if options:
+            digest.update(json.dumps(options, sort_keys=True).encode())
+        for vol in volumes:
+            array = np.asarray(vol.array)
+            geometry = {
+                "shape": array.shape,
+                "dtype": array.dtype.str,
+                "origin": list(vol.origin),
+                "spacing": list(vol.spacing),
+                "transform": list(vol.transform),
+            }
+            digest.update(json.dumps(geometry).encode())
+            # hash the voxels in (x-fastest) SimpleITK order, which is a copy-free view for loaded volumes
+            digest.update(np.ascontiguousarray(array.T).data)
+        return digest.hexdigest()
+
+    @property
+    def stats(self):
+        """Return the hit and miss counters, the number of entries and their total size in bytes."""
+        entries = self._entries()
+        return {"hits": self.hits, "misses": self.misses, "entries": len(entries), "size": sum(entries.values())}
+
+    def get(self, key):
+        """Return the cached segmentation and labels, or None."""
+        entry = self.directory / key
+        try:
+            volume = api.Volume.load(entry / "segmentation.nii.gz")
+            labels = api.Labels.load(entry / "labels.txt")
+            os.utime(entry)  # mark as recently used
+        except (OSError, RuntimeError):
+            # missing, or evicted meanwhile
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return volume, labels
+
+    def put(self, key, volume, labels):
+        """Store a segmentation and its labels, and evict old entries if needed."""
+        entry = self.directory / key
+        tmp = pathlib.Path(tempfile.mkdtemp(dir=self.directory, prefix=".tmp-"))
+        volume.save(tmp / "segmentation.nii.gz")
+        labels.save(tmp / "labels.txt")
+        try:
+            os.rename(tmp, entry)
+        except OSError:
+            # already stored (e.g., by another process)
+            shutil.rmtree(tmp, ignore_errors=True)
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits into `max_size` bytes."""
+        if self.max_size is None:
+            return
+        entries = self._entries()
+        size = sum(entries.values())
+        for entry in sorted(entries, key=lambda entry: entry.stat().st_mtime if entry.exists() else 0):
+            if size <= self.max_size:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            size -= entries[entry]
+
+    def _entries(self):
+        """Return the size of each entry."""
+        entries = {}
+        for entry in self.directory.iterdir():
+            if entry.name.startswith("."):
+                continue
+            try:
+                entries[entry] = sum(file.stat().st_size for file in entry.iterdir())
+            except OSError:
+                continue
+        return entries
@@ -1,29 +1,140 @@
 """Command line interface for muscle segmentation."""
 from __future__ import annotations
 
+import json
+import os
 import pathlib
 import re
+import socket
 import sys
+import time
 
 import click
 
-from musegai import api
+from musegai import api, labelmap, tracing
+from musegai.cache import SegmentationCache
+from musegai.jobs import JobQueue
+from musegai.watch import Watcher, micro_batches
 
 
-@click.command(context_settings={"show_default": True})
-@click.argument("volumes", type=click.Path(exists=True), nargs=-1)
-@click.option("-d", "--dest", type=click.Path(), help="Output directory.")
-@click.option("--model", default="thigh-model3", help="Specify the segmentation model.")
-@click.option("--side", default="left+right", type=click.Choice(api.SIDES), help="Specify the limb's side(s).")
-@click.option("--tempdir", type=click.Path(exists=True), help="Location for temporary files.")
-def cli(volumes, dest, model, side, tempdir):
+class _DefaultGroup(click.Group):
+    """Group of commands running `default` unless the first argument names a command."""
+
+    def __init__(self, *args, default=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.default = default
+
+    def parse_args(self, ctx, args):
+        if not args or (args[0] not in self.commands and args[0] not in ctx.help_option_names):
+            args = [self.default, *args]
+        return super().parse_args(ctx, args)
+
+
+# volume files grouped by prefix, numbered within the group, e.g. `subject_0.nii.gz`, `subject_1.nii.gz`, except the
+# previews of the segmentations (see `_preview_file`)
+_PAIR_REGEX = re.compile(r"(?!.*preview\.[\w.]+$)(.+?)(\d+).[\w.]+$")
+
+_OUTPUT_OPTIONS = [
+    click.option("-d", "--dest", type=click.Path(), help="Output directory."),
+    click.option(
+        "--output-format",
+        type=click.Choice(api.Volume.SEGMENTATION_EXTENSIONS),
+        help="File format of the segmentations (default: that of the input volumes), `.mseg` is a compact label map format.",
+    ),
+]
+
+_SEGMENT_OPTIONS = [
+    click.option("--model", default="thigh-model3", help="Specify the segmentation model."),
+    click.option("--side", default="left+right", type=click.Choice(api.SIDES), help="Specify the limb's side(s)."),
+    click.option("--tempdir", type=click.Path(exists=True), help="Location for temporary files."),
+    click.option(
+        "--workdir",
+        type=click.Path(file_okay=False),
+        help="Persistent working directory instead of a temporary one: running the same command again after an interruption "
+        "does not segment again the cases already segmented by the model.",
+    ),
+    click.option("--server", envvar="MUSEGAI_SERVER", help="URL of a running inference server to reuse (see `api.start_server`)."),
+    click.option("--batch-size", type=click.IntRange(min=1), help="Number of volume pairs segmented per chunk (default: all at once)."),
+    click.option(
+        "--exchange",
+        default=".nii.gz",
+        type=click.Choice(api.EXCHANGE_FORMATS + [api.MEMORY_EXCHANGE]),
+        help="File format for exchanging volumes with the model, uncompressed `.nii` is faster (best with `--tempdir /dev/shm`), "
+        "`memory` exchanges them without files (in-process backends only).",
+    ),
+    click.option("--cache", type=click.Path(file_okay=False), help="Directory caching segmentations of previously segmented volumes."),
+    click.option("--cache-size", type=click.FloatRange(min=0), help="Maximum size of the cache in MB (default: unlimited)."),
+    click.option("--io-workers", default=4, type=click.IntRange(min=1), help="Number of workers reading and writing volume files."),
+    click.option("--io-executor", default="thread", type=click.Choice(["thread", "process"]), help="Type of the workers reading and writing volume files."),
+    click.option("--workers", default=1, type=click.IntRange(min=1), help="Number of concurrent inference workers."),
+    click.option("--devices", help="Comma-separated GPU ids assigned to the inference workers in turn, or `cpu` (default: all GPUs)."),
+    click.option("--preset", type=click.Choice(list(api.PRESETS)), help="Speed/accuracy trade-off of the inference (default: the model's defaults)."),
+    click.option(
+        "-O",
+        "--option",
+        "options",
+        multiple=True,
+        callback=lambda ctx, param, value: _parse_options(value),
+        help=f"Inference option overriding the preset, as KEY=VALUE (JSON value), with KEY one of: {', '.join(api.INFERENCE_OPTIONS)}.",
+    ),
+    click.option("--backend", type=click.Choice(list(api.BACKENDS)), help="Inference backend (default: docker)."),
+    click.option("--crop", is_flag=True, help="Crop the limbs to their bounding boxes before inference (the background is not segmented)."),
+    click.option(
+        "--slab-size",
+        type=click.IntRange(min=1),
+        help="Tile the limbs into slabs of this many slices, segmented separately and stitched back, to bound the memory of the inference "
+        "on long volumes (default: not tiled).",
+    ),
+    click.option("--slab-overlap", default=api.SLAB_OVERLAP, type=click.IntRange(min=0), help="Minimum overlap (slices) of the slabs."),
+    click.option(
+        "--preview",
+        is_flag=True,
+        help=f"Save a coarse segmentation first, of the volumes downsampled in-plane by {api.PREVIEW_FACTOR} with the `fast` preset (unless given "
+        "another), as `<name>preview<ext>`.",
+    ),
+    click.option(
+        "--refine",
+        is_flag=True,
+        help="With `--preview`, segment the volumes at full resolution after the previews, reusing the loaded volumes (chunk by chunk, see `--batch-size`).",
+    ),
+]
+
+
+def _options(options):
+    """Return a decorator adding the options to a command."""
+
+    def decorator(func):
+        for option in reversed(options):
+            func = option(func)
+        return func
+
+    return decorator
+
+
+# options of the segmentation and of its output files
+_segment_options = _options(_OUTPUT_OPTIONS + _SEGMENT_OPTIONS)
+
+
+@click.group(cls=_DefaultGroup, default="segment", context_settings={"show_default": True})
+def cli():
     """Automatic muscle segmentation command line tool.
 
+    Without a command, the arguments are those of `segment`, e.g., `museg-ai subject_0.nii.gz subject_1.nii.gz`.
+    """
+
+
+@cli.command(context_settings={"show_default": True})
+@click.argument("volumes", type=click.Path(exists=True), nargs=-1)
+@_segment_options
+@click.option("--profile", type=click.Path(dir_okay=False), help="Save the time spent in each stage as JSON trace events (see chrome://tracing or ui.perfetto.dev).")
+def segment(volumes, dest, output_format, profile, cache, cache_size, io_workers, io_executor, devices, **kwargs):
+    """Segment volume pairs.
+
     \b
     VOLUMES can be:
         - (nothing): show available segmentation models
-        - two matching Dixon volumes to segment
-        - a single directory with numbered pairs of matching Dixon volumes
+        - two matching Dixon volumes to segment (files, or directories of DICOM series)
+        - a single directory with numbered pairs of matching Dixon volumes, or with DICOM series (paired by echo time)
     """
     if not volumes:
         # no argument: list available models
@@ -33,27 +144,17 @@ def cli(volumes, dest, model, side, tempdir):
         sys.exit(0)
 
     if (len(volumes) == 1) and pathlib.Path(volumes[0]).is_dir():
-        # a folder with volume pairs
+        # a folder with volume pairs: only read the headers for now
         root = pathlib.Path(volumes[0])
-        regex = re.compile(r"(.+?)(\d+).[\w.]+$")
-        volumes = {}
-        for file in sorted(root.glob("*")):
-            match = regex.match(file.name)
-            if not match:
-                continue
-            name, _ = match.groups()
-            vol = api.Volume.load(file)
-            volumes.setdefault(name, []).append(vol)
-            if len(volumes[name]) > 2:
-                click.echo(f"Expecting two volume files with prefix: {name}")
+        volumes = _scan_directory(root)
         click.echo(f"Found {len(volumes)} volume pair(s) to segment:")
         for name in volumes:
             click.echo(f"\t{name}")
 
-    elif len(volumes) == 2 and all(pathlib.Path(file).is_file() for file in volumes):
-        # individual files
+    elif len(volumes) == 2:
+        # individual files, or DICOM series
         root = "."
-        volumes = [api.Volume.load(file) for file in volumes]
+        volumes = [api.Volume.load_header(file) for file in volumes]
         name = volumes[0].info["name"]
         volumes = {name: volumes}
         click.echo(f"Found one volume pair to segment: {name}")
@@ -66,7 +167,7 @@ def cli(volumes, dest, model, side, tempdir):
     # destination
     dest = pathlib.Path(root if dest is None else dest)
     dest.mkdir(exist_ok=True, parents=True)
-    destfiles = {name: (dest / name).with_suffix(volumes[name][0].info["extension"]) for name in volumes}
+    destfiles = {name: (dest / name).with_suffix(output_format or volumes[name][0].info["extension"]) for name in volumes}
     for name in destfiles:
         if destfiles[name].is_file():
             click.echo(f"Output file already exists: {destfiles[name]}, skipping")
@@ -76,18 +177,342 @@ def cli(volumes, dest, model, side, tempdir):
         click.echo("Nothing to do.")
         sys.exit(0)
 
-    # segment volumes
-    click.echo(f"Segmenting {len(volumes)} volume(s)...")
-    segmented, labels = api.segment_volumes(volumes, model, side=side, tempdir=tempdir)
+    cache = _open_cache(cache, cache_size)
+    tracer = tracing.NO_TRACER if profile is None else tracing.Tracer()
+    failed = _segment(volumes, dest, destfiles, cache=cache, io_workers=io_workers, io_executor=io_executor, devices=devices, tracer=tracer, **kwargs)
+    if profile is not None:
+        tracer.save(profile)
+        click.echo(f"Profile saved to {profile}:")
+        for stage, stats in tracer.summary().items():
+            click.echo(f"\t{stage}: {stats['count']} span(s), {stats['time']:.2f}s" + (f", {stats['bytes'] / 1e6:.1f} MB" if stats["bytes"] else ""))
+    if failed:
+        click.echo(f"Failed to save {len(failed)} of {len(volumes)} segmentation(s).")
+        sys.exit(1)
+
+    click.echo("Done.")
+
+
+@cli.command(context_settings={"show_default": True})
+@click.argument("directory", type=click.Path(exists=True, file_okay=False))
+@_segment_options
+@click.option("--manifest", type=click.Path(dir_okay=False), help="File recording the processed volume files (default: `.museg-watch.json` in the output directory).")
+@click.option("--interval", default=5.0, type=click.FloatRange(min=0), help="Seconds between scans of the directory.")
+@click.option("--settle", default=10.0, type=click.FloatRange(min=0), help="Seconds a volume file must be unchanged before it is segmented.")
+@click.option("--max-batch", default=16, type=click.IntRange(min=1), help="Maximum number of volume pairs segmented at once.")
+@click.option("--batch-delay", default=60.0, type=click.FloatRange(min=0), help="Maximum seconds a complete volume pair waits for a batch to fill.")
+@click.option("--once", is_flag=True, help="Segment the volume pairs found, and exit (instead of watching the directory).")
+def watch(directory, dest, output_format, manifest, interval, settle, max_batch, batch_delay, once, cache, cache_size, io_workers, io_executor, devices, **kwargs):
+    """Watch a directory, and segment the new pairs of matching Dixon volumes as they arrive.
+
+    The processed volume files are recorded (by name, size and modification time) in a manifest, such that restarting
+    the command only segments the new or modified files. With `--preview`, the volumes are always segmented at full
+    resolution after the previews (as with `--refine`), such that a recorded pair has an up-to-date segmentation.
+    """
+    root = pathlib.Path(directory)
+    dest = pathlib.Path(root if dest is None else dest)
+    dest.mkdir(exist_ok=True, parents=True)
+    watcher = Watcher(root, dest / ".museg-watch.json" if manifest is None else manifest, _PAIR_REGEX, settle=settle)
+    cache = _open_cache(cache, cache_size)
+    kwargs["refine"] = kwargs["refine"] or kwargs["preview"]
+    click.echo(f"Watching `{root}` for new volume pairs, saving results to `{dest}`...")
 
-    # save
-    click.echo(f"Saving results to `{dest}`")
-    labels.save(dest / "labels.txt")
-    for name, vol in segmented.items():
-        vol.save(destfiles[name])
+    for batch in micro_batches(watcher, interval=interval, max_cases=max_batch, max_delay=batch_delay, once=once):
+        volumes, destfiles = {}, {}
+        for name, files in batch.items():
+            try:
+                headers = [api.Volume.load_header(file) for file in files]
+                api._check_volumes(headers)  # pylint: disable=protected-access
+            except (RuntimeError, ValueError) as exc:
+                click.echo(f"Invalid volume pair: {name} ({exc}), skipping")
+                continue
+            destfiles[name] = (dest / name).with_suffix(output_format or headers[0].info["extension"])
+            if destfiles[name].is_file() and destfiles[name].stat().st_mtime_ns >= max(file.stat().st_mtime_ns for file in files):
+                click.echo(f"Output file already up to date: {destfiles[name]}, skipping")
+                continue
+            volumes[name] = headers
+        if volumes:
+            click.echo(f"Found {len(volumes)} new volume pair(s): {', '.join(volumes)}")
+            failed = _segment(volumes, dest, destfiles, cache=cache, io_workers=io_workers, io_executor=io_executor, devices=devices, tracer=tracing.NO_TRACER, **kwargs)
+            if failed:
+                click.echo(f"Failed to save {len(failed)} of {len(volumes)} segmentation(s).")
+        # the invalid and failed pairs are recorded too: they are tried again once modified
+        previews = [_preview_file(file) for file in destfiles.values()] if kwargs["preview"] else []
+        watcher.done(batch, outputs=[*destfiles.values(), *previews, dest / "labels.txt"])
 
     click.echo("Done.")
 
 
+@cli.command(context_settings={"show_default": True})
+@click.argument("queue_file", type=click.Path(dir_okay=False))
+@click.argument("volumes", type=click.Path(exists=True), nargs=-1, required=True)
+@_options(_OUTPUT_OPTIONS)
+def enqueue(queue_file, volumes, dest, output_format):
+    """Register volume pairs as jobs of a queue (created if needed), segmented by `museg-ai worker`.
+
+    VOLUMES are two matching Dixon volumes, or directories with numbered pairs of matching Dixon volumes. The
+    segmentations are saved next to the volumes, or into the output directory, and the pairs already segmented or
+    queued are skipped.
+    """
+    pairs = {}
+    if len(volumes) == 2 and all(pathlib.Path(file).is_file() for file in volumes):
+        headers = [api.Volume.load_header(file) for file in volumes]
+        pairs[(pathlib.Path(volumes[0]).parent, headers[0].info["name"])] = headers
+    else:
+        for directory in volumes:
+            if not pathlib.Path(directory).is_dir():
+                click.echo(f"Expecting two volume files or directories, not: {directory}")
+                sys.exit(1)
+            pairs.update({(pathlib.Path(directory), name): headers for name, headers in _scan_directory(pathlib.Path(directory)).items()})
+
+    jobs = []
+    for (root, name), headers in pairs.items():
+        output = (pathlib.Path(root if dest is None else dest) / name).with_suffix(output_format or headers[0].info["extension"])
+        if output.is_file():
+            click.echo(f"Output file already exists: {output}, skipping")
+            continue
+        # absolute paths, as the workers may run elsewhere
+        jobs.append((name, [header.file.resolve() for header in headers], output.resolve()))
+    queue = JobQueue(queue_file)
+    added = queue.enqueue(jobs)
+    counts = queue.counts()
+    click.echo(f"Enqueued {added} new job(s), {len(jobs) - added} already queued.")
+    click.echo("Jobs: " + ", ".join(f"{count} {state}" for state, count in counts.items()))
+
+
+@cli.command(context_settings={"show_default": True})
+@click.argument("queue_file", type=click.Path(exists=True, dir_okay=False))
+@_options(_SEGMENT_OPTIONS)
+@click.option("--jobs", "max_jobs", default=1, type=click.IntRange(min=1), help="Maximum number of jobs claimed and segmented at once.")
+@click.option(
+    "--lease",
+    default=300.0,
+    type=click.FloatRange(min=1),
+    help="Seconds a claimed job stays reserved without a heartbeat of the worker (renewed every third of it), before the other workers claim it again.",
+)
+@click.option("--max-attempts", default=3, type=click.IntRange(min=1), help="Maximum number of claims of a job, before it is recorded as failed.")
+@click.option("--poll", default=10.0, type=click.FloatRange(min=0), help="Seconds between checks of the queue when no job can be claimed.")
+@click.option("--wait", is_flag=True, help="Wait for new jobs once the queue is empty (instead of exiting).")
+@click.option("--name", help="Name of the worker in the queue (default: HOST:PID).")
+def worker(queue_file, max_jobs, lease, max_attempts, poll, wait, name, cache, cache_size, io_workers, io_executor, devices, **kwargs):
+    """Segment the jobs of a queue (see `museg-ai enqueue`), alongside other workers, possibly on other machines.
+
+    The queue is a SQLite database, on storage shared by the workers (with working file locks). Each worker claims
+    jobs atomically, and keeps them reserved by a heartbeat while segmenting them: the jobs of a worker that died are
+    claimed again by the others once their lease expired.
+    """
+    name = f"{socket.gethostname()}:{os.getpid()}" if name is None else name
+    queue = JobQueue(queue_file, lease=lease, max_attempts=max_attempts)
+    cache = _open_cache(cache, cache_size)
+    done = failed = 0
+    click.echo(f"Worker {name} processing the jobs of `{queue_file}`...")
+    while True:
+        jobs = queue.claim(name, max_jobs)
+        if not jobs:
+            counts = queue.counts()
+            if not wait and not counts["pending"] and not counts["running"]:
+                break
+            # wait for new jobs, or for the leases of other workers to expire
+            time.sleep(poll)
+            continue
+
+        # the cases are named by job, as jobs of several directories may have the same name
+        volumes, destfiles = {}, {}
+        for job in jobs:
+            key = f"job{job.id}_{job.name}"
+            try:
+                headers = [api.Volume.load_header(file) for file in job.files]
+                api._check_volumes(headers)  # pylint: disable=protected-access
+                destfiles[key] = pathlib.Path(job.output)
+                destfiles[key].parent.mkdir(exist_ok=True, parents=True)
+            except (OSError, RuntimeError, ValueError) as exc:
+                click.echo(f"Invalid job {job.id} ({exc}), failed")
+                queue.finish(name, job, error=str(exc))
+                failed += 1
+                continue
+            volumes[key] = (job, headers)
+        if not volumes:
+            continue
+
+        with queue.heartbeat(name, [job for job, _ in volumes.values()]):
+            try:
+                errors = _segment(
+                    {key: headers for key, (_, headers) in volumes.items()},
+                    pathlib.Path(jobs[0].output).parent,
+                    destfiles,
+                    cache=cache,
+                    io_workers=io_workers,
+                    io_executor=io_executor,
+                    devices=devices,
+                    tracer=tracing.NO_TRACER,
+                    **kwargs,
+                )
+            except Exception as exc:  # pylint: disable=broad-exception-caught
+                # e.g., the inference failed: the jobs are tried again, possibly by another worker
+                click.echo(f"Failed to segment {len(volumes)} job(s), returned to the queue: {exc}")
+                queue.release(name, [job for job, _ in volumes.values()], error=str(exc))
+                time.sleep(poll)
+                continue
+        for key, (job, _) in volumes.items():
+            queue.finish(name, job, error=f"failed to save {job.output}" if key in errors else None)
+        done += len(volumes) - len(errors)
+        failed += len(errors)
+
+    click.echo(f"Done: {done} job(s) segmented, {failed} failed.")
+
+
+@cli.command(context_settings={"show_default": True})
+@click.argument("directory", type=click.Path(exists=True, file_okay=False))
+@click.option("-d", "--dest", type=click.Path(exists=True, file_okay=False), help="Directory of the segmentations (default: DIRECTORY).")
+@click.option("-o", "--output", default="metrics.csv", type=click.Path(dir_okay=False), help="Table of the metrics, CSV or Parquet (`.parquet`, requires pyarrow).")
+@click.option("--side", default="left+right", type=click.Choice(api.SIDES), help="Specify the limb's side(s).")
+@click.option("--workers", default=4, type=click.IntRange(min=1), help="Number of processes computing the metrics.")
+def metrics(directory, dest, output, side, workers):
+    """Compute the volume, intensities and fat fraction of each muscle and side.
+
+    DIRECTORY holds the numbered pairs of matching Dixon volumes (in- and out-of-phase), the segmentations of which are
+    found in the output directory of `segment` (with their `labels.txt`).
+    """
+    from musegai import metrics as quantify  # pylint: disable=import-outside-toplevel  # imports numpy
+
+    root = pathlib.Path(directory)
+    dest = root if dest is None else pathlib.Path(dest)
+    cases = {}
+    for file in sorted(root.iterdir()):
+        match = _PAIR_REGEX.match(file.name)
+        if match and any(file.name.endswith(ext) for ext in api.Volume.EXTENSIONS):
+            cases.setdefault(match.group(1), []).append(file)
+    segmented = {}
+    for name, files in cases.items():
+        # in the format of the volumes, or in the compact label map format
+        found = [dest / f"{name}{ext}" for ext in [api.Volume.check_file(files[0])[1], labelmap.EXTENSION]]
+        segmentation = next((file for file in found if file.is_file()), None)
+        if len(files) == 2 and segmentation is not None:
+            segmented[name] = (segmentation, files)
+    click.echo(f"Computing the metrics of {len(segmented)} segmented volume pair(s)...")
+    labels = api.Labels.load(dest / "labels.txt") if (dest / "labels.txt").is_file() else None
+    rows = quantify.statistics_table(segmented, labels, workers=workers, side=side)
+    quantify.save_table(rows, output)
+    click.echo(f"Saved {len(rows)} row(s) to {output}")
+
+
+def _open_cache(cache, cache_size):
+    """Return the segmentation cache in directory `cache` (or None)."""
+    if cache is None:
+        return None
+    return SegmentationCache(cache, max_size=None if cache_size is None else int(cache_size * 1e6))
+
+
+def _segment(volumes, dest, destfiles, *, io_workers, io_executor, batch_size=None, preview=False, refine=False, **kwargs):
+    """Segment the volumes, save the segmentations into `destfiles` as soon as written by the model, and return the failed cases.
+
+    With `preview`, the coarse segmentations are saved first (see `_preview_file`), and with `refine` the volumes are
+    then segmented at full resolution, loaded once for both: chunk by chunk (of `batch_size` cases), such that only the
+    volumes of a chunk are held in memory.
+    """
+    kwargs.update(io_workers=io_workers, io_executor=io_executor, batch_size=batch_size)
+    previews = {name: _preview_file(file) for name, file in destfiles.items()}
+    if not preview:
+        return _segment_pass(volumes, dest, destfiles, **kwargs)
+    if not refine:
+        click.echo("Preview:")
+        return _segment_pass(volumes, dest, previews, preview=True, **kwargs)
+    names = list(volumes)
+    size = batch_size or len(names)
+    failed = set()
+    for start in range(0, len(names), size):
+        chunk = {name: volumes[name] for name in names[start : start + size]}
+        with api._io_pool(io_workers, io_executor) as pool:  # pylint: disable=protected-access
+            loading = {name: [pool.submit(vol.load) if isinstance(vol, api.VolumeHeader) else None for vol in vols] for name, vols in chunk.items()}
+            chunk = {name: [vol if future is None else future.result() for vol, future in zip(chunk[name], futures)] for name, futures in loading.items()}
+        click.echo("Preview:")
+        failed.update(_segment_pass(chunk, dest, previews, preview=True, **kwargs))
+        click.echo("Full resolution:")
+        failed.update(_segment_pass(chunk, dest, destfiles, **kwargs))
+    return sorted(failed)
+
+
+def _segment_pass(volumes, dest, destfiles, *, cache, io_workers, io_executor, devices, tracer, **kwargs):
+    """Segment the volumes once (see `_segment`)."""
+    # the voxel data is loaded by `segment_volumes`
+    click.echo(f"Segmenting {len(volumes)} volume(s), saving results to `{dest}`...")
+
+    saving = {}
+    with api._io_pool(io_workers, io_executor) as pool, tracer.span("segment volumes", cases=len(volumes)):  # pylint: disable=protected-access
+
+        def save(name, vol):
+            saving[name] = pool.submit(tracing.timed, vol.save, destfiles[name])
+
+        _, labels = api.segment_volumes(
+            volumes,
+            callback=save,
+            stream=True,
+            cache=cache,
+            io_workers=io_workers,
+            io_executor=io_executor,
+            devices=None if devices is None else devices.split(","),
+            tracer=tracer,
+            **kwargs,
+        )
+    for directory in {file.parent for file in destfiles.values()}:
+        labels.save(directory / "labels.txt")
+    if cache is not None:
+        click.echo(f"Cache: {cache.hits} hit(s), {cache.misses} miss(es)")
+
+    # report failures per file
+    failed = []
+    for name in volumes:
+        try:
+            _, start, end, pid, tid = saving[name].result()
+        except Exception as exc:  # pylint: disable=broad-exception-caught
+            click.echo(f"Failed to save {destfiles[name]}: {exc}")
+            failed.append(name)
+            continue
+        tracer.add("save output", start, end, pid=pid, tid=tid, case=name, file=str(destfiles[name]), bytes=destfiles[name].stat().st_size)
+    return failed
+
+
+def _preview_file(file):
+    """Return the file of the preview of a segmentation, e.g., `subject_preview.nii.gz` for `subject_.nii.gz`."""
+    name, ext = api.Volume.check_file(file)
+    return file.with_name(f"{name}preview{ext}")
+
+
+def _scan_directory(root):
+    """Find the pairs of matching volume files, and of DICOM series, in a directory, reading their headers only."""
+    volumes = {}
+    for file in sorted(root.glob("*")):
+        match = _PAIR_REGEX.match(file.name)
+        if not match or not any(file.name.endswith(ext) for ext in api.Volume.EXTENSIONS):
+            continue
+        name, _ = match.groups()
+        header = api.Volume.load_header(file)
+        volumes.setdefault(name, []).append(header)
+        if len(volumes[name]) > 2:
+            click.echo(f"Expecting two volume files with prefix: {name}")
+    for name in list(volumes):
+        try:
+            api._check_volumes(volumes[name])  # pylint: disable=protected-access
+        except ValueError as exc:
+            click.echo(f"Invalid volume pair: {name} ({exc}), skipping")
+            volumes.pop(name)
+    # DICOM series, paired by echo time
+    volumes.update(api.scan_dicom(root))
+    return volumes
+
+
+def _parse_options(values):
+    """Parse inference options given as KEY=VALUE, where VALUE is JSON (or a plain string)."""
+    options = {}
+    for value in values:
+        key, sep, value = value.partition("=")
+        if not sep or key not in api.INFERENCE_OPTIONS:
+            raise click.BadParameter(f"Expecting KEY=VALUE with KEY one of: {', '.join(api.INFERENCE_OPTIONS)}")
+        try:
+            options[key] = json.loads(value)
+        except ValueError:
+            options[key] = value
+    return options
+
+
 if __name__ == "__main__":
-    cli()  # pylint: disable=no-value-for-parameter
+    cli()
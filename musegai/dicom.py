@@ -0,0 +1,203 @@
+"""Reading of DICOM series, e.g., the Dixon series exported by the scanners, without intermediate files.
+
+The slice files of a directory are indexed by reading their headers only (in parallel), and grouped into series by
+series UID and echo time, as the echoes of a Dixon acquisition may share a series. The in-phase and out-of-phase series
+of a study are paired by their echo times (`ECHO_TIMES`). The slices of a series are decoded in parallel, directly into
+one preallocated array.
+"""
+from __future__ import annotations
+
+import concurrent.futures
+import dataclasses
+import pathlib
+import re
+
+from musegai import imports
+
+np = imports.lazy_import("numpy")  # pylint: disable=invalid-name
+sitk = imports.lazy_import("SimpleITK")  # pylint: disable=invalid-name
+
+# echo times (ms) of the in-phase and out-of-phase volumes, in the order of the volume pairs
+ECHO_TIMES = (1.95, 2.75)
+ECHO_TOLERANCE = 0.3
+
+# file format of the segmentations of DICOM series (default)
+OUTPUT_EXTENSION = ".nii.gz"
+
+# threads reading the slice files of a directory or series
+WORKERS = 8
+
+_TAGS = {
+    "series": "0020|000e",
+    "study": "0020|000d",
+    "patient": "0010|0020",
+    "number": "0020|0011",
+    "echo_time": "0018|0081",
+}
+
+
+@dataclasses.dataclass
+class Series:  # pylint: disable=too-many-instance-attributes
+    """DICOM series of a single echo: its slice files (sorted along the slice axis) and geometry, with the voxels (x, y, z)."""
+
+    uid: str
+    echo_time: float
+    study: str
+    patient: str
+    number: str
+    files: list
+    shape: tuple
+    dtype: object
+    origin: tuple
+    spacing: tuple
+    transform: tuple
+
+
+def is_dicom(file):
+    """Return whether a file is a DICOM file (with the standard preamble)."""
+    try:
+        with open(file, "rb") as fp:
+            return fp.read(132)[128:] == b"DICM"
+    except OSError:
+        return False
+
+
+def index(files, *, workers=WORKERS):
+    """Read the headers of DICOM slice files, and return their series (by series UID and echo time) sorted by series number."""
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        slices = [header for header in executor.map(_read_slice, files) if header is not None]
+    groups = {}
+    for header in slices:
+        # the slices of a series share their size and orientation
+        groups.setdefault((header["series"], header["echo_time"], header["size"], header["direction"]), []).append(header)
+    series = [_make_series(group) for group in groups.values()]
+    return sorted(series, key=lambda item: (item.patient, item.study, _number(item.number), item.echo_time))
+
+
+def index_directory(directory, *, workers=WORKERS):
+    """Return the DICOM series of the files of a directory and of its subdirectories (see `index`)."""
+    return index([file for file in sorted(pathlib.Path(directory).rglob("*")) if file.is_file() and is_dicom(file)], workers=workers)
+
+
+def pair_series(series, *, echo_times=ECHO_TIMES, tolerance=ECHO_TOLERANCE):
+    """Pair the series of each study with the given echo times and the same geometry, and return the pairs by name.
+
+    The pairs are named after the patient and the series number of the first series, e.g., `PAT01_5_`.
+    """
+    pairs, paired = {}, set()
+    for first in series:
+        if abs(first.echo_time - echo_times[0]) > tolerance:
+            continue
+        candidates = [item for item in series if id(item) not in paired and abs(item.echo_time - echo_times[1]) <= tolerance and _same_geometry(first, item)]
+        if not candidates:
+            continue
+        second = candidates[0]
+        paired.update([id(first), id(second)])
+        base = re.sub(r"[^\w-]+", "-", f"{first.patient or 'dicom'}_{first.number}").strip("-")
+        name = f"{base}_"
+        for i in range(2, len(series) + 2):
+            if name not in pairs:
+                break
+            name = f"{base}-{i}_"
+        pairs[name] = [first, second]
+    return pairs
+
+
+def find_series(file, *, workers=WORKERS):
+    """Return the series of a DICOM slice file (read from the files of its directory), or of a directory with a single series."""
+    file = pathlib.Path(file)
+    if file.is_dir():
+        series = index_directory(file, workers=workers)
+        if len(series) != 1:
+            raise ValueError(f"Expecting a single DICOM series in {file}, found {len(series)}")
+        return series[0]
+    header = _read_slice(file)
+    if header is None:
+        raise ValueError(f"Not a DICOM image file: {file}")
+    siblings = [other for other in sorted(file.parent.iterdir()) if other.is_file() and is_dicom(other)]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        slices = [other for other in executor.map(_read_slice, siblings) if other is not None]
+    key = (header["series"], header["echo_time"], header["size"], header["direction"])
+    return _make_series([other for other in slices if (other["series"], other["echo_time"], other["size"], other["direction"]) == key])
+
+
+def load(series, *, workers=WORKERS):
+    """Decode the slices of a series in parallel, into one (x, y, z) array in Fortran order."""
+    array = np.empty(series.shape, dtype=series.dtype, order="F")
+
+    def decode(k):
+        image = sitk.ReadImage(str(series.files[k]), imageIO="GDCMImageIO")
+        # (1, y, x) to (x, y), a contiguous slice of the array
+        array[:, :, k] = sitk.GetArrayViewFromImage(image)[0].T
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(decode, range(len(series.files))))
+    return array
+
+
+def _read_slice(file):
+    """Return the header of a DICOM slice file, or None if it is not a DICOM image."""
+    reader = sitk.ImageFileReader()
+    reader.SetImageIO("GDCMImageIO")
+    reader.SetFileName(str(file))
+    try:
+        reader.ReadImageInformation()
+    except RuntimeError:
+        return None
+    if reader.GetDimension() != 3 or reader.GetSize()[2] != 1 or not reader.HasMetaDataKey(_TAGS["series"]):
+        return None
+    tags = {key: reader.GetMetaData(tag).strip() if reader.HasMetaDataKey(tag) else "" for key, tag in _TAGS.items()}
+    direction = reader.GetDirection()
+    pixel = sitk.Image([1, 1], reader.GetPixelID(), reader.GetNumberOfComponents())
+    return {
+        **tags,
+        "file": pathlib.Path(file),
+        "echo_time": float(tags["echo_time"] or "nan"),
+        "size": reader.GetSize()[:2],
+        "direction": tuple(round(value, 4) for value in direction),
+        "transform": direction,
+        "origin": reader.GetOrigin(),
+        "spacing": reader.GetSpacing(),
+        "dtype": sitk.GetArrayViewFromImage(pixel).dtype,
+        # position along the slice axis (the normal of the slices)
+        "position": float(np.dot(reader.GetOrigin(), direction[2::3])),
+    }
+
+
+def _make_series(slices):
+    """Return the series of the slice headers of a single series and echo."""
+    slices = sorted(slices, key=lambda header: header["position"])
+    # duplicates of a slice (e.g., exported twice)
+    slices = [header for i, header in enumerate(slices) if not i or header["position"] - slices[i - 1]["position"] > 1e-3]
+    first = slices[0]
+    positions = [header["position"] for header in slices]
+    spacing = float(np.median(np.diff(positions))) if len(slices) > 1 else first["spacing"][2]
+    return Series(
+        uid=first["series"],
+        echo_time=first["echo_time"],
+        study=first["study"],
+        patient=first["patient"],
+        number=first["number"],
+        files=[header["file"] for header in slices],
+        shape=(*first["size"], len(slices)),
+        dtype=np.result_type(*[header["dtype"] for header in slices]),
+        origin=first["origin"],
+        spacing=(*first["spacing"][:2], spacing),
+        transform=first["transform"],
+    )
+
+
+def _same_geometry(first, second):
+    """Return whether two series of the same study have the same voxel grid."""
+    return (
+        first.study == second.study
+        and first.shape == second.shape
+        and np.allclose(first.origin, second.origin, atol=1e-3)
+        and np.allclose(first.spacing, second.spacing, atol=1e-3)
+        and np.allclose(first.transform, second.transform, atol=1e-3)
+    )
+
+
+def _number(number):
+    """Return a series number for sorting."""
+    return int(number) if number.isdigit() else -1
@@ -0,0 +1,20 @@
+"""Deferred imports of heavy dependencies, such that the command line interface starts fast."""
+from __future__ import annotations
+
+import importlib.util
+import sys
+
+
+def lazy_import(name):
+    """Return the module `name`, imported on first attribute access (see `importlib.util.LazyLoader`)."""
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ModuleNotFoundError(f"No module named '{name}'", name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
@@ -0,0 +1,159 @@
+"""Queue of segmentation jobs shared by several workers, possibly on several machines.
+
+The jobs are rows of a SQLite database, e.g., on shared storage with working file locks. A worker claims jobs in a
+single write transaction, which holds a lease on them for `lease` seconds, and renews the lease while segmenting (the
+heartbeat). The jobs of a worker that stopped renewing its leases (e.g., its machine died) are claimed again by the
+other workers, up to `max_attempts` times.
+"""
+from __future__ import annotations
+
+import contextlib
+import dataclasses
+import json
+import sqlite3
+import threading
+import time
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    files TEXT NOT NULL,
+    output TEXT NOT NULL UNIQUE,
+    state TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    lease REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, lease);
+"""
+
+# states of the jobs
+STATES = ["pending", "running", "done", "failed"]
+
+
+@dataclasses.dataclass
+class Job:
+    """Segmentation of a volume pair (`files`) into the file `output`."""
+
+    id: int
+    name: str
+    files: list
+    output: str
+
+
+class JobQueue:
+    """Queue of segmentation jobs in the SQLite database `file` (created if needed)."""
+
+    def __init__(self, file, *, lease=300.0, max_attempts=3):
+        """Open the queue, whose claimed jobs are reserved for `lease` seconds, and tried at most `max_attempts` times."""
+        self.file = str(file)
+        self.lease = lease
+        self.max_attempts = max_attempts
+        with self._connect() as db:
+            db.executescript(_SCHEMA)
+
+    def enqueue(self, jobs):
+        """Add jobs, given as `(name, files, output)`, and return the number of new jobs (one per output file)."""
+        with self._transaction() as db:
+            before = db.total_changes
+            rows = [(name, json.dumps([str(file) for file in files]), str(output)) for name, files, output in jobs]
+            db.executemany("INSERT OR IGNORE INTO jobs (name, files, output) VALUES (?, ?, ?)", rows)
+            return db.total_changes - before
+
+    def claim(self, worker, count=1, now=None):
+        """Claim up to `count` pending jobs (or jobs whose lease expired) for `worker`, and return them."""
+        now = time.time() if now is None else now
+        with self._transaction() as db:
+            # jobs of lost workers, tried too often
+            db.execute(
+                "UPDATE jobs SET state = 'failed', error = 'lease expired ' || attempts || ' time(s)' WHERE state = 'running' AND lease < ? AND attempts >= ?",
+                (now, self.max_attempts),
+            )
+            rows = db.execute(
+                "SELECT id, name, files, output FROM jobs WHERE state = 'pending' OR (state = 'running' AND lease < ?) ORDER BY id LIMIT ?", (now, count)
+            ).fetchall()
+            db.executemany(
+                "UPDATE jobs SET state = 'running', worker = ?, lease = ?, attempts = attempts + 1 WHERE id = ?", [(worker, now + self.lease, row[0]) for row in rows]
+            )
+        return [Job(id, name, json.loads(files), output) for id, name, files, output in rows]  # pylint: disable=redefined-builtin
+
+    def renew(self, worker, jobs, now=None):
+        """Renew the leases of the running jobs of `worker`, and return the number of jobs still held."""
+        now = time.time() if now is None else now
+        with self._transaction() as db:
+            before = db.total_changes
+            db.executemany("UPDATE jobs SET lease = ? WHERE id = ? AND worker = ? AND state = 'running'", [(now + self.lease, job.id, worker) for job in jobs])
+            return db.total_changes - before
+
+    @contextlib.contextmanager
+    def heartbeat(self, worker, jobs, interval=None):
+        """Renew the leases of the jobs of `worker` every `interval` seconds (default: a third of the lease) while in context."""
+        interval = self.lease / 3 if interval is None else interval
+        stop = threading.Event()
+
+        def beat():
+            while not stop.wait(interval):
+                self.renew(worker, jobs)
+
+        thread = threading.Thread(target=beat, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    def finish(self, worker, job, error=None):
+        """Record a job of `worker` as done, or as failed with `error` (ignored if the job was claimed by another worker meanwhile)."""
+        with self._transaction() as db:
+            db.execute(
+                "UPDATE jobs SET state = ?, error = ?, lease = NULL WHERE id = ? AND worker = ? AND state = 'running'",
+                ("done" if error is None else "failed", error, job.id, worker),
+            )
+
+    def release(self, worker, jobs, error=None):
+        """Return the running jobs of `worker` to the queue (e.g., after an error of the inference), unless tried too often."""
+        with self._transaction() as db:
+            db.executemany(
+                "UPDATE jobs SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, error = ?, lease = NULL "
+                "WHERE id = ? AND worker = ? AND state = 'running'",
+                [(self.max_attempts, error, job.id, worker) for job in jobs],
+            )
+
+    def counts(self, now=None):
+        """Return the number of jobs by state, of which the running jobs whose lease expired as "expired"."""
+        now = time.time() if now is None else now
+        with self._connect() as db:
+            counts = dict.fromkeys(STATES + ["expired"], 0)
+            counts.update(db.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall())
+            counts["expired"] = db.execute("SELECT COUNT(*) FROM jobs WHERE state = 'running' AND lease < ?", (now,)).fetchone()[0]
+        return counts
+
+    def failures(self):
+        """Return the failed jobs with their errors."""
+        with self._connect() as db:
+            rows = db.execute("SELECT id, name, files, output, error FROM jobs WHERE state = 'failed' ORDER BY id").fetchall()
+        return [(Job(id, name, json.loads(files), output), error) for id, name, files, output, error in rows]  # pylint: disable=redefined-builtin
+
+    @contextlib.contextmanager
+    def _connect(self):
+        """Return a new connection (in autocommit mode), closed on exit, such that the queue can be used by several threads and processes."""
+        db = sqlite3.connect(self.file, timeout=60.0, isolation_level=None)
+        try:
+            yield db
+        finally:
+            db.close()
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """Return a connection in a write transaction, committed on exit (rolled back on error)."""
+        with self._connect() as db:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                yield db
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+            db.execute("COMMIT")
@@ -0,0 +1,123 @@
+"""Compact file format of segmentations (label maps).
+
+A `.mseg` file holds a `uint8` label map cropped to the bounding box of its labelled voxels, encoded as runs of equal
+labels or as bit-packed labels (whichever is smaller) and deflated, after a JSON header with the geometry of the full
+volume. Both encodings are decoded with a few vectorized numpy operations (`np.repeat`, shifts).
+
+Layout: the magic `MSEG`, the format version (1 byte), the length of the header (4 bytes, little endian), the header
+(UTF-8 JSON), and the deflated payload.
+"""
+from __future__ import annotations
+
+import json
+import pathlib
+import struct
+import zlib
+
+from musegai import imports
+
+np = imports.lazy_import("numpy")  # pylint: disable=invalid-name
+
+EXTENSION = ".mseg"
+MAGIC = b"MSEG"
+VERSION = 1
+
+
+def save(array, file, *, origin, spacing, transform, level=6):
+    """Save a label map (non-negative integers up to 255) with its geometry, deflated with compression `level`."""
+    array = np.asarray(array)
+    if not (array.dtype.kind == "b" or (array.dtype.kind in "iu" and (not array.size or (array.min() >= 0 and array.max() <= 255)))):
+        raise ValueError(f"Expecting a label map with labels in [0, 255], not an array of {array.dtype} in [{array.min()}, {array.max()}]")
+    box = bounding_box(array)
+    encoding, payload = encode(array[tuple(slice(start, stop) for start, stop in box)].astype(np.uint8))
+    header = {
+        "shape": list(array.shape),
+        "origin": list(origin),
+        "spacing": list(spacing),
+        "transform": list(transform),
+        "box": box,
+        "encoding": encoding,
+    }
+    data = json.dumps(header).encode()
+    with open(file, "wb") as fp:
+        fp.write(MAGIC + struct.pack("<BI", VERSION, len(data)) + data)
+        fp.write(zlib.compress(payload, level))
+
+
+def load(file):
+    """Load a label map, and return it (as `uint8`, in Fortran order) with its header."""
+    with open(file, "rb") as fp:
+        header = _read_header(fp, file)
+        payload = zlib.decompress(fp.read())
+    array = np.zeros(header["shape"], dtype=np.uint8, order="F")
+    box = tuple(slice(start, stop) for start, stop in header["box"])
+    array[box] = decode(header["encoding"], payload, [stop - start for start, stop in header["box"]])
+    return array, header
+
+
+def load_header(file):
+    """Read the header of a label map file only: its shape and geometry."""
+    with open(file, "rb") as fp:
+        return _read_header(fp, file)
+
+
+def bounding_box(array):
+    """Return the bounding box of the non-zero voxels, as `[start, stop]` per axis (empty if there is none)."""
+    box = []
+    for axis in range(array.ndim):
+        filled = np.flatnonzero(np.any(array, axis=tuple(i for i in range(array.ndim) if i != axis)))
+        if not filled.size:
+            return [[0, 0]] * array.ndim
+        box.append([int(filled[0]), int(filled[-1]) + 1])
+    return box
+
+
+def encode(array):
+    """Return the smallest encoding of a `uint8` array (in Fortran order), and the encoded bytes."""
+    flat = array.ravel(order="F")
+    if not flat.size:
+        return "rle", b""
+    # runs of equal labels: the label (1 byte) and the length (4 bytes) of each run
+    starts = np.flatnonzero(np.concatenate([[True], flat[1:] != flat[:-1]]))
+    bits = next(bits for bits in [1, 2, 4, 8] if int(flat.max()) < 1 << bits)
+    if starts.size * 5 < flat.size * bits / 8:
+        lengths = np.diff(np.append(starts, flat.size)).astype("<u4")
+        return "rle", flat[starts].tobytes() + lengths.tobytes()
+    # labels packed into 1, 2, 4 or 8 bits, the first label in the lowest bits
+    per_byte = 8 // bits
+    padded = np.zeros(-(-flat.size // per_byte) * per_byte, dtype=np.uint8)
+    padded[: flat.size] = flat
+    shifts = np.arange(0, 8, bits, dtype=np.uint8)
+    packed = np.bitwise_or.reduce(padded.reshape(-1, per_byte) << shifts, axis=1).astype(np.uint8)
+    return f"bits{bits}", packed.tobytes()
+
+
+def decode(encoding, data, shape):
+    """Return the `uint8` array of the given shape (in Fortran order) from its encoded bytes."""
+    size = int(np.prod(shape))
+    if encoding == "rle":
+        runs = len(data) // 5
+        values = np.frombuffer(data, dtype=np.uint8, count=runs)
+        lengths = np.frombuffer(data, dtype="<u4", offset=runs)
+        flat = np.repeat(values, lengths)
+    elif encoding.startswith("bits") and encoding[4:] in ["1", "2", "4", "8"]:
+        bits = int(encoding[4:])
+        packed = np.frombuffer(data, dtype=np.uint8)
+        shifts = np.arange(0, 8, bits, dtype=np.uint8)
+        flat = ((packed[:, None] >> shifts) & np.uint8((1 << bits) - 1)).ravel()[:size]
+    else:
+        raise ValueError(f"Unknown encoding: {encoding}")
+    if flat.size != size:
+        raise ValueError(f"Invalid label map data: expecting {size} labels, got {flat.size}")
+    return flat.reshape(shape, order="F")
+
+
+def _read_header(fp, file):
+    """Read and return the header of an open label map file."""
+    start = fp.read(len(MAGIC) + 5)
+    if len(start) < len(MAGIC) + 5 or start[: len(MAGIC)] != MAGIC:
+        raise ValueError(f"Not a label map file: {pathlib.Path(file)}")
+    version, length = struct.unpack("<BI", start[len(MAGIC) :])
+    if version != VERSION:
+        raise ValueError(f"Unsupported version of the label map file {pathlib.Path(file)}: {version}")
+    return json.loads(fp.read(length))
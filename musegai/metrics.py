@@ -0,0 +1,144 @@
+"""Per-muscle quantitative metrics of segmented Dixon volume pairs.
+
+The statistics of all labels of a segmentation are computed in one pass over its labelled voxels: the voxels are keyed
+by label and side (left or right limb), counted and summed with `np.bincount`, and sorted once per volume for the
+percentiles. The fat fraction is derived from the in- and out-of-phase volumes (two-point Dixon, assuming that water
+dominates): `(in_phase - out_of_phase) / (2 * in_phase)`, averaged over the voxels of each label.
+"""
+from __future__ import annotations
+
+import csv
+import functools
+import pathlib
+import re
+
+from musegai import api
+
+np = api.np  # pylint: disable=invalid-name
+
+# names of the volumes of a case, in order
+CHANNELS = ("in_phase", "out_of_phase")
+PERCENTILES = (5, 25, 50, 75, 95)
+SIDES = ("right", "left")  # order of `api._split_volume` along the first axis
+
+# ITK-SNAP label description: index, red, green, blue, alpha, visibility, mesh visibility, "label"
+_LABEL_LINE = re.compile(r'^\s*(\d+)\s+(?:[\d.]+\s+){6}"(.*)"\s*$')
+
+
+def label_names(labels):
+    """Return the names of the labels (an `api.Labels` in ITK-SNAP format) by label id, without the background."""
+    names = {}
+    for line in labels.data.splitlines():
+        match = _LABEL_LINE.match(line)
+        if match and int(match.group(1)):
+            names[int(match.group(1))] = match.group(2)
+    return names
+
+
+def label_statistics(segmentation, volumes=(), *, labels=None, side="left+right", channels=CHANNELS, percentiles=PERCENTILES):
+    """Return the statistics of each label and side of a segmentation, as rows (dicts).
+
+    Each row holds the label id and name, the side, the number of voxels and the volume (mL), and per volume of the case
+    (named by `channels`) the mean and `percentiles` of its voxels. With both Dixon volumes, the rows also hold the mean
+    fat fraction. The limbs are separated at the least-labelled position in the central half of the first axis.
+    """
+    array = np.asarray(segmentation.array)
+    mask = array > 0
+    ids = array[mask].astype(np.intp)
+    if not ids.size:
+        return []
+    sides = _sides(mask, side)
+    keys = ids * 2 + np.broadcast_to(sides.reshape((-1,) + (1,) * (mask.ndim - 1)), mask.shape)[mask]
+    counts = np.bincount(keys, minlength=2 * (int(ids.max()) + 1))
+    present = np.flatnonzero(counts)
+    voxel_volume = float(np.prod(segmentation.spacing)) / 1000  # mL
+
+    columns = {"voxels": counts[present], "volume_ml": counts[present] * voxel_volume}
+    values = {}
+    for channel, volume in zip(channels, volumes):
+        values[channel] = np.asarray(volume.array)[mask].astype(np.float64)
+        columns[f"{channel}_mean"] = np.bincount(keys, weights=values[channel], minlength=counts.size)[present] / counts[present]
+        for percentile, result in zip(percentiles, _group_percentiles(keys, values[channel], counts, percentiles)):
+            columns[f"{channel}_p{percentile}"] = result[present]
+    if set(CHANNELS) <= set(values):
+        in_phase, out_of_phase = values[CHANNELS[0]], values[CHANNELS[1]]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            fat_fraction = np.where(in_phase > 0, np.clip((in_phase - out_of_phase) / (2 * in_phase), 0, 1), 0)
+        columns["fat_fraction"] = np.bincount(keys, weights=fat_fraction, minlength=counts.size)[present] / counts[present]
+
+    names = {} if labels is None else label_names(labels)
+    rows = []
+    for index, key in enumerate(present):
+        label = int(key // 2)
+        row = {"label": label, "name": names.get(label, f"label{label}"), "side": SIDES[key % 2]}
+        row.update((column, result[index].item()) for column, result in columns.items())
+        rows.append(row)
+    return rows
+
+
+def case_statistics(name, segmentation_file, volume_files=(), labels=None, **kwargs):
+    """Load a segmentation and its volumes (memory-mapped), and return the statistics of its labels, as rows with the case name."""
+    segmentation = api.Volume.load(segmentation_file, mmap=True)
+    volumes = [api.Volume.load(file, mmap=True) for file in volume_files]
+    return [{"case": name, **row} for row in label_statistics(segmentation, volumes, labels=labels, **kwargs)]
+
+
+def statistics_table(cases, labels=None, *, workers=None, executor="process", **kwargs):
+    """Return the statistics of the labels of all cases, given as `(segmentation file, volume files)` by case name.
+
+    The cases are processed by a pool of `workers` threads or processes (`executor`, default: sequentially).
+    """
+    statistics = functools.partial(case_statistics, labels=labels, **kwargs)
+    tasks = [(segmentation_file, statistics, name, segmentation_file, volume_files) for name, (segmentation_file, volume_files) in cases.items()]
+    with api._io_pool(workers, executor) as pool:  # pylint: disable=protected-access
+        results = api._map_files(pool, "compute the statistics of", tasks)  # pylint: disable=protected-access
+    return [row for rows in results for row in rows]
+
+
+def save_table(rows, file):
+    """Save the rows as a CSV table, or as a Parquet table if `file` ends with `.parquet` (requires pyarrow)."""
+    file = pathlib.Path(file)
+    if file.suffix == ".parquet":
+        # pylint: disable=import-outside-toplevel,import-error  # pyarrow is optional
+        import pyarrow
+        import pyarrow.parquet
+
+        pyarrow.parquet.write_table(pyarrow.Table.from_pylist(rows), file)
+        return
+    fields = list(dict.fromkeys(field for row in rows for field in row))
+    with open(file, "w", newline="", encoding="utf-8") as fp:
+        writer = csv.DictWriter(fp, fieldnames=fields)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def _sides(mask, side):
+    """Return the side index (see `SIDES`) of each position along the first axis."""
+    side = side.lower()
+    size = mask.shape[0]
+    if "left" in side and "right" in side:
+        filled = np.count_nonzero(mask, axis=tuple(range(1, mask.ndim)))
+        central = filled[size // 4 : size - size // 4]
+        gap = np.flatnonzero(central == central.min())
+        split = size // 4 + int(gap[len(gap) // 2])
+        return (np.arange(size) >= split).astype(np.intp)
+    if side in SIDES:
+        return np.full(size, SIDES.index(side), dtype=np.intp)
+    raise ValueError(f"Invalid side: {side}")
+
+
+def _group_percentiles(keys, values, counts, percentiles):
+    """Return the percentiles of the values of each key (linear interpolation, as `np.percentile`), sorting the values once."""
+    ordered = values[np.lexsort((values, keys))]
+    starts = np.cumsum(counts) - counts
+    last = np.maximum(counts - 1, 0)
+    results = []
+    for percentile in percentiles:
+        position = percentile / 100 * last
+        lower = np.floor(position).astype(np.intp)
+        upper = np.minimum(lower + 1, last)
+        fraction = position - lower
+        below = ordered[np.minimum(starts + lower, ordered.size - 1)]
+        above = ordered[np.minimum(starts + upper, ordered.size - 1)]
+        results.append(below + (above - below) * fraction)
+    return results
@@ -0,0 +1,31 @@
+"""Manifest of the segmentation models.
+
+The metadata of each model (Docker image, inputs, labels, folder of the nnU-Net model) is read from the static file
+`models.json`, such that listing the models does not import the segmentation API and its dependencies.
+"""
+from __future__ import annotations
+
+import functools
+import json
+import pathlib
+
+MANIFEST = pathlib.Path(__file__).with_name("models.json")
+
+
+@functools.lru_cache(maxsize=None)
+def load_manifest():
+    """Return the metadata of all models, by name."""
+    return json.loads(MANIFEST.read_text(encoding="utf-8"))
+
+
+def list_models():
+    """List available models."""
+    return list(load_manifest())
+
+
+def get_model(name):
+    """Return the metadata of a model."""
+    manifest = load_manifest()
+    if name not in manifest:
+        raise ValueError(f"Unknown model: {name}")
+    return manifest[name]
@@ -0,0 +1,207 @@
+"""In-process nnU-Net inference, run by the "torch" backend of `api.segment_volumes`.
+
+The models are loaded from `MUSEGAI_NNUNET_MODELS` (default: nnU-Net's `RESULTS_FOLDER`), laid out like in the Docker
+images (see `nnunet_folder` in `models.json`), with the labels of each model in its folder (`labels.txt`), e.g.:
+
+    $MUSEGAI_NNUNET_MODELS/nnUNet/3d_fullres/Task503_MuscleThigh/nnUNetTrainerV2_MUSEGAI__nnUNetPlansv2.1/labels.txt
+
+nnU-Net finds the trainer of the models in its package only: copy `docker/nnUNetTrainerV2_MUSEGAI.py` into
+`nnunet/training/network_training` (as done by the Dockerfile). The loaded models stay in memory until `clear_cache`,
+such that the trainer and the fold parameters are loaded once per process and device.
+"""
+from __future__ import annotations
+
+import os
+import pathlib
+import threading
+
+import numpy as np
+
+from musegai import models
+
+_PREDICTORS = {}
+_PREDICTORS_LOCK = threading.Lock()
+
+
+def model_folder(model):
+    """Return the folder of the model."""
+    root = os.environ.get("MUSEGAI_NNUNET_MODELS") or os.environ.get("RESULTS_FOLDER")
+    if not root:
+        raise RuntimeError("Set `MUSEGAI_NNUNET_MODELS` to the directory of the nnU-Net models")
+    folder = pathlib.Path(root) / models.get_model(model)["nnunet_folder"]
+    if not folder.is_dir():
+        raise FileNotFoundError(f"Model folder not found: {folder}")
+    return folder
+
+
+def get_predictor(folder, device=None, *, mixed_precision=True):
+    """Return the predictor of the model in `folder` on `device` (GPU id, or "cpu"), loaded once per process."""
+    key = (str(folder), device, mixed_precision)
+    with _PREDICTORS_LOCK:
+        if key not in _PREDICTORS:
+            _PREDICTORS[key] = Predictor(folder, device, mixed_precision=mixed_precision)
+        return _PREDICTORS[key]
+
+
+def clear_cache():
+    """Release the loaded models."""
+    with _PREDICTORS_LOCK:
+        _PREDICTORS.clear()
+
+
+class Predictor:  # pylint: disable=too-few-public-methods,too-many-instance-attributes
+    """nnU-Net predictor of in-memory volumes, keeping the trainer and the fold parameters in memory between predictions.
+
+    This mirrors the predictor of `docker/nnunet_predict.py`, but preprocesses and exports the volumes without files.
+    """
+
+    def __init__(self, folder, device=None, *, folds=None, do_tta=True, mixed_precision=True, step_size=0.5, checkpoint_name="model_final_checkpoint"):
+        """Load the trainer and the parameters of all folds on the device (GPU id, or "cpu")."""
+        # pylint: disable=import-outside-toplevel,import-error  # torch and nnU-Net are optional
+        import nnunet
+        import torch
+        from batchgenerators.utilities.file_and_folder_operations import subfolders
+        from nnunet.inference.predict import load_model_and_checkpoint_files
+        from nnunet.postprocessing.connected_components import load_postprocessing
+        from nnunet.training.model_restore import recursive_find_python_class
+
+        folder = str(folder)
+        cpu = device == "cpu" or not torch.cuda.is_available()
+        self.do_tta = do_tta
+        self.mixed_precision = mixed_precision and not cpu
+        self.step_size = step_size
+        if folds is None:
+            # detected automatically, as done by `load_model_and_checkpoint_files`
+            folds = sorted(int(name[len("fold_") :]) for name in subfolders(folder, prefix="fold_", join=False))
+        self.trainer, params = load_model_and_checkpoint_files(folder, folds, mixed_precision=self.mixed_precision, checkpoint_name=checkpoint_name)
+        if cpu:
+            self.trainer.network.cpu()
+        elif device is not None:
+            torch.cuda.set_device(int(device))
+            self.trainer.network.cuda(int(device))
+        # parameters by fold, such that predictions can select a subset of the loaded folds
+        self.params = dict(zip(map(str, folds), params))
+        # the trainer holds the parameters of a single fold at a time
+        self.lock = threading.Lock()
+
+        plans = self.trainer.plans
+        preprocessor = plans.get("preprocessor_name") or ("GenericPreprocessor" if self.trainer.threeD else "PreprocessorFor2D")
+        preprocessor = recursive_find_python_class([os.path.join(nnunet.__path__[0], "preprocessing")], preprocessor, current_module="nnunet.preprocessing")
+        self.preprocessor = preprocessor(self.trainer.normalization_schemes, self.trainer.use_mask_for_norm, self.trainer.transpose_forward, self.trainer.intensity_properties)
+        self.target_spacing = plans["plans_per_stage"][self.trainer.stage]["current_spacing"]
+
+        export_params = plans.get("segmentation_export_params", {})
+        self.force_separate_z = export_params.get("force_separate_z")
+        self.interpolation_order = export_params.get("interpolation_order", 1)
+        self.interpolation_order_z = export_params.get("interpolation_order_z", 0)
+        self.region_class_order = getattr(self.trainer, "regions_class_order", None)
+
+        postprocessing_file = os.path.join(folder, "postprocessing.json")
+        self.postprocessing = load_postprocessing(postprocessing_file) if os.path.isfile(postprocessing_file) else None
+
+    def predict(self, volumes, *, folds=None, disable_tta=None, step_size=None):
+        """Return the segmentation (uint8 array indexed like the volumes) of a case, given as the volumes of each modality.
+
+        The folds (a subset of the loaded folds), test time augmentation and step size default to those given at creation.
+        """
+        folds = list(self.params) if folds is None else [str(fold) for fold in folds]
+        missing = [fold for fold in folds if fold not in self.params]
+        if missing:
+            raise ValueError(f"Folds not loaded: {missing}")
+        do_tta = self.do_tta if disable_tta is None else not disable_tta
+        step_size = self.step_size if step_size is None else step_size
+
+        data, properties = self._preprocess(volumes)
+        with self.lock:
+            softmax = self._predict_softmax(data, [self.params[fold] for fold in folds], do_tta, step_size)
+        segmentation = self._export(softmax, properties)
+        # (z, y, x) as exported by nnU-Net, to (x, y, z)
+        return segmentation.T
+
+    def _preprocess(self, volumes):
+        """Crop, resample and normalize the volumes, like `nnUNetTrainer.preprocess_patient` does with files."""
+        from nnunet.preprocessing.cropping import ImageCropper  # pylint: disable=import-outside-toplevel,import-error
+
+        volume = volumes[0]
+        # (modality, z, y, x) as read by nnU-Net
+        data = np.stack([np.asarray(vol.array, dtype=np.float32).T for vol in volumes])
+        properties = {
+            "original_size_of_raw_data": np.array(data.shape[1:]),
+            "original_spacing": np.array(volume.spacing)[[2, 1, 0]],
+            "list_of_data_files": [],
+            "seg_file": None,
+            "itk_origin": volume.origin,
+            "itk_spacing": volume.spacing,
+            "itk_direction": volume.transform,
+        }
+        data, seg, properties = ImageCropper.crop(data, properties)
+        transpose = (0, *[i + 1 for i in self.trainer.transpose_forward])
+        data, _, properties = self.preprocessor.resample_and_normalize(data.transpose(transpose), self.target_spacing, properties, seg.transpose(transpose))
+        return data.astype(np.float32), properties
+
+    def _predict_softmax(self, data, params, do_tta, step_size):
+        """Average the softmax of the given folds."""
+        softmax = None
+        for fold_params in params:
+            self.trainer.load_checkpoint_ram(fold_params, False)
+            prediction = self.trainer.predict_preprocessed_data_return_seg_and_softmax(
+                data,
+                do_mirroring=do_tta,
+                mirror_axes=self.trainer.data_aug_params["mirror_axes"],
+                use_sliding_window=True,
+                step_size=step_size,
+                use_gaussian=True,
+                all_in_gpu=False,
+                mixed_precision=self.mixed_precision,
+            )[1]
+            softmax = prediction if softmax is None else softmax + prediction
+        softmax /= len(params)
+        transpose_backward = self.trainer.plans.get("transpose_backward")
+        if self.trainer.plans.get("transpose_forward") is not None:
+            softmax = softmax.transpose([0] + [i + 1 for i in transpose_backward])
+        return softmax
+
+    def _export(self, softmax, properties):
+        """Resample the softmax to the original spacing, and paste its labels into the original volume.
+
+        This mirrors `nnunet.inference.segmentation_export.save_segmentation_nifti_from_softmax`, without the file.
+        """
+        # pylint: disable=import-outside-toplevel,import-error
+        from nnunet.postprocessing.connected_components import remove_all_but_the_largest_connected_component
+        from nnunet.preprocessing.preprocessing import get_do_separate_z, get_lowres_axis, resample_data_or_seg
+
+        shape = properties["size_after_cropping"]
+        if tuple(softmax.shape[1:]) != tuple(shape):
+            lowres_axis = None
+            if self.force_separate_z is not None:
+                separate_z = self.force_separate_z
+                if separate_z:
+                    lowres_axis = get_lowres_axis(properties["original_spacing"])
+            elif get_do_separate_z(properties["original_spacing"]):
+                separate_z, lowres_axis = True, get_lowres_axis(properties["original_spacing"])
+            elif get_do_separate_z(properties["spacing_after_resampling"]):
+                separate_z, lowres_axis = True, get_lowres_axis(properties["spacing_after_resampling"])
+            else:
+                separate_z = False
+            if lowres_axis is not None and len(lowres_axis) != 1:
+                separate_z = False
+            softmax = resample_data_or_seg(
+                softmax, shape, is_seg=False, axis=lowres_axis, order=self.interpolation_order, do_separate_z=separate_z, order_z=self.interpolation_order_z
+            )
+
+        if self.region_class_order is None:
+            labels = softmax.argmax(0)
+        else:
+            labels = np.zeros(softmax.shape[1:], dtype=np.uint8)
+            for index, region in enumerate(self.region_class_order):
+                labels[softmax[index] > 0.5] = region
+
+        segmentation = np.zeros(properties["original_size_of_raw_data"], dtype=np.uint8)
+        bbox = properties["crop_bbox"]
+        segmentation[tuple(slice(start, min(start + size, total)) for (start, _), size, total in zip(bbox, labels.shape, segmentation.shape))] = labels
+
+        if self.postprocessing is not None:
+            for_which_classes, min_valid_object_size = self.postprocessing
+            volume_per_voxel = float(np.prod(properties["itk_spacing"], dtype=np.float64))
+            segmentation = remove_all_but_the_largest_connected_component(segmentation, for_which_classes, volume_per_voxel, min_valid_object_size)[0]
+        return segmentation
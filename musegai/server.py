@@ -0,0 +1,93 @@
+"""Local inference server.
+
+A stand-in for the inference server of the Docker image (`nnunet_predict.py --serve`), speaking the same protocol:
+
+    - `GET /health` returns the served model and the root directory shared with the clients
+    - `POST /predict` with `{"input": ..., "output": ..., "exchange": ..., "options": ...}` (paths relative to the root)
+      predicts all cases of the input folder, exchanged as files of the given format (default: `.nii.gz`), with the
+      given inference options (see `api.REQUEST_OPTIONS`)
+
+"""
+# pylint: disable=missing-function-docstring
+from __future__ import annotations
+
+import http.server
+import json
+import pathlib
+import threading
+import time
+
+from musegai import api
+
+
+class InferenceServer(http.server.ThreadingHTTPServer):
+    """Inference server running a model on folders below a shared root directory."""
+
+    def __init__(self, model, root, *, host="localhost", port=0):
+        super().__init__((host, port), _RequestHandler)
+        self.model = model
+        self.root = pathlib.Path(root).resolve()
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def predict(self, indir, outdir, exchange=".nii.gz", options=None):
+        """Run the model on the cases of `indir`, one request at a time."""
+        with self.lock:
+            api._run_model(self.model, indir, outdir, exchange=exchange, options=options)  # pylint: disable=protected-access
+
+    def start(self):
+        """Serve requests in a background thread."""
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+
+class _RequestHandler(http.server.BaseHTTPRequestHandler):
+    server: InferenceServer
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        if self.path != "/health":
+            self._reply(404, {"error": f"Unknown path: {self.path}"})
+            return
+        self._reply(200, {"model": self.server.model, "root": str(self.server.root)})
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        if self.path != "/predict":
+            self._reply(404, {"error": f"Unknown path: {self.path}"})
+            return
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        indir = (self.server.root / request["input"]).resolve()
+        outdir = (self.server.root / request["output"]).resolve()
+        if not all(folder.is_relative_to(self.server.root) for folder in [indir, outdir]):
+            self._reply(400, {"error": "Folders must be located inside the root directory"})
+            return
+        exchange = request.get("exchange", ".nii.gz")
+        if exchange not in api.EXCHANGE_FORMATS:
+            self._reply(400, {"error": f"Unknown exchange format: {exchange}"})
+            return
+        options = request.get("options", {})
+        if set(options) - set(api.REQUEST_OPTIONS):
+            self._reply(400, {"error": f"Unsupported inference options: {', '.join(sorted(set(options) - set(api.REQUEST_OPTIONS)))}"})
+            return
+        start = time.monotonic()
+        try:
+            self.server.predict(indir, outdir, exchange, options)
+        except Exception as exc:  # pylint: disable=broad-exception-caught
+            self._reply(500, {"error": repr(exc)})
+            return
+        self._reply(200, {"status": "done", "time": time.monotonic() - start})
+
+    def log_message(self, format, *args):
+        """Silence request logging."""
+
+    def _reply(self, code, content):
+        body = json.dumps(content).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
@@ -0,0 +1,89 @@
+"""Timing of the segmentation stages.
+
+A `Tracer` records the spans of the stages of `api.segment_volumes` (per chunk, case and file, with the bytes read and
+written), and saves them in the trace event format of chrome://tracing and https://ui.perfetto.dev. Without a tracer,
+`NO_TRACER` records nothing.
+"""
+from __future__ import annotations
+
+import contextlib
+import json
+import os
+import threading
+import time
+
+
+class Tracer:
+    """Recorder of timed spans."""
+
+    enabled = True
+
+    def __init__(self):
+        """Start recording, the time stamps are relative to now."""
+        self.origin = time.perf_counter()
+        self.events = []
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def span(self, name, **args):
+        """Record the time spent in context as span `name`, with arguments `args` (which can be updated in context)."""
+        start = time.perf_counter()
+        try:
+            yield args
+        finally:
+            self.add(name, start, time.perf_counter(), **args)
+
+    def add(self, name, start, end, *, pid=None, tid=None, **args):
+        """Add a span from `start` to `end` (in seconds of `time.perf_counter`), in the given process and thread."""
+        event = {
+            "name": name,
+            "ph": "X",
+            "ts": (start - self.origin) * 1e6,
+            "dur": (end - start) * 1e6,
+            "pid": os.getpid() if pid is None else pid,
+            "tid": threading.get_ident() if tid is None else tid,
+            "args": {key: value for key, value in args.items() if value is not None},
+        }
+        with self._lock:
+            self.events.append(event)
+
+    def summary(self):
+        """Return the number of spans, their total time (in seconds) and bytes per name, in order of appearance."""
+        summary = {}
+        for event in sorted(self.events, key=lambda event: event["ts"]):
+            stats = summary.setdefault(event["name"], {"count": 0, "time": 0.0, "bytes": 0})
+            stats["count"] += 1
+            stats["time"] += event["dur"] / 1e6
+            stats["bytes"] += event["args"].get("bytes", 0)
+        return summary
+
+    def save(self, file):
+        """Save the spans as JSON trace events."""
+        with open(file, "w", encoding="utf-8") as fp:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, fp)
+
+
+class _NoTracer:
+    """Disabled tracer."""
+
+    enabled = False
+
+    def span(self, _name, **_args):
+        """Return a null context, with its own arguments (which can be updated in context, as those of `Tracer.span`)."""
+        return contextlib.nullcontext({})
+
+    def add(self, *_args, **_kwargs):
+        """Record nothing."""
+
+
+NO_TRACER = _NoTracer()
+
+
+def timed(func, *args):
+    """Return the result of `func(*args)` with the start and end times, and the ids of the process and the thread.
+
+    This records the spans of functions run by a pool of threads or processes (`time.perf_counter` is system-wide on Linux).
+    """
+    start = time.perf_counter()
+    result = func(*args)
+    return result, start, time.perf_counter(), os.getpid(), threading.get_ident()
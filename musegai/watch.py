@@ -0,0 +1,131 @@
+"""Incremental detection of new volume pairs in a watched directory.
+
+A `Watcher` keeps a persistent manifest of the processed volume files, keyed by path with their size and modification
+time. The first scan checks all files of the directory against the manifest, later scans list the directory only when
+its modification time changed, and examine the new files only, such that a scan costs in proportion to the number of
+new files rather than to the size of the directory.
+"""
+from __future__ import annotations
+
+import json
+import os
+import pathlib
+import tempfile
+import time
+
+
+class Watcher:  # pylint: disable=too-many-instance-attributes
+    """Watcher of a directory for new, complete pairs of volume files."""
+
+    def __init__(self, root, manifest, regex, *, settle=10.0, nfiles=2):
+        """Watch `root`, recording the processed files in the JSON file `manifest`.
+
+        The files are grouped into cases by the first group of `regex` (matched to the file names), a case is complete
+        when its `nfiles` files are stable, i.e., unchanged for `settle` seconds.
+        """
+        self.root = pathlib.Path(root)
+        self.manifest = pathlib.Path(manifest)
+        self.regex = regex
+        self.settle = settle
+        self.nfiles = nfiles
+        state = json.loads(self.manifest.read_text(encoding="utf-8")) if self.manifest.is_file() else {}
+        self.processed = state.get("files", {})  # file name -> [size, mtime] when processed
+        self.outputs = set(state.get("outputs", []))  # names of the files written into the directory
+        self.pending = {}  # file name -> (size, mtime, time first seen with this size and mtime)
+        self.reported = set()  # names of the cases reported as complete, but not yet processed
+        self.by_case = {}  # case name -> names of its processed files
+        for name in self.processed:
+            self.by_case.setdefault(self.regex.match(name).group(1), set()).add(name)
+        self.settling = 0  # number of files not yet stable
+        self._mtime = None  # modification time of the directory at the last listing
+
+    def poll(self, now=None):
+        """Scan the directory, and return the new complete cases as lists of files by case name (in order of file name)."""
+        now = time.time() if now is None else now
+        mtime = os.stat(self.root).st_mtime_ns
+        if mtime != self._mtime:
+            full = self._mtime is None
+            self._mtime = mtime
+            for entry in os.scandir(self.root):
+                if entry.name in self.pending or entry.name in self.outputs or not self.regex.match(entry.name):
+                    continue
+                if entry.name in self.processed and not full:
+                    continue
+                if not entry.is_file():
+                    continue
+                stat = entry.stat()
+                if self.processed.get(entry.name) != [stat.st_size, stat.st_mtime_ns]:
+                    self.pending[entry.name] = (stat.st_size, stat.st_mtime_ns, now)
+
+        # check the pending files for changes
+        stable = set()
+        for name, (size, mtime, since) in list(self.pending.items()):
+            try:
+                stat = os.stat(self.root / name)
+            except FileNotFoundError:
+                del self.pending[name]
+                continue
+            if (stat.st_size, stat.st_mtime_ns) != (size, mtime):
+                self.pending[name] = (stat.st_size, stat.st_mtime_ns, now)
+            elif now - since >= self.settle and now - mtime / 1e9 >= self.settle:
+                stable.add(name)
+        self.settling = len(self.pending) - len(stable)
+
+        # complete cases: all files of the case are stable (a modified file is processed again with the other files of its case)
+        cases = {}
+        for name in self.pending:
+            cases.setdefault(self.regex.match(name).group(1), set()).add(name)
+        complete = {}
+        for case, names in cases.items():
+            if case in self.reported or not stable.issuperset(names):
+                continue
+            names |= self.by_case.get(case, set())
+            if len(names) == self.nfiles:
+                self.reported.add(case)
+                complete[case] = [self.root / name for name in sorted(names)]
+        return complete
+
+    def done(self, cases, outputs=()):
+        """Record the files of the processed cases (lists of files by case name), and the written output files."""
+        for case, files in cases.items():
+            self.reported.discard(case)
+            for file in files:
+                if file.name in self.pending:
+                    size, mtime, _ = self.pending.pop(file.name)
+                    self.processed[file.name] = [size, mtime]
+                    self.by_case.setdefault(case, set()).add(file.name)
+        self.outputs.update(pathlib.Path(file).name for file in outputs if pathlib.Path(file).parent == self.root)
+        self.save()
+
+    def save(self):
+        """Save the manifest (atomically)."""
+        self.manifest.parent.mkdir(parents=True, exist_ok=True)
+        state = {"files": self.processed, "outputs": sorted(self.outputs)}
+        with tempfile.NamedTemporaryFile("w", dir=self.manifest.parent, suffix=".tmp", delete=False, encoding="utf-8") as fp:
+            json.dump(state, fp)
+        os.replace(fp.name, self.manifest)
+
+
+def micro_batches(watcher, *, interval=5.0, max_cases=16, max_delay=60.0, once=False, sleep=time.sleep, clock=time.monotonic):
+    """Poll the watcher every `interval` seconds, and yield the new complete cases in batches (lists of files by case name).
+
+    A batch is yielded when it holds `max_cases` cases, or when its first case waited for `max_delay` seconds. If `once`,
+    the generator stops as soon as all files are stable (the complete cases are yielded, the incomplete ones are not).
+    The cases of a batch must be recorded (`Watcher.done`) before the next batch is requested.
+    """
+    batch, start = {}, None
+    while True:
+        batch.update(watcher.poll())
+        if batch and start is None:
+            start = clock()
+        idle = once and not watcher.settling
+        while len(batch) >= max_cases:
+            cases = list(batch)[:max_cases]
+            yield {case: batch.pop(case) for case in cases}
+            start = clock() if batch else None
+        if batch and (idle or clock() - start >= max_delay):
+            yield batch
+            batch, start = {}, None
+        if idle:
+            return
+        sleep(interval)
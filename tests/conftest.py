@@ -0,0 +1,21 @@
+"""Shared test fixtures."""
+
+from __future__ import annotations
+
+import numpy as np
+import pytest
+
+from musegai import api
+
+METADATA = {"origin": (0.0, 0.0, 0.0), "spacing": (1.0, 1.0, 2.0), "transform": (1.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 1.0)}
+
+
+@pytest.fixture(name="make_volumes")
+def fixture_make_volumes():
+    """Return a factory of random Dixon volume pairs."""
+
+    def make_volumes(shape=(20, 12, 8), seed=0):
+        rng = np.random.default_rng(seed)
+        return [api.Volume(rng.random(shape).astype("float32"), **METADATA) for _ in range(2)]
+
+    return make_volumes
@@ -0,0 +1,194 @@
+"""Test the segmentation API."""
+# pylint: disable=protected-access
+
+from __future__ import annotations
+
+import numpy as np
+import pytest
+
+from musegai import api
+
+
+def test_segment_volumes(make_volumes):
+    """Segment with the dummy model."""
+    volumes = {"case": make_volumes(shape=(21, 12, 8))}
+    segmented, labels = api.segment_volumes(volumes, "test", side="left+right")
+    assert segmented["case"].shape == (21, 12, 8)
+    assert labels.data == "labels"
+
+
+def test_segment_volumes_in_chunks(make_volumes, monkeypatch):
+    """Chunked segmentation runs one inference per chunk and yields the same results."""
+    volumes = {f"case{i}": make_volumes(seed=i) for i in range(5)}
+    reference, _ = api.segment_volumes(volumes, "test", side="left+right")
+
+    runs = []
+    run_model = api._run_model
+    monkeypatch.setattr(api, "_run_model", lambda model, indir, outdir, **kwargs: runs.append(len(list(indir.iterdir()))) or run_model(model, indir, outdir, **kwargs))
+    results = {}
+    segmented, labels = api.segment_volumes(volumes, "test", side="left+right", batch_size=2, callback=results.__setitem__)
+    assert segmented is None
+    assert labels.data == "labels"
+    assert runs == [8, 8, 4]
+    assert list(results) == list(volumes)
+    for name, vol in results.items():
+        assert np.array_equal(vol.array, reference[name].array)
+
+
+def test_make_chunks(make_volumes):
+    """Chunks are limited by number of cases and bytes."""
+    volumes = {f"case{i}": make_volumes() for i in range(5)}
+    nbytes = sum(vol.nbytes for vol in volumes["case0"])
+    assert api._make_chunks(volumes) == [list(volumes)]
+    assert api._make_chunks(volumes, batch_size=3) == [["case0", "case1", "case2"], ["case3", "case4"]]
+    assert api._make_chunks(volumes, max_memory=2 * nbytes) == [["case0", "case1"], ["case2", "case3"], ["case4"]]
+    # a case larger than the budget gets its own chunk
+    assert api._make_chunks(volumes, max_memory=1) == [[name] for name in volumes]
+
+
+def test_segment_volumes_exchange(make_volumes, monkeypatch):
+    """Uncompressed exchange files yield the same results."""
+    volumes = {"case": make_volumes()}
+    reference, _ = api.segment_volumes(volumes, "test", side="left+right")
+
+    exchanged = []
+    run_model = api._run_model
+    monkeypatch.setattr(api, "_run_model", lambda model, indir, outdir, **kwargs: exchanged.extend(indir.iterdir()) or run_model(model, indir, outdir, **kwargs))
+    segmented, _ = api.segment_volumes(volumes, "test", side="left+right", exchange=".nii")
+    assert exchanged and all(file.name.endswith("_0000.nii") or file.name.endswith("_0001.nii") for file in exchanged)
+    assert np.array_equal(segmented["case"].array, reference["case"].array)
+
+
+def test_segment_volumes_io_workers(make_volumes):
+    """Files are read and written in parallel, in threads or processes."""
+    volumes = {f"case{i}": make_volumes(seed=i) for i in range(3)}
+    reference, _ = api.segment_volumes(volumes, "test", side="left+right")
+    for executor in ["thread", "process"]:
+        segmented, _ = api.segment_volumes(volumes, "test", side="left+right", io_workers=2, io_executor=executor)
+        assert list(segmented) == list(volumes)
+        assert all(np.array_equal(segmented[name].array, reference[name].array) for name in volumes)
+
+
+def test_map_files_errors(tmp_path):
+    """All files are processed, and the failures are reported per file."""
+    files = [tmp_path / "missing1.mha", tmp_path / "missing2.mha"]
+    for workers in [None, 2]:
+        with api._io_pool(workers) as pool:
+            with pytest.raises(RuntimeError) as exc:
+                api._map_files(pool, "load", [(file, api.Volume.load, file) for file in files])
+        message = str(exc.value)
+        assert message.startswith("Failed to load 2 file(s)")
+        assert all(str(file) in message for file in files)
+
+
+def test_segment_volumes_workers(make_volumes, monkeypatch):
+    """The cases are sharded across concurrent (CPU) workers."""
+    volumes = {f"case{i}": make_volumes(seed=i) for i in range(3)}
+    reference, _ = api.segment_volumes(volumes, "test", side="left+right")
+
+    shards = []
+    run_model = api._run_model
+
+    def record(model, indir, outdir, **kwargs):
+        shards.append((len(list(indir.iterdir())), kwargs["device"]))
+        run_model(model, indir, outdir, **kwargs)
+
+    monkeypatch.setattr(api, "_run_model", record)
+    segmented, _ = api.segment_volumes(volumes, "test", side="left+right", workers=4, devices=["cpu"])
+    # 6 cases (left and right of 3 volumes pairs) with 2 files each
+    assert sorted(shards) == [(2, "cpu"), (2, "cpu"), (4, "cpu"), (4, "cpu")]
+    assert all(np.array_equal(segmented[name].array, reference[name].array) for name in volumes)
+
+
+def test_balance():
+    """Large cases do not stall a shard."""
+    sizes = {"large": 100, "a": 30, "b": 30, "c": 20, "d": 20, "e": 10}
+    shards = api._balance(sizes, 2)
+    assert len(next(shard for shard in shards if "large" in shard)) == 2
+    assert sorted(sum(sizes[case] for case in shard) for shard in shards) == [100, 110]
+
+
+def test_inference_options(make_volumes, monkeypatch):
+    """Presets and overrides are passed to the inference model as command line arguments."""
+    options = api._inference_options("fast", {"step_size": 0.9, "num_threads_preprocessing": 2})
+    assert options == {"folds": [0], "disable_tta": True, "step_size": 0.9, "num_threads_preprocessing": 2}
+    assert api._model_arguments(options) == ["--folds", "0", "--disable_tta", "--step_size", "0.9", "--num_threads_preprocessing", "2"]
+    assert api._model_arguments({"disable_tta": False}) == []
+    with pytest.raises(ValueError, match="Unknown preset"):
+        api._inference_options("fastest")
+    with pytest.raises(ValueError, match="Unknown inference option"):
+        api._inference_options(options={"tta": False})
+
+    received = []
+    run_model = api._run_model
+    monkeypatch.setattr(api, "_run_model", lambda model, indir, outdir, **kwargs: received.append(kwargs["options"]) or run_model(model, indir, outdir, **kwargs))
+    api.segment_volumes({"case": make_volumes()}, "test", side="left+right", preset="balanced", options={"folds": [0, 1]})
+    assert received == [{"folds": [0, 1], "disable_tta": True, "step_size": 0.5}]
+
+
+def test_segment_volumes_crop(make_volumes, capsys):
+    """Cropped segmentations are pasted back into full-size volumes, and the saved voxels are reported."""
+    volumes = make_volumes(shape=(40, 12, 8))
+    for vol in volumes:
+        vol.array[:, :2] = 0  # background
+    segmented, _ = api.segment_volumes({"case": volumes}, "test", side="left+right", crop=True)
+    assert segmented["case"].shape == (40, 12, 8)
+    assert segmented["case"].origin == volumes[0].origin
+    assert not segmented["case"].array[:, :2].any()
+    assert "voxels" in capsys.readouterr().out
+
+
+def test_segment_volumes_slabs(make_volumes, monkeypatch):
+    """Long volumes are segmented in slabs of bounded size, and stitched back."""
+    monkeypatch.setattr(api, "BACKENDS", dict(api.BACKENDS))
+    shapes = []
+
+    def threshold(_model, indir, outdir, *, exchange, **_kwargs):
+        for name, files in api._exchanged_cases(indir, exchange).items():
+            vols = api._receive_volumes(files)
+            shapes.append(vols[0].shape)
+            api._send_volume(api.Volume((vols[0].array > 0.5).astype("uint8"), **vols[0].metadata), outdir / f"{name}{exchange}")
+        api._send_volume(api.Labels("labels"), outdir / "labels.txt")
+
+    api.register_backend("threshold", threshold)
+    volumes = make_volumes(shape=(40, 12, 50))
+    for crop in [False, True]:
+        shapes.clear()
+        segmented, _ = api.segment_volumes({"case": volumes}, "thigh-model3", side="left+right", backend="threshold", crop=crop, slab_size=16, slab_overlap=4)
+        assert segmented["case"].shape == (40, 12, 50) and segmented["case"].origin == volumes[0].origin
+        assert np.array_equal(segmented["case"].array, volumes[0].array > 0.5)
+        assert len(shapes) == 2 * 4 and all(shape[-1] == 16 for shape in shapes)
+
+
+def test_segment_volumes_preview(make_volumes, monkeypatch, tmp_path):
+    """Previews segment the volumes downsampled in-plane, and are upsampled back to their geometry."""
+    monkeypatch.setattr(api, "BACKENDS", dict(api.BACKENDS))
+    calls = []
+
+    def threshold(_model, indir, outdir, *, exchange, options, **_kwargs):
+        for name, files in api._exchanged_cases(indir, exchange).items():
+            vols = api._receive_volumes(files)
+            calls.append((vols[0].shape, vols[0].spacing, options))
+            api._send_volume(api.Volume((vols[0].array > 0.5).astype("uint8"), **vols[0].metadata), outdir / f"{name}{exchange}")
+        api._send_volume(api.Labels("labels"), outdir / "labels.txt")
+
+    api.register_backend("threshold", threshold)
+    volumes = make_volumes(shape=(41, 12, 8))
+    segmented, _ = api.segment_volumes({"case": volumes}, "thigh-model3", side="left+right", backend="threshold", preview=True)
+    assert segmented["case"].shape == (41, 12, 8)
+    assert segmented["case"].origin == volumes[0].origin and segmented["case"].spacing == volumes[0].spacing
+    assert sum(shape[0] for shape, _, _ in calls) == 21 and all(shape[1:] == (6, 8) and spacing == (2.0, 2.0, 2.0) for shape, spacing, _ in calls)
+    assert all(options == api.PRESETS["fast"] for _, _, options in calls)
+    expected = api._downsample(volumes[0], 2).array > 0.5
+    assert np.array_equal(segmented["case"].array, expected[np.arange(41) // 2][:, np.arange(12) // 2])
+
+    # from files, loaded downsampled
+    for i, vol in enumerate(volumes):
+        vol.save(tmp_path / f"case_{i}.mha")
+    headers = [api.Volume.load_header(tmp_path / f"case_{i}.mha") for i in range(2)]
+    calls.clear()
+    previewed, _ = api.segment_volumes({"case": headers}, "thigh-model3", side="left+right", backend="threshold", preview=3, preset="full")
+    assert previewed["case"].shape == (41, 12, 8)
+    assert sum(shape[0] for shape, _, _ in calls) == 14 and all(options == api.PRESETS["full"] for _, _, options in calls)
+    with pytest.raises(ValueError, match="downsampling factor"):
+        api.segment_volumes({"case": volumes}, "thigh-model3", backend="threshold", preview=1)
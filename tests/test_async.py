@@ -0,0 +1,157 @@
+"""Test the asyncio segmentation API."""
+# pylint: disable=protected-access
+
+from __future__ import annotations
+
+import asyncio
+import time
+
+import numpy as np
+import pytest
+
+import docker
+from musegai import api
+
+
+class FakeContainer:
+    """Container running until stopped, or exiting with `status` after `runtime` seconds."""
+
+    def __init__(self, runtime=None, status=0, startup=0):
+        """Create the container, started by `start`."""
+        self.runtime = runtime
+        self.end = None
+        self.exit_code = status
+        self.startup = startup
+        self.status = "created"
+        self.calls = []
+
+    def start(self):
+        """Start the container (after `startup` seconds)."""
+        time.sleep(self.startup)
+        self.calls.append("start")
+        self.status = "running"
+        self.end = None if self.runtime is None else time.monotonic() + self.runtime
+
+    def reload(self):
+        """Update the status."""
+        if self.end is not None and time.monotonic() > self.end:
+            self.status = "exited"
+
+    def wait(self):
+        """Return the exit status."""
+        return {"StatusCode": self.exit_code}
+
+    def logs(self, **_kwargs):
+        """Return the error output."""
+        return b"error"
+
+    def stop(self, _timeout=None, **_kwargs):
+        """Stop the container."""
+        self.calls.append("stop")
+        self.status = "exited"
+
+    def remove(self):
+        """Remove the container."""
+        self.calls.append("remove")
+
+
+@pytest.fixture(name="containers")
+def fixture_containers(monkeypatch):
+    """Fake Docker client, starting the containers of the list (in order)."""
+    containers = []
+    started = []
+
+    class Client:  # pylint: disable=too-few-public-methods
+        """Docker client."""
+
+        class images:  # pylint: disable=invalid-name,too-few-public-methods
+            """Available images."""
+
+            list = staticmethod(lambda name: [name])
+
+        class containers:  # pylint: disable=invalid-name,too-few-public-methods
+            """Containers."""
+
+            @staticmethod
+            def run(_image, detach=False, **kwargs):
+                """Start the next container."""
+                assert detach
+                started.append(kwargs["command"])
+                container = containers[len(started) - 1]
+                container.start()
+                return container
+
+    monkeypatch.setattr(docker, "from_env", Client)
+    return containers
+
+
+async def wait_for(condition, timeout=5):
+    """Wait until `condition()` holds."""
+    start = time.monotonic()
+    while not condition():
+        assert time.monotonic() - start < timeout, "timed out"
+        await asyncio.sleep(0.01)
+
+
+def test_segment_volumes_async(make_volumes):
+    """The results match the blocking API."""
+    volumes = {f"case{i}": make_volumes(seed=i) for i in range(3)}
+    reference, _ = api.segment_volumes(volumes, "test", side="left+right")
+    segmented, labels = asyncio.run(api.segment_volumes_async(volumes, "test", side="left+right", batch_size=1, concurrency=2))
+    assert list(segmented) == list(volumes)
+    assert all(np.array_equal(segmented[name].array, reference[name].array) for name in volumes)
+    assert labels.data == "labels"
+
+
+def test_segment_volumes_async_concurrency(make_volumes, monkeypatch):
+    """A semaphore shared between calls limits the concurrent inferences."""
+    running, peak = [], []
+    run_model = api._run_model
+
+    def record(*args, **kwargs):
+        running.append(None)
+        peak.append(len(running))
+        time.sleep(0.05)
+        running.pop()
+        run_model(*args, **kwargs)
+
+    monkeypatch.setattr(api, "_run_model", record)
+
+    async def main(concurrency):
+        calls = [api.segment_volumes_async({f"case{i}": make_volumes(seed=i)}, "test", side="left+right", concurrency=concurrency) for i in range(3)]
+        return await asyncio.gather(*calls)
+
+    asyncio.run(main(asyncio.Semaphore(1)))
+    assert len(peak) == 3 and max(peak) == 1
+    peak.clear()
+    asyncio.run(main(3))
+    assert max(peak) > 1
+
+
+@pytest.mark.parametrize("startup", [0, 0.3])
+def test_segment_volumes_async_cancel(tmp_path, make_volumes, containers, startup):
+    """Cancelling stops the container (also while starting) and removes the temporary files."""
+    containers.append(FakeContainer(startup=startup))
+
+    async def main():
+        call = api.segment_volumes_async({"case": make_volumes()}, "thigh-model3", side="left+right", tempdir=tmp_path, poll_interval=0.01)
+        task = asyncio.create_task(call)
+        await wait_for(lambda: list(tmp_path.glob("*/chunk0000/in/*")) or task.done())
+        await asyncio.sleep(0.1)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(main())
+    assert containers[0].calls == ["start", "stop", "remove"]
+    assert not list(tmp_path.iterdir())
+
+
+def test_segment_volumes_async_failure(tmp_path, make_volumes, containers):
+    """A failing container is reported and removed."""
+    containers.append(FakeContainer(runtime=0.05, status=1))
+    call = api.segment_volumes_async({"case": make_volumes()}, "thigh-model3", side="left+right", tempdir=tmp_path, poll_interval=0.01, preset="fast")
+    with pytest.raises(docker.errors.ContainerError, match="error"):
+        asyncio.run(call)
+    assert containers[0].calls == ["start", "stop", "remove"]
+    assert not list(tmp_path.iterdir())
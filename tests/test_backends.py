@@ -0,0 +1,94 @@
+"""Test the inference backends."""
+# pylint: disable=protected-access
+
+from __future__ import annotations
+
+import numpy as np
+import pytest
+
+from musegai import api, models, nnunet
+
+
+def test_memory_exchange(make_volumes, monkeypatch):
+    """In-process backends exchange the volumes without files."""
+    volumes = {f"case{i}": make_volumes(seed=i) for i in range(3)}
+    reference, _ = api.segment_volumes(volumes, "test", side="left+right")
+
+    def fail(*_args, **_kwargs):
+        raise AssertionError("file written")
+
+    monkeypatch.setattr(api.Volume, "save", fail)
+    monkeypatch.setattr(api.Labels, "save", fail)
+    segmented, labels = api.segment_volumes(volumes, "test", side="left+right", exchange=api.MEMORY_EXCHANGE, batch_size=2)
+    assert all(np.array_equal(segmented[name].array, reference[name].array) for name in volumes)
+    assert labels.data == "labels"
+
+
+def test_register_backend(make_volumes, monkeypatch):
+    """Backends are pluggable, and checked before segmenting."""
+    monkeypatch.setattr(api, "BACKENDS", dict(api.BACKENDS))
+    monkeypatch.setattr(api, "_pull_if_not_exists", lambda model: pytest.fail("pulled"))
+    calls = []
+
+    def run(model, indir, outdir, *, exchange, device, options, tracer):  # pylint: disable=unused-argument
+        calls.append((model, device))
+        api._run_dummy(model, indir, outdir, exchange=exchange)
+
+    api.register_backend("custom", run)
+    segmented, _ = api.segment_volumes({"case": make_volumes()}, "thigh-model3", side="left+right", backend="custom", devices=["cpu"])
+    assert calls == [("thigh-model3", "cpu")]
+    assert segmented["case"].shape == make_volumes()[0].shape
+
+    with pytest.raises(ValueError, match="Unknown backend"):
+        api.segment_volumes({"case": make_volumes()}, "thigh-model3", backend="other")
+    with pytest.raises(ValueError, match="in memory"):
+        api.segment_volumes({"case": make_volumes()}, "thigh-model3", backend="custom", exchange=api.MEMORY_EXCHANGE)
+    with pytest.raises(ValueError, match="single in-process worker"):
+        api.segment_volumes({"case": make_volumes()}, "test", exchange=api.MEMORY_EXCHANGE, workers=2)
+    with pytest.raises(ValueError, match="only on the `test` backend"):
+        api.segment_volumes({"case": make_volumes()}, "test", backend="docker")
+
+
+class FakePredictor:  # pylint: disable=too-few-public-methods
+    """Predictor thresholding the first volume."""
+
+    instances = []
+
+    def __init__(self, folder, device=None, *, mixed_precision=True):
+        """Load the model."""
+        self.folder = folder
+        self.device = device
+        self.mixed_precision = mixed_precision
+        self.requests = []
+        self.instances.append(self)
+
+    def predict(self, volumes, *, folds=None, disable_tta=None, step_size=None):
+        """Return the segmentation of a case."""
+        self.requests.append((len(volumes), folds, disable_tta, step_size))
+        return (volumes[0].array > 0.5).astype("uint8")
+
+
+@pytest.mark.parametrize("exchange", [".nii", api.MEMORY_EXCHANGE])
+def test_torch_backend(tmp_path, make_volumes, monkeypatch, exchange):
+    """The torch backend runs in process, and loads each model once per device."""
+    folder = tmp_path / models.get_model("thigh-model3")["nnunet_folder"]
+    folder.mkdir(parents=True)
+    (folder / "labels.txt").write_text("thigh labels", encoding="utf-8")
+    monkeypatch.setenv("MUSEGAI_NNUNET_MODELS", str(tmp_path))
+    monkeypatch.setattr(nnunet, "Predictor", FakePredictor)
+    monkeypatch.setattr(FakePredictor, "instances", [])
+    monkeypatch.setattr(api, "_pull_if_not_exists", lambda model: pytest.fail("pulled"))
+    nnunet.clear_cache()
+
+    volumes = {f"case{i}": make_volumes(seed=i) for i in range(2)}
+    for _ in range(2):
+        segmented, labels = api.segment_volumes(volumes, "thigh-model3", side="left+right", backend="torch", exchange=exchange, devices=["cpu"], preset="fast")
+    assert labels.data == "thigh labels"
+    assert all(np.array_equal(segmented[name].array, volumes[name][0].array > 0.5) for name in volumes)
+
+    assert len(FakePredictor.instances) == 1
+    predictor = FakePredictor.instances[0]
+    assert predictor.device == "cpu" and predictor.mixed_precision
+    # each part of each case, twice
+    assert predictor.requests == [(2, [0], True, 0.7)] * 8
+    nnunet.clear_cache()
@@ -0,0 +1,31 @@
+"""Smoke tests of the benchmark scripts."""
+
+from __future__ import annotations
+
+import pathlib
+import subprocess
+import sys
+
+BENCHMARKS = pathlib.Path(__file__).parents[1] / "benchmarks"
+
+
+def test_presets(tmp_path, make_volumes):
+    """The presets are evaluated against the `full` preset."""
+    for i, vol in enumerate(make_volumes()):
+        vol.save(tmp_path / f"volume_{i}.mha")
+    command = [sys.executable, BENCHMARKS / "presets.py", tmp_path / "volume_0.mha", tmp_path / "volume_1.mha", "--model", "test"]
+    result = subprocess.run(command, capture_output=True, text=True, check=True)
+    for preset in ["fast", "balanced", "full"]:
+        assert f"{preset}:" in result.stdout
+    assert "mean Dice 1.000" in result.stdout
+
+
+def test_pipeline(tmp_path):
+    """The pipeline benchmark stores a baseline and compares with it."""
+    baseline = tmp_path / "baseline.json"
+    command = [sys.executable, BENCHMARKS / "pipeline.py", "--shape", "20", "12", "8", "--repeat", "1"]
+    subprocess.run([*command, "--save-baseline", baseline], capture_output=True, text=True, check=True)
+    result = subprocess.run([*command, "--baseline", baseline, "--tolerance", "1000"], capture_output=True, text=True, check=True)
+    for step in ["save .nii.gz", "load .mha", "load segmentation .mseg", "split", "heal", "segment (test model)"]:
+        assert f"{step}:" in result.stdout
+    assert "x baseline time" in result.stdout
@@ -0,0 +1,92 @@
+"""Test the segmentation cache."""
+# pylint: disable=protected-access
+
+from __future__ import annotations
+
+import os
+
+import numpy as np
+import pytest
+
+from musegai import api
+from musegai.cache import SegmentationCache
+
+
+@pytest.fixture(name="runs")
+def fixture_runs(monkeypatch):
+    """Record the number of input files of each inference run."""
+    runs = []
+    run_model = api._run_model
+
+    def record(model, indir, outdir, **kwargs):
+        runs.append(len(list(indir.iterdir())))
+        run_model(model, indir, outdir, **kwargs)
+
+    monkeypatch.setattr(api, "_run_model", record)
+    return runs
+
+
+def test_cache_hit(tmp_path, make_volumes, runs):
+    """Cached cases are served without inference."""
+    cache = SegmentationCache(tmp_path / "cache")
+    volumes = {"case": make_volumes()}
+    segmented, _ = api.segment_volumes(volumes, "test", side="left+right", cache=cache)
+    assert runs == [4]
+    assert cache.stats == {"hits": 0, "misses": 1, "entries": 1, "size": cache.stats["size"]}
+
+    # another name, same content
+    cached, labels = api.segment_volumes({"other": volumes["case"]}, "test", side="left+right", cache=cache)
+    assert runs == [4]
+    assert cache.hits == 1
+    assert labels.data == "labels"
+    assert np.array_equal(cached["other"].array, segmented["case"].array)
+
+    # another side is another case
+    api.segment_volumes(volumes, "test", side="left", cache=cache)
+    assert runs == [4, 2]
+    assert cache.stats["entries"] == 2
+
+
+def test_cache_deduplication(tmp_path, make_volumes, runs):
+    """Identical cases of a batch are segmented once, also across chunks."""
+    cache = SegmentationCache(tmp_path / "cache")
+    volumes = {"case1": make_volumes(seed=1), "case2": make_volumes(seed=2), "copy1": make_volumes(seed=1), "copy2": make_volumes(seed=2)}
+    segmented, _ = api.segment_volumes(volumes, "test", side="left+right", cache=cache, batch_size=1)
+    assert runs == [4, 4]
+    assert list(segmented) == list(volumes)
+    assert np.array_equal(segmented["copy1"].array, segmented["case1"].array)
+    assert np.array_equal(segmented["copy2"].array, segmented["case2"].array)
+    assert cache.stats["entries"] == 2
+
+
+def test_cache_eviction(tmp_path, make_volumes):
+    """The least recently used entries are evicted."""
+    cache = SegmentationCache(tmp_path / "cache")
+    labels = api.Labels("labels")
+    keys = []
+    for seed in range(3):
+        vols = make_volumes(seed=seed)
+        keys.append(cache.key(vols, "test", "left+right"))
+        cache.put(keys[-1], vols[0], labels)
+        os.utime(cache.directory / keys[-1], (seed, seed))
+    size = cache.stats["size"]
+
+    # use the oldest entry
+    assert cache.get(keys[0]) is not None
+    cache.max_size = size * 2 // 3
+    cache.evict()
+    assert cache.get(keys[1]) is None
+    assert cache.get(keys[0]) is not None and cache.get(keys[2]) is not None
+
+
+def test_cache_key(make_volumes):
+    """The key depends on the content, not on the memory layout."""
+    vols = make_volumes()
+    fortran = [api.Volume(np.asfortranarray(vol.array), **vol.metadata) for vol in vols]
+    assert SegmentationCache.key(vols, "test", "left") == SegmentationCache.key(fortran, "test", "left")
+    assert SegmentationCache.key(vols, "test", "left") != SegmentationCache.key(vols, "test", "right")
+    shifted = [api.Volume(vol.array, origin=(1.0, 0.0, 0.0), spacing=vol.spacing, transform=vol.transform) for vol in vols]
+    assert SegmentationCache.key(vols, "test", "left") != SegmentationCache.key(shifted, "test", "left")
+    options = api._inference_options("fast")
+    assert SegmentationCache.key(vols, "test", "left", options) != SegmentationCache.key(vols, "test", "left")
+    assert SegmentationCache.key(vols, "test", "left", dict(reversed(options.items()))) == SegmentationCache.key(vols, "test", "left", options)
@@ -0,0 +1,118 @@
+"""Test the command line interface."""
+
+from __future__ import annotations
+
+from click.testing import CliRunner
+
+from musegai import api
+from musegai.cli import cli
+
+
+def test_directory_scan(tmp_path, make_volumes, monkeypatch):
+    """Only headers are read during the scan, voxel data of finished cases is never loaded."""
+    indir = tmp_path / "in"
+    indir.mkdir()
+    for name in ["alpha_", "beta_"]:
+        for i, vol in enumerate(make_volumes()):
+            vol.save(indir / f"{name}{i}.mha")
+    make_volumes(shape=(10, 12, 8))[0].save(indir / "invalid_0.mha")
+    make_volumes()[0].save(indir / "invalid_1.mha")
+    outdir = tmp_path / "out"
+    outdir.mkdir()
+    (outdir / "alpha_.mha").touch()
+
+    loaded = []
+    load = api.Volume.load
+    monkeypatch.setattr(api.Volume, "load", classmethod(lambda cls, file, ext=None, **kwargs: loaded.append(file) or load(file, ext, **kwargs)))
+
+    result = CliRunner().invoke(cli, [str(indir), "--dest", str(outdir), "--model", "test"])
+    assert not result.exit_code, result.output
+    assert "Invalid volume pair: invalid_" in result.output
+    assert {file.name for file in loaded if file.parent == indir} == {"beta_0.mha", "beta_1.mha"}
+    assert api.Volume.load(outdir / "beta_.mha").shape == (20, 12, 8)
+
+
+def test_load_header(tmp_path, make_volumes):
+    """The header matches the loaded volume."""
+    vol = make_volumes(shape=(7, 5, 3))[0]
+    vol.save(tmp_path / "vol.nii.gz")
+    header = api.Volume.load_header(tmp_path / "vol.nii.gz")
+    loaded = header.load()
+    assert header.shape == loaded.shape == (7, 5, 3)
+    assert header.spacing == loaded.spacing
+    assert header.info == {"extension": ".nii.gz", "name": "vol"}
+
+
+def test_save_errors(tmp_path, make_volumes):
+    """Failures to save are reported per file, the other results are saved."""
+    for name in ["alpha_", "beta_"]:
+        for i, vol in enumerate(make_volumes()):
+            vol.save(tmp_path / f"{name}{i}.mha")
+    outdir = tmp_path / "out"
+    (outdir / "alpha_.mha").mkdir(parents=True)
+
+    result = CliRunner().invoke(cli, [str(tmp_path), "--dest", str(outdir), "--model", "test", "--io-workers", "2"])
+    assert result.exit_code == 1
+    assert f"Failed to save {outdir / 'alpha_.mha'}" in result.output
+    assert (outdir / "beta_.mha").is_file()
+
+
+def test_output_format(tmp_path, make_volumes):
+    """The segmentations are saved in the compact label map format, and label maps are not taken for volumes."""
+    for i, vol in enumerate(make_volumes()):
+        vol.save(tmp_path / f"alpha_{i}.mha")
+    vol = make_volumes()[0]
+    segmentation = api.Volume(vol.array.astype("uint8"), **vol.metadata)
+    for name in ["gamma_0", "gamma_1", "gamma_"]:
+        segmentation.save(tmp_path / f"{name}.mseg")
+    result = CliRunner().invoke(cli, [str(tmp_path), "--model", "test", "--output-format", ".mseg"])
+    assert not result.exit_code, result.output
+    assert "Found 1 volume pair(s)" in result.output
+    segmentation = api.Volume.load(tmp_path / "alpha_.mseg")
+    assert segmentation.shape == (20, 12, 8) and segmentation.array.dtype == "uint8"
+
+    result = CliRunner().invoke(cli, ["metrics", str(tmp_path), "--output", str(tmp_path / "metrics.csv")])
+    assert not result.exit_code, result.output
+    assert "Computing the metrics of 1 segmented volume pair(s)" in result.output
+
+
+def test_inference_options(tmp_path, make_volumes, monkeypatch):
+    """The preset and the overriding options are passed to `segment_volumes`."""
+    for i, vol in enumerate(make_volumes()):
+        vol.save(tmp_path / f"alpha_{i}.mha")
+    received = {}
+    segment_volumes = api.segment_volumes
+    monkeypatch.setattr(api, "segment_volumes", lambda *args, **kwargs: received.update(kwargs) or segment_volumes(*args, **kwargs))
+
+    result = CliRunner().invoke(cli, [str(tmp_path), "--model", "test", "--preset", "fast", "-O", "folds=[0, 1]", "-O", "step_size=0.6"])
+    assert not result.exit_code, result.output
+    assert received["preset"] == "fast"
+    assert received["options"] == {"folds": [0, 1], "step_size": 0.6}
+
+    result = CliRunner().invoke(cli, [str(tmp_path), "--model", "test", "-O", "tta=false"])
+    assert result.exit_code == 2
+    assert "Expecting KEY=VALUE" in result.output
+
+
+def test_preview(tmp_path, make_volumes, monkeypatch):
+    """The previews are saved first, and the volumes are loaded once for the full-resolution pass, chunk by chunk."""
+    for name in ["alpha_", "beta_"]:
+        for i, vol in enumerate(make_volumes()):
+            vol.save(tmp_path / f"{name}{i}.mha")
+    loaded = []
+    load = api.VolumeHeader.load
+    monkeypatch.setattr(api.VolumeHeader, "load", lambda self, **kwargs: loaded.append(self.file.name) or load(self, **kwargs))
+
+    result = CliRunner().invoke(cli, [str(tmp_path), "--dest", str(tmp_path / "out"), "--model", "test", "--preview", "--refine", "--batch-size", "1"])
+    assert not result.exit_code, result.output
+    assert result.output.count("Preview:") == result.output.count("Full resolution:") == 2
+    assert result.output.index("Preview:") < result.output.index("Full resolution:")
+    # the second chunk is loaded after the first one is segmented
+    assert loaded == ["alpha_0.mha", "alpha_1.mha", "beta_0.mha", "beta_1.mha"]
+    assert api.Volume.load(tmp_path / "out" / "alpha_preview.mha").shape == api.Volume.load(tmp_path / "out" / "alpha_.mha").shape == (20, 12, 8)
+
+    # the previews are not taken for volumes, also with numbered names (of DICOM series)
+    for name in ["PAT01_5_", "PAT02_5_"]:
+        make_volumes()[0].save(tmp_path / f"{name}preview.mha")
+    result = CliRunner().invoke(cli, [str(tmp_path), "--dest", str(tmp_path / "again"), "--model", "test"])
+    assert "Found 2 volume pair(s)" in result.output and "PAT" not in result.output
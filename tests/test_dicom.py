@@ -0,0 +1,101 @@
+"""Test the reading of DICOM series."""
+
+from __future__ import annotations
+
+import numpy as np
+import pytest
+import SimpleITK as sitk
+from click.testing import CliRunner
+
+from musegai import api, dicom
+from musegai.cli import cli
+
+
+def write_series(directory, array, *, uid, echo_time, study="1.2.3", patient="PAT01", number=5, origin=(10.0, 20.0, 30.0), spacing=(0.8, 0.9, 3.0)):
+    """Write an (x, y, z) array as DICOM slices, named in the reverse order of the slices."""
+    directory.mkdir(parents=True, exist_ok=True)
+    writer = sitk.ImageFileWriter()
+    writer.KeepOriginalImageUIDOn()
+    size = array.shape[2]
+    for k in range(size):
+        image = sitk.GetImageFromArray(array[:, :, k : k + 1].T)
+        image.SetSpacing(spacing)
+        position = (origin[0], origin[1], origin[2] + k * spacing[2])
+        tags = {
+            "0008|0060": "MR",
+            "0008|0018": f"{uid}.{echo_time}.{k}",
+            "0010|0020": patient,
+            "0018|0081": str(echo_time),
+            "0020|000d": study,
+            "0020|000e": uid,
+            "0020|0011": str(number),
+            "0020|0013": str(k + 1),
+            "0020|0032": "\\".join(str(value) for value in position),
+            "0020|0037": "1\\0\\0\\0\\1\\0",
+        }
+        for tag, value in tags.items():
+            image.SetMetaData(tag, value)
+        writer.SetFileName(str(directory / f"IM{echo_time}_{size - k:04d}.dcm"))
+        writer.Execute(image)
+
+
+@pytest.fixture(name="arrays")
+def fixture_arrays():
+    """Return the in-phase and out-of-phase arrays of a Dixon pair."""
+    rng = np.random.default_rng(0)
+    return [rng.integers(0, 1000, (12, 10, 6), dtype="int16") for _ in range(2)]
+
+
+@pytest.fixture(name="studies")
+def fixture_studies(tmp_path, arrays):
+    """Write two studies: with both echoes in one series, and with one series per echo (in subdirectories)."""
+    root = tmp_path / "dicom"
+    write_series(root, arrays[0], uid="1.2.3.4", echo_time=1.95)
+    write_series(root, arrays[1], uid="1.2.3.4", echo_time=2.75)
+    write_series(root / "ip", arrays[0], uid="1.2.5.1", echo_time=2.0, study="1.2.5", patient="PAT 02", number=7)
+    write_series(root / "op", arrays[1], uid="1.2.5.2", echo_time=2.7, study="1.2.5", patient="PAT 02", number=8)
+    write_series(root / "other", arrays[1][:, :, :4], uid="1.2.5.3", echo_time=2.75, study="1.2.5", patient="PAT 02", number=9)
+    (root / "notes.txt").write_text("not DICOM", encoding="utf-8")
+    return root
+
+
+def test_index(studies, arrays):
+    """The slices are grouped by series and echo, sorted along the slice axis, and paired by echo time."""
+    series = dicom.index_directory(studies)
+    assert [(item.patient, item.number, item.echo_time, item.shape) for item in series] == [
+        ("PAT 02", "7", 2.0, (12, 10, 6)),
+        ("PAT 02", "8", 2.7, (12, 10, 6)),
+        ("PAT 02", "9", 2.75, (12, 10, 4)),
+        ("PAT01", "5", 1.95, (12, 10, 6)),
+        ("PAT01", "5", 2.75, (12, 10, 6)),
+    ]
+    assert series[0].origin == pytest.approx((10.0, 20.0, 30.0)) and series[0].spacing == pytest.approx((0.8, 0.9, 3.0))
+    assert [file.name for file in series[0].files[:2]] == ["IM2.0_0006.dcm", "IM2.0_0005.dcm"]
+
+    pairs = dicom.pair_series(series)
+    assert {name: [item.echo_time for item in pair] for name, pair in pairs.items()} == {"PAT-02_7_": [2.0, 2.7], "PAT01_5_": [1.95, 2.75]}
+    loaded = dicom.load(pairs["PAT01_5_"][1], workers=3)
+    assert loaded.flags.f_contiguous and np.array_equal(loaded, arrays[1])
+
+
+def test_volume(studies, arrays):
+    """A series is loaded as a volume from one of its slices, or from its directory."""
+    vol = api.Volume.load(studies / "op" / "IM2.7_0003.dcm")
+    assert np.array_equal(vol.array, arrays[1])
+    assert vol.spacing == pytest.approx((0.8, 0.9, 3.0))
+    header = api.Volume.load_header(studies / "ip")
+    assert header.shape == (12, 10, 6) and header.dtype == np.int16
+    assert np.array_equal(header.load().array, arrays[0])
+    with pytest.raises(ValueError, match="Expecting a single DICOM series"):
+        api.Volume.load(studies)
+
+
+def test_segment(studies, tmp_path):
+    """The DICOM series of a directory are segmented in pairs, without intermediate files."""
+    result = CliRunner().invoke(cli, [str(studies), "--dest", str(tmp_path / "out"), "--model", "test"])
+    assert not result.exit_code, result.output
+    assert "Found 2 volume pair(s)" in result.output
+    for name in ["PAT-02_7_", "PAT01_5_"]:
+        segmentation = api.Volume.load(tmp_path / "out" / f"{name}.nii.gz")
+        assert segmentation.shape == (12, 10, 6)
+        assert segmentation.origin == pytest.approx((10.0, 20.0, 30.0))
@@ -0,0 +1,83 @@
+"""Test the queue of segmentation jobs, and its workers."""
+
+from __future__ import annotations
+
+import subprocess
+import sys
+import time
+
+from click.testing import CliRunner
+
+from musegai import api
+from musegai.cli import cli
+from musegai.jobs import JobQueue
+
+
+def test_claims(tmp_path):
+    """Each job is claimed by one worker, and by another one only once the lease of the first one expired."""
+    queue = JobQueue(tmp_path / "queue.db", lease=10, max_attempts=2)
+    assert queue.enqueue([(f"case{i}_", [f"case{i}_0.mha", f"case{i}_1.mha"], f"out/case{i}_.mha") for i in range(3)]) == 3
+    assert not queue.enqueue([("case0_", ["other_0.mha", "other_1.mha"], "out/case0_.mha")])  # same output
+
+    first = queue.claim("a", 2, now=0)
+    assert [job.name for job in first] == ["case0_", "case1_"] and first[0].files == ["case0_0.mha", "case0_1.mha"]
+    second = queue.claim("b", 2, now=1)
+    assert [job.name for job in second] == ["case2_"]
+    assert not queue.claim("b", 2, now=5)
+
+    # the heartbeat keeps the jobs of a worker, until it stops
+    assert queue.renew("a", first[:1], now=8) == 1 and queue.renew("b", second, now=8) == 1
+    assert queue.claim("b", 2, now=12) == first[1:]
+    assert not queue.renew("a", first[1:], now=13)
+    queue.finish("a", first[1])  # claimed by "b" meanwhile
+    assert queue.counts(now=13) == {"pending": 0, "running": 3, "done": 0, "failed": 0, "expired": 0}
+
+    queue.finish("a", first[0])
+    queue.release("b", first[1:], error="inference failed")
+    assert queue.counts(now=13) == {"pending": 0, "running": 1, "done": 1, "failed": 1, "expired": 0}
+    # the job of a worker that died is claimed again, up to `max_attempts` times
+    assert queue.claim("c", now=20) == second
+    assert not queue.claim("d", now=40)
+    assert [(job.name, error) for job, error in queue.failures()] == [("case1_", "inference failed"), ("case2_", "lease expired 2 time(s)")]
+
+
+def test_heartbeat(tmp_path):
+    """The leases are renewed while in the context of the heartbeat."""
+    queue = JobQueue(tmp_path / "queue.db", lease=0.3)
+    queue.enqueue([("case_", ["case_0.mha", "case_1.mha"], "case_.mha")])
+    jobs = queue.claim("a")
+    with queue.heartbeat("a", jobs, interval=0.05):
+        time.sleep(0.6)
+        assert not queue.claim("b")
+    time.sleep(0.4)
+    assert queue.claim("b") == jobs
+
+
+def test_workers(tmp_path, make_volumes):
+    """Several worker processes segment all jobs once, and exit once the queue is empty."""
+    indir = tmp_path / "in"
+    indir.mkdir()
+    names = ["alpha_", "beta_", "gamma_", "delta_", "epsilon_", "zeta_"]
+    for seed, name in enumerate(names):
+        for i, vol in enumerate(make_volumes(seed=seed)):
+            vol.save(indir / f"{name}{i}.mha")
+    outdir = tmp_path / "out"
+    queue_file = tmp_path / "queue.db"
+
+    result = CliRunner().invoke(cli, ["enqueue", str(queue_file), str(indir), "--dest", str(outdir), "--output-format", ".mseg"])
+    assert not result.exit_code, result.output
+    assert "Enqueued 6 new job(s)" in result.output
+    result = CliRunner().invoke(cli, ["enqueue", str(queue_file), str(indir), "--dest", str(outdir), "--output-format", ".mseg"])
+    assert "Enqueued 0 new job(s), 6 already queued" in result.output
+
+    command = [sys.executable, "-m", "musegai.cli", "worker", str(queue_file), "--model", "test", "--io-workers", "1", "--poll", "0.1"]
+    workers = [subprocess.Popen([*command, "--name", f"worker{i}"], stdout=subprocess.PIPE, text=True) for i in range(3)]  # pylint: disable=consider-using-with
+    outputs = [process.communicate(timeout=300)[0] for process in workers]
+    assert all(not process.returncode for process in workers), outputs
+    assert sum(int(output.split("Done: ")[1].split()[0]) for output in outputs) == 6
+
+    counts = JobQueue(queue_file).counts()
+    assert counts["done"] == 6 and not counts["pending"] and not counts["running"]
+    for name in names:
+        assert api.Volume.load(outdir / f"{name}.mseg").shape == (20, 12, 8)
+    assert (outdir / "labels.txt").is_file()
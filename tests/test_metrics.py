@@ -0,0 +1,81 @@
+"""Test the per-muscle metrics."""
+
+from __future__ import annotations
+
+import csv
+import pathlib
+
+import numpy as np
+import pytest
+from click.testing import CliRunner
+
+from musegai import api, metrics, models
+from musegai.cli import cli
+
+from .conftest import METADATA
+
+LABELS = api.Labels((pathlib.Path(__file__).parents[1] / "docker" / "labels_thigh.txt").read_text(encoding="utf-8"))
+
+
+def make_case(shape=(40, 12, 8), seed=0):
+    """Return a segmentation of two legs with three muscles each, and its Dixon volumes."""
+    rng = np.random.default_rng(seed)
+    segmentation = np.zeros(shape, dtype="uint8")
+    segmentation[2:8] = 1
+    segmentation[8:14, :6] = 2
+    segmentation[22:30] = 1
+    segmentation[30:38, 6:] = 3
+    in_phase = rng.uniform(100, 200, shape)
+    out_of_phase = in_phase * rng.uniform(0.5, 1.0, shape)
+    return api.Volume(segmentation, **METADATA), [api.Volume(in_phase, **METADATA), api.Volume(out_of_phase, **METADATA)]
+
+
+def test_label_names():
+    """The ITK-SNAP label descriptions are parsed without the background."""
+    names = metrics.label_names(LABELS)
+    assert names == {int(key): value for key, value in models.get_model("thigh-model3")["labels"].items()}
+    assert not metrics.label_names(api.Labels("labels"))
+
+
+def test_label_statistics():
+    """The statistics match those computed label by label."""
+    segmentation, volumes = make_case()
+    rows = metrics.label_statistics(segmentation, volumes, labels=LABELS)
+    assert [(row["name"], row["side"]) for row in rows] == [("VL", "right"), ("VL", "left"), ("VI", "right"), ("VM", "left")]
+
+    array = segmentation.array
+    halves = {"right": np.arange(array.shape[0])[:, None, None] < 20, "left": np.arange(array.shape[0])[:, None, None] >= 20}
+    for row in rows:
+        mask = (array == row["label"]) & halves[row["side"]]
+        assert row["voxels"] == np.count_nonzero(mask)
+        assert row["volume_ml"] == pytest.approx(np.count_nonzero(mask) * 2 / 1000)
+        for channel, volume in zip(metrics.CHANNELS, volumes):
+            assert row[f"{channel}_mean"] == pytest.approx(volume.array[mask].mean())
+            for percentile in metrics.PERCENTILES:
+                assert row[f"{channel}_p{percentile}"] == pytest.approx(np.percentile(volume.array[mask], percentile))
+        in_phase, out_of_phase = volumes[0].array[mask], volumes[1].array[mask]
+        assert row["fat_fraction"] == pytest.approx(np.mean((in_phase - out_of_phase) / (2 * in_phase)))
+
+    rows = metrics.label_statistics(segmentation, side="left")
+    assert [(row["label"], row["name"], row["side"]) for row in rows] == [(1, "label1", "left"), (2, "label2", "left"), (3, "label3", "left")]
+    assert "fat_fraction" not in rows[0]
+
+
+def test_metrics_command(tmp_path):
+    """The metrics of all segmented cases of a directory are saved in one table."""
+    for name, seed in [("alpha_", 0), ("beta_", 1), ("unsegmented_", 2)]:
+        segmentation, volumes = make_case(seed=seed)
+        for i, vol in enumerate(volumes):
+            vol.save(tmp_path / f"{name}{i}.mha")
+        if name != "unsegmented_":
+            segmentation.save(tmp_path / f"{name}.mha")
+    LABELS.save(tmp_path / "labels.txt")
+
+    result = CliRunner().invoke(cli, ["metrics", str(tmp_path), "--output", str(tmp_path / "metrics.csv"), "--workers", "2"])
+    assert not result.exit_code, result.output
+    with open(tmp_path / "metrics.csv", encoding="utf-8") as fp:
+        rows = list(csv.DictReader(fp))
+    expected = [("alpha_", "VL", "right"), ("alpha_", "VL", "left"), ("alpha_", "VI", "right"), ("alpha_", "VM", "left")]
+    assert [(row["case"], row["name"], row["side"]) for row in rows[:4]] == expected
+    assert len(rows) == 8
+    assert 0 < float(rows[0]["fat_fraction"]) < 0.5
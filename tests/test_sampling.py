@@ -0,0 +1,84 @@
+"""Test the patch sampling around the annotated slices, of the nnU-Net trainer (numpy only)."""
+
+from __future__ import annotations
+
+import importlib.util
+import pathlib
+
+import numpy as np
+import pytest
+
+IGNORE = 4  # ignore label: the number of classes
+
+
+@pytest.fixture(name="sampling", scope="module")
+def fixture_sampling():
+    """Import the sampling module of the Docker image."""
+    file = pathlib.Path(__file__).parents[1] / "docker" / "sparse_sampling.py"
+    spec = importlib.util.spec_from_file_location("sparse_sampling", file)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture(name="dataset")
+def fixture_dataset(tmp_path):
+    """Return a preprocessed dataset of three cases (two channels, 30 slices), annotated on every 10th slice."""
+    rng = np.random.default_rng(0)
+    for case in ["alpha", "beta", "gamma"]:
+        seg = np.full((30, 16, 16), IGNORE, dtype="float32")
+        seg[5::10] = rng.integers(0, IGNORE, (3, 16, 16))
+        seg[:, :2] = -1  # outside of the image
+        np.savez(tmp_path / f"{case}.npz", data=np.concatenate([rng.random((2, 30, 16, 16), dtype="float32"), seg[np.newaxis]]))
+    return {case: {"data_file": str(tmp_path / f"{case}.npz")} for case in ["alpha", "beta", "gamma"]}
+
+
+def test_slice_index(sampling, dataset, tmp_path):
+    """The labelled voxels per slice are computed once, and cached next to the data."""
+    index = sampling.index_dataset(dataset, IGNORE, workers=2)
+    assert list(index) == ["alpha", "beta", "gamma"]
+    assert np.flatnonzero(index["alpha"]).tolist() == [5, 15, 25]
+    assert index["alpha"][5] == 14 * 16
+
+    (tmp_path / "alpha.npz").unlink()
+    assert np.array_equal(sampling.load_slice_index(dataset["alpha"]["data_file"], IGNORE), index["alpha"])
+
+
+@pytest.mark.parametrize("size, margin", [(8, 2), (8, 0), (36, 2)])
+def test_slice_start(sampling, size, margin):
+    """The drawn slice lies in the central half of the final patch, when the patch fits in the range of starts."""
+    rng = np.random.RandomState(0)  # pylint: disable=no-member
+    # as `DataLoader3D`, for 30 slices
+    need_to_pad = max(2 * margin, size + 2 * margin - 30)
+    lower, upper = -need_to_pad // 2, 30 + need_to_pad // 2 + need_to_pad % 2 - size - 2 * margin
+    for index in range(30):
+        starts = {sampling.slice_start(index, lower, upper, margin, size, rng=rng) for _ in range(20)}
+        assert all(lower <= start <= upper for start in starts)
+        if lower <= index - margin - size // 2 <= upper:
+            assert all(size // 4 <= index - start - margin < size - size // 4 for start in starts)
+
+
+def test_voxel_start(sampling):
+    """The oversampled voxel stays inside the final patch, also near the borders of the volume."""
+    margin, final_patch_size = np.array([2, 4, 4]), np.array([8, 8, 8])
+    # as `DataLoader3D`, for a volume (30, 24, 24)
+    lower, upper = -margin, np.array([30, 24, 24]) + margin - final_patch_size - 2 * margin
+    for voxel in np.ndindex(30, 24, 24):
+        start = sampling.voxel_start(voxel, lower, upper, margin, final_patch_size)
+        assert np.all(start >= lower) and np.all(start <= upper)
+        offset = np.asarray(voxel) - start - margin
+        assert np.all(offset >= 0) and np.all(offset < final_patch_size), voxel
+    # centered if possible
+    assert sampling.voxel_start((15, 12, 12), lower, upper, margin, final_patch_size).tolist() == [9, 4, 4]
+    # as close as possible when the final patch cannot contain the voxel
+    assert sampling.voxel_start((1, 8, 8), np.array([3, 0, 0]), np.array([18, 8, 8]), margin, final_patch_size).tolist() == [3, 0, 0]
+
+
+def test_labelled_in_patch(sampling):
+    """Only the labelled voxels of the final patch (without the margin) are counted."""
+    seg = np.full((12, 12, 12), IGNORE, dtype="float32")
+    seg[:, :, 0] = 1  # in the margin only
+    seg[5] = np.where(np.arange(12) < 3, -1, 2)[:, np.newaxis]
+    assert sampling.labelled_in_patch(seg, (2, 2, 2), (8, 8, 8), IGNORE) == 7 * 8
+    assert sampling.labelled_in_patch(seg, (0, 0, 0), (12, 12, 12), IGNORE) == 11 * 12 + 9 * 12
+    assert not sampling.labelled_in_patch(np.full((12, 12, 12), IGNORE), (2, 2, 2), (8, 8, 8), IGNORE)
@@ -0,0 +1,91 @@
+"""Test the inference server and its client."""
+# pylint: disable=protected-access
+
+from __future__ import annotations
+
+import json
+import urllib.error
+import urllib.request
+
+import pytest
+
+from musegai import api
+from musegai.server import InferenceServer
+
+
+@pytest.fixture(name="server")
+def fixture_server(tmp_path):
+    """Local inference server running the test model."""
+    server = InferenceServer("test", tmp_path)
+    server.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_find_server(server, monkeypatch):
+    """The server is found if it serves the requested model."""
+    assert api._find_server("test", server.url)["root"] == str(server.root)
+    assert api._find_server("thigh-model3", server.url) is None
+    monkeypatch.setenv("MUSEGAI_SERVER", server.url)
+    assert api._find_server("test")["url"] == server.url
+    monkeypatch.delenv("MUSEGAI_SERVER")
+    assert api._find_server("test") is None
+
+
+def test_segment_volumes_with_server(server, make_volumes, monkeypatch):
+    """Inference is delegated to the running server."""
+    requests = []
+    monkeypatch.setattr(server, "predict", lambda indir, outdir, exchange, options: requests.append(indir) or api._run_model("test", indir, outdir, exchange=exchange))
+    segmented, labels = api.segment_volumes({"case": make_volumes()}, "test", side="left+right", server=server.url, exchange=".nii")
+    assert len(requests) == 1
+    assert requests[0].is_relative_to(server.root)
+    assert segmented["case"].shape == (20, 12, 8)
+    assert labels.data == "labels"
+    # temporary files are removed
+    assert not list(server.root.iterdir())
+
+
+def test_server_options(server, make_volumes, monkeypatch):
+    """Per-request inference options are passed to the server, the others are fixed when it starts."""
+    requests = []
+    monkeypatch.setattr(server, "predict", lambda indir, outdir, exchange, options: requests.append(options) or api._run_model("test", indir, outdir, exchange=exchange))
+    api.segment_volumes({"case": make_volumes()}, "test", side="left+right", server=server.url, preset="fast")
+    assert requests == [api.PRESETS["fast"]]
+    with pytest.raises(ValueError, match="fixed when the server starts"):
+        api.segment_volumes({"case": make_volumes()}, "test", side="left+right", server=server.url, options={"disable_mixed_precision": True})
+    with pytest.raises(RuntimeError, match="Unsupported inference options"):
+        api._request_server(api._find_server("test", server.url), server.root / "in", server.root / "out", options={"num_threads_nifti_save": 1})
+
+
+def test_server_predict(server, make_volumes):
+    """The server runs the model on the requested folder."""
+    segmented, labels = api.segment_volumes({"case": make_volumes()}, "test", side="left+right", server=server.url)
+    reference, _ = api.segment_volumes({"case": make_volumes()}, "test", side="left+right")
+    assert (segmented["case"].array == reference["case"].array).all()
+    assert labels.data == "labels"
+
+
+def test_server_errors(server, make_volumes, monkeypatch):
+    """Failing predictions and folders outside the root are reported as errors."""
+    run_model = api._run_model
+
+    def fail(*args, server=None, **kwargs):
+        if server is not None:
+            # client side
+            run_model(*args, server=server, **kwargs)
+            return
+        raise ValueError("inference failed")
+
+    monkeypatch.setattr(api, "_run_model", fail)
+    with pytest.raises(RuntimeError, match="inference failed"):
+        api.segment_volumes({"case": make_volumes()}, "test", side="left+right", server=server.url)
+    assert not list(server.root.iterdir())
+
+    # a sibling directory sharing the prefix of the root
+    request = {"input": f"../{server.root.name}_other/in", "output": "out"}
+    request = urllib.request.Request(f"{server.url}/predict", data=json.dumps(request).encode())
+    with pytest.raises(urllib.error.HTTPError) as excinfo:
+        urllib.request.urlopen(request)  # pylint: disable=consider-using-with
+    assert excinfo.value.code == 400
+    assert "inside the root directory" in excinfo.value.read().decode()
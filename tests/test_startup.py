@@ -0,0 +1,29 @@
+"""Test the startup time of the command line interface."""
+
+from __future__ import annotations
+
+import subprocess
+import sys
+
+HEAVY_MODULES = ["numpy", "SimpleITK", "docker", "asyncio"]
+
+
+def import_times(statement):
+    """Return the cumulative import time (in seconds) of each module imported by the statement in a new interpreter."""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", statement], capture_output=True, text=True, check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        if line.startswith("import time:") and "cumulative" not in line:
+            _, cumulative, module = line[len("import time:") :].split("|")
+            times[module.strip()] = int(cumulative) / 1e6
+    return times, result.stdout
+
+
+def test_startup():
+    """Listing the models imports neither the heavy dependencies nor the model code."""
+    statement = "from click.testing import CliRunner; from musegai import cli; print(CliRunner().invoke(cli.cli, []).output)"
+    times, output = import_times(statement)
+    assert "thigh-model3" in output
+    assert not set(HEAVY_MODULES) & set(times)
+    # generous bound, the heavy dependencies take several hundred milliseconds
+    assert times["musegai.cli"] < 0.25
@@ -0,0 +1,139 @@
+"""Test streaming the segmentations, and resuming interrupted runs."""
+# pylint: disable=protected-access
+
+from __future__ import annotations
+
+import json
+import threading
+
+import numpy as np
+import pytest
+
+from musegai import api
+
+
+@pytest.fixture(name="register")
+def fixture_register(monkeypatch):
+    """Register backends for the duration of a test."""
+    monkeypatch.setattr(api, "BACKENDS", dict(api.BACKENDS))
+    monkeypatch.setattr(api, "_pull_if_not_exists", lambda model: pytest.fail("pulled"))
+    monkeypatch.setattr(api, "STREAM_INTERVAL", 0.01)
+    return api.register_backend
+
+
+def threshold(model, indir, outdir, *, exchange, device, options, tracer, after_case=None):  # pylint: disable=unused-argument
+    """Segment the cases one by one, thresholding the first volume."""
+    for name, files in api._exchanged_cases(indir, exchange).items():
+        vols = api._receive_volumes(files)
+        api._send_volume(api.Volume((vols[0].array > 0.5).astype("uint8"), **vols[0].metadata), outdir / f"{name}{exchange}")
+        if after_case is not None:
+            after_case(name)
+    api._send_volume(api.Labels("labels"), outdir / "labels.txt")
+
+
+def test_segment_volumes_iter(make_volumes, register):
+    """The cases are yielded while the model segments the others."""
+    received = threading.Event()
+    waited = []
+
+    def after_case(name):
+        if name.endswith("_right"):
+            # the case is complete
+            waited.append(received.wait(5))
+            received.clear()
+
+    register("stepwise", lambda *args, **kwargs: threshold(*args, after_case=after_case, **kwargs))
+    volumes = {f"case{letter}": make_volumes(seed=seed) for seed, letter in enumerate("abc")}
+    names = []
+    for name, vol in api.segment_volumes_iter(volumes, "thigh-model3", side="left+right", backend="stepwise", exchange=".nii", batch_size=2):
+        assert np.array_equal(vol.array, volumes[name][0].array > 0.5)
+        names.append(name)
+        received.set()
+    assert names == ["casea", "caseb", "casec"]
+    assert waited == [True] * 3
+
+
+def test_segment_volumes_iter_error(make_volumes, register):
+    """Errors of the segmentation are raised by the generator."""
+
+    def fail(*_args, **_kwargs):
+        raise RuntimeError("inference failed")
+
+    register("failing", fail)
+    with pytest.raises(RuntimeError, match="inference failed"):
+        list(api.segment_volumes_iter({"case": make_volumes()}, "thigh-model3", backend="failing"))
+
+
+def test_resume(tmp_path, make_volumes, register):
+    """A run interrupted during inference is resumed from its working directory."""
+    segmented = []
+
+    def interrupt(name):
+        segmented.append(name)
+        if name == "caseb_right":
+            raise RuntimeError("container died")
+
+    register("interrupted", lambda *args, **kwargs: threshold(*args, after_case=interrupt, **kwargs))
+    register("resumed", lambda *args, **kwargs: threshold(*args, after_case=segmented.append, **kwargs))
+    volumes = {f"case{letter}": make_volumes(seed=seed) for seed, letter in enumerate("abcd")}
+    workdir = tmp_path / "work"
+    with pytest.raises(RuntimeError, match="container died"):
+        api.segment_volumes(volumes, "thigh-model3", side="left+right", backend="interrupted", exchange=".nii", workdir=workdir)
+    assert (workdir / "chunk0000" / "out" / "caseb_right.nii").is_file()
+    # an output truncated by the interruption
+    (workdir / "chunk0000" / "out" / "casea_left.nii").write_bytes(b"truncated")
+
+    with pytest.raises(ValueError, match="another run"):
+        api.segment_volumes(volumes, "thigh-model3", side="left", backend="resumed", exchange=".nii", workdir=workdir)
+    segmented.clear()
+    results, labels = api.segment_volumes(volumes, "thigh-model3", side="left+right", backend="resumed", exchange=".nii", workdir=workdir)
+    assert segmented == ["casea_left", "casea_right", "casec_left", "casec_right", "cased_left", "cased_right"]
+    assert labels.data == "labels"
+    assert all(np.array_equal(results[name].array, volumes[name][0].array > 0.5) for name in volumes)
+    assert not list(workdir.iterdir())
+
+
+def test_resume_all(tmp_path, make_volumes, register):
+    """The inference is skipped if all cases of a chunk were segmented by the interrupted run."""
+    register("complete", threshold)
+    volumes = {"case": make_volumes()}
+    workdir = tmp_path / "work"
+    outdir = workdir / "chunk0000" / "out"
+    outdir.mkdir(parents=True)
+    for part, vol in zip(["left", "right"], api._split_volume(volumes["case"][0], "left+right")):
+        api.Volume((vol.array > 0.5).astype("uint8"), **vol.metadata).save(outdir / f"case_{part}.nii.gz")
+    api.Labels("labels").save(outdir / "labels.txt")
+    (workdir / "chunk0000" / "cases.json").write_text(json.dumps({"case": api._fingerprint(volumes["case"])}))
+    (workdir / "run.json").write_text('{"model": "thigh-model3", "side": "left+right", "exchange": ".nii.gz", "options": {}, "crop": false}')
+
+    register("unused", lambda *args, **kwargs: pytest.fail("inference"))
+    results, labels = api.segment_volumes(volumes, "thigh-model3", side="left+right", backend="unused", workdir=workdir)
+    assert labels.data == "labels"
+    assert np.array_equal(results["case"].array, volumes["case"][0].array > 0.5)
+
+
+def test_resume_changed(tmp_path, make_volumes, register):
+    """The outputs of the cases whose volumes changed since the interrupted run are not resumed."""
+    segmented = []
+
+    def interrupt(name):
+        segmented.append(name)
+        if name == "caseb_right":
+            raise RuntimeError("container died")
+
+    register("interrupted", lambda *args, **kwargs: threshold(*args, after_case=interrupt, **kwargs))
+    register("resumed", lambda *args, **kwargs: threshold(*args, after_case=segmented.append, **kwargs))
+    volumes = {f"case{letter}": make_volumes(seed=seed) for seed, letter in enumerate("abc")}
+    workdir = tmp_path / "work"
+    with pytest.raises(RuntimeError, match="container died"):
+        api.segment_volumes(volumes, "thigh-model3", side="left+right", backend="interrupted", exchange=".nii", workdir=workdir)
+
+    # same shape and geometry, other voxels
+    volumes["casea"] = make_volumes(seed=10)
+    segmented.clear()
+    results, _ = api.segment_volumes(volumes, "thigh-model3", side="left+right", backend="resumed", exchange=".nii", workdir=workdir)
+    assert segmented == ["casea_left", "casea_right", "casec_left", "casec_right"]
+    assert all(np.array_equal(results[name].array, volumes[name][0].array > 0.5) for name in volumes)
+
+    with pytest.raises(ValueError, match="as a dict"):
+        api.segment_volumes(list(volumes.values()), "thigh-model3", backend="resumed", workdir=workdir)
@@ -0,0 +1,65 @@
+"""Test the timing of the segmentation stages."""
+
+from __future__ import annotations
+
+import json
+
+import pytest
+from click.testing import CliRunner
+
+from musegai import api, tracing
+from musegai.cli import cli
+
+
+def test_tracer(tmp_path):
+    """Spans are saved as trace events, and summarized per name."""
+    tracer = tracing.Tracer()
+    with tracer.span("stage", case="a") as span:
+        span["bytes"] = 10
+    tracer.add("stage", tracer.origin, tracer.origin + 0.5, pid=1, tid=2, bytes=5)
+    summary = tracer.summary()
+    assert summary["stage"]["count"] == 2
+    assert summary["stage"]["bytes"] == 15
+    assert summary["stage"]["time"] >= 0.5
+
+    tracer.save(tmp_path / "trace.json")
+    events = json.loads((tmp_path / "trace.json").read_text(encoding="utf-8"))["traceEvents"]
+    assert {event["ph"] for event in events} == {"X"}
+    assert events[0]["args"] == {"case": "a", "bytes": 10}
+    assert not events[1]["ts"]
+    assert events[1]["dur"] == 0.5e6
+
+    # disabled: the arguments updated in context are not shared between spans (e.g., of concurrent threads)
+    with tracing.NO_TRACER.span("stage") as span:
+        span["bytes"] = 10
+    with tracing.NO_TRACER.span("other", case="b") as span:
+        assert not span
+
+
+@pytest.mark.parametrize("io_executor", ["thread", "process"])
+def test_segment_volumes_tracer(make_volumes, io_executor):
+    """The stages are recorded per chunk, case and file."""
+    tracer = tracing.Tracer()
+    volumes = {"alpha": make_volumes(seed=0), "beta": make_volumes(seed=1)}
+    api.segment_volumes(volumes, "test", side="left+right", batch_size=1, io_workers=2, io_executor=io_executor, exchange=".nii", tracer=tracer)
+    summary = tracer.summary()
+    assert list(summary)[0] == "connect"
+    assert summary["prepare chunk"]["count"] == summary["inference"]["count"] == summary["collect chunk"]["count"] == 2
+    assert summary["split"]["count"] == summary["heal"]["count"] == 2
+    # 2 cases of 2 volumes, split into 2 halves, and their segmentations
+    assert summary["save file"]["count"] == 8
+    assert summary["load file"]["count"] == 4
+    nbytes = sum(vol.nbytes for vols in volumes.values() for vol in vols)
+    assert nbytes < summary["save file"]["bytes"] < 1.1 * nbytes
+    assert {event["args"]["case"] for event in tracer.events if event["name"] == "heal"} == {"alpha", "beta"}
+
+
+def test_profile(tmp_path, make_volumes):
+    """The CLI saves the trace."""
+    for i, vol in enumerate(make_volumes()):
+        vol.save(tmp_path / f"alpha_{i}.mha")
+    result = CliRunner().invoke(cli, [str(tmp_path), "--model", "test", "--profile", str(tmp_path / "profile.json")])
+    assert not result.exit_code, result.output
+    assert "save output: 1 span(s)" in result.output
+    events = json.loads((tmp_path / "profile.json").read_text(encoding="utf-8"))["traceEvents"]
+    assert {"segment volumes", "inference", "save output"} <= {event["name"] for event in events}
@@ -0,0 +1,71 @@
+"""Test the sparse-annotation patch sampling of the nnU-Net trainer, on a tiny synthetic dataset (CPU only)."""
+
+from __future__ import annotations
+
+import importlib.util
+import pathlib
+import pickle
+import sys
+
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+dataset_loading = pytest.importorskip("nnunet.training.dataloading.dataset_loading")
+
+IGNORE = 4  # ignore label: the number of classes
+
+
+@pytest.fixture(name="trainer", scope="module")
+def fixture_trainer():
+    """Import the trainer module of the Docker image (and its sampling module, installed next to nnU-Net)."""
+    docker = pathlib.Path(__file__).parents[1] / "docker"
+    modules = {}
+    for name in ["sparse_sampling", "nnUNetTrainerV2_MUSEGAI"]:
+        spec = importlib.util.spec_from_file_location(name, docker / f"{name}.py")
+        modules[name] = importlib.util.module_from_spec(spec)
+        sys.modules[name] = modules[name]
+        spec.loader.exec_module(modules[name])
+    yield modules["nnUNetTrainerV2_MUSEGAI"]
+    del sys.modules["sparse_sampling"], sys.modules["nnUNetTrainerV2_MUSEGAI"]
+
+
+@pytest.fixture(name="dataset")
+def fixture_dataset(tmp_path):
+    """Return a preprocessed dataset of three cases (two channels, 30 slices), annotated on every 10th slice."""
+    rng = np.random.default_rng(0)
+    for case in range(3):
+        seg = np.full((30, 16, 16), IGNORE, dtype="float32")
+        seg[5::10] = rng.integers(0, IGNORE, (3, 16, 16))
+        seg[:, :2] = -1  # outside of the image
+        np.savez(tmp_path / f"case{case}.npz", data=np.concatenate([rng.random((2, 30, 16, 16), dtype="float32"), seg[np.newaxis]]))
+        locations = {label: np.argwhere(seg == label)[:50] for label in range(1, IGNORE + 1)}
+        with open(tmp_path / f"case{case}.pkl", "wb") as fp:
+            pickle.dump({"class_locations": locations}, fp)
+    return dataset_loading.load_dataset(str(tmp_path))
+
+
+@pytest.mark.parametrize("patch_size, final_patch_size", [((12, 12, 12), (8, 8, 8)), ((8, 20, 20), (8, 20, 20)), ((40, 12, 12), (36, 8, 8))])
+def test_patches(trainer, dataset, patch_size, final_patch_size):
+    """Every final patch overlaps annotated slices, also when padded, and its labelled voxels are counted."""
+    index = trainer.index_dataset(dataset, IGNORE)
+    loader = trainer.SparseAnnotationDataLoader3D(
+        dataset, patch_size, final_patch_size, 4, index=index, ignore_label=IGNORE, oversample_foreground_percent=0.33, pad_mode="constant"
+    )
+    margin = (np.array(patch_size) - np.array(final_patch_size)) // 2
+    central = tuple(slice(start, start + size) for start, size in zip(margin, final_patch_size))
+    for _ in range(50):
+        batch = loader.generate_train_batch()
+        assert batch["data"].shape == (4, 2, *patch_size) and batch["seg"].shape == (4, 1, *patch_size)
+        for seg, labelled in zip(batch["seg"][:, 0], batch["labelled"]):
+            assert labelled == np.count_nonzero((seg[central] >= 0) & (seg[central] != IGNORE)) > 0
+
+
+def test_loss(trainer):
+    """The loss matches nnU-Net's with labelled voxels, and is 0 without."""
+    loss = trainer.DC_and_CE_loss_improved({"batch_dice": True, "smooth": 1e-5, "do_bg": False}, {}, ignore_label=IGNORE)
+    reference = trainer.DC_and_CE_loss({"batch_dice": True, "smooth": 1e-5, "do_bg": False}, {}, ignore_label=IGNORE)
+    output = torch.randn(2, IGNORE, 4, 8, 8)
+    target = torch.randint(0, IGNORE + 1, (2, 1, 4, 8, 8)).float()
+    assert torch.isclose(loss(output, target.clone()), reference(output, target.clone()))
+    assert not loss(output, torch.full((2, 1, 4, 8, 8), float(IGNORE)))
@@ -0,0 +1,239 @@
+"""Test the volume container."""
+# pylint: disable=protected-access
+
+from __future__ import annotations
+
+import gc
+import struct
+import tracemalloc
+
+import numpy as np
+import pytest
+import SimpleITK as sitk
+
+from musegai import api, labelmap
+
+from .conftest import METADATA
+
+SHAPE = (256, 256, 96)  # 24 MB of float32
+
+
+@pytest.fixture(name="volume")
+def fixture_volume():
+    """Large synthetic volume."""
+    return api.Volume(np.random.default_rng(0).random(SHAPE, dtype="float32"), **METADATA)
+
+
+def peak_memory(func, *args):
+    """Return the result and the peak memory allocated by numpy during the call."""
+    tracemalloc.start()
+    try:
+        result = func(*args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, peak
+
+
+def test_save_load(tmp_path, volume):
+    """Loading shares the image buffer, saving copies directly into the image buffer."""
+    assert api.sitk.ReadImage  # imported on first use, not while tracing the memory
+    _, peak = peak_memory(volume.save, tmp_path / "vol.mha")
+    assert peak < 0.05 * volume.nbytes
+
+    loaded, peak = peak_memory(api.Volume.load, tmp_path / "vol.mha")
+    assert peak < 0.05 * volume.nbytes
+    assert isinstance(loaded.array.base.base, api._ImageBuffer)
+    assert loaded.array.flags.f_contiguous and loaded.array.flags.writeable
+
+    # the image buffer lives as long as the array
+    array = loaded.array
+    del loaded
+    gc.collect()
+    assert np.array_equal(array, volume.array)
+
+
+@pytest.mark.parametrize("size", [256, 255])
+def test_split_heal(size, volume):
+    """Splitting returns views, healing copies once into a preallocated output."""
+    volume = api.Volume(volume.array[:size], **volume.metadata)
+    (left, right), peak = peak_memory(api._split_volume, volume, "left+right")
+    assert peak < 0.05 * volume.nbytes
+    assert np.shares_memory(left.array, volume.array) and np.shares_memory(right.array, volume.array)
+    assert right.shape[0] + left.shape[0] == size
+
+    healed, peak = peak_memory(api._heal_volume, left, right)
+    assert peak < 1.05 * volume.nbytes
+    assert healed.array.flags.f_contiguous
+    assert np.array_equal(healed.array, volume.array)
+
+
+def test_slab_ranges():
+    """The slabs tile the slices with equal sizes, overlapping by at least the given overlap."""
+    assert api._slab_ranges(100, 40, 8) == [(0, 40), (32, 72), (60, 100)]
+    assert api._slab_ranges(40, 40, 8) == [(0, 40)]
+    assert api._slab_ranges(20, 40, 8) == [(0, 20)]
+    for size in range(41, 200):
+        ranges = api._slab_ranges(size, 40, 8)
+        assert not ranges[0][0] and ranges[-1][1] == size
+        assert all(stop - start == 40 for start, stop in ranges)
+        assert all(8 <= previous_stop - start < 40 for (start, _), (_, previous_stop) in zip(ranges[1:], ranges[:-1]))
+    with pytest.raises(ValueError, match="overlap"):
+        api._check_slabs(8, 8)
+
+
+def test_tile_stitch():
+    """The slabs are views with their physical position, and the overlaps are split halfway when stitched."""
+    volume = make_legs()[0]
+    volume = api.Volume(volume.array.astype("uint8"), **volume.metadata)
+    ranges = {"left": api._slab_ranges(volume.shape[-1], 4, 2)}
+    assert ranges["left"] == [(0, 4), (2, 6), (4, 8), (6, 10)]
+    slabs = api._tile_parts({"left": volume}, ranges)
+    assert list(slabs) == ["left_z0", "left_z1", "left_z2", "left_z3"]
+    direction = np.reshape(volume.transform, (3, 3))
+    for slab, (start, stop) in zip(slabs.values(), ranges["left"]):
+        assert np.shares_memory(slab.array, volume.array)
+        assert np.array_equal(slab.array, volume.array[..., start:stop])
+        assert np.allclose(slab.origin, np.asarray(volume.origin) + direction @ (np.array([0, 0, start]) * volume.spacing))
+
+    # each slab labelled by its index: the overlaps go to the nearest slab center
+    labelled = [api.Volume(np.full(slab.shape, index, dtype="uint8"), **slab.metadata) for index, slab in enumerate(slabs.values())]
+    healed = api._heal_volume(labelled, None, slabs=ranges)
+    assert healed.array.flags.f_contiguous and healed.origin == volume.origin
+    assert healed.array[0, 0].tolist() == [0, 0, 0, 1, 1, 2, 2, 3, 3, 3]
+    stitched = api._heal_parts({part: api.Volume(vol) for part, vol in slabs.items()}, slabs=ranges)
+    assert np.array_equal(stitched.array, volume.array)
+
+
+def make_legs(shape=(60, 30, 10), gap=36):
+    """Return a pair of synthetic volumes with two legs separated at `gap` along the first axis."""
+    array = np.zeros(shape, dtype="float32")
+    array[8 : gap - 4, 5:20, 2:8] = 100  # right leg
+    array[gap + 3 : 55, 10:25, 1:9] = 80  # left leg
+    transform = (0.0, -1.0, 0.0, 1.0, 0.0, 0.0, 0.0, 0.0, 1.0)  # rotated about z
+    return [api.Volume(array, origin=(10.0, -20.0, 5.0), spacing=(0.5, 1.0, 2.0), transform=transform) for _ in range(2)]
+
+
+def test_crop_boxes():
+    """The legs are split at the gap between them, and cropped with a margin."""
+    volumes = make_legs()
+    boxes = api._crop_boxes(volumes, "left+right", margin=2.0)
+    assert boxes["right"][0].stop == boxes["left"][0].start
+    assert 32 <= boxes["left"][0].start <= 39
+    assert boxes["right"] == (slice(4, boxes["right"][0].stop), slice(3, 22), slice(1, 9))
+    assert boxes["left"][1:] == (slice(8, 27), slice(0, 10))
+    assert list(api._crop_boxes(volumes, "left")) == ["left"]
+
+
+def test_crop_geometry(tmp_path):
+    """Cropped parts keep their physical position, and are pasted back with the original geometry."""
+    volumes = make_legs()
+    volume = volumes[0]
+    boxes = api._crop_boxes(volumes, "left+right")
+    left, right = api._split_volume(volume, "left+right", boxes=boxes)
+    for part, box in [(left, boxes["left"]), (right, boxes["right"])]:
+        # the first voxel of the part is at the physical position of the same voxel in the volume
+        start = np.array([index.start for index in box])
+        direction = np.reshape(volume.transform, (3, 3))
+        assert np.allclose(part.origin, np.asarray(volume.origin) + direction @ (start * volume.spacing))
+        assert np.array_equal(part.array, volume.array[box])
+
+    # round-trip through the exchange files
+    left.save(tmp_path / "left.nii.gz")
+    right.save(tmp_path / "right.nii.gz")
+    left, right = api.Volume.load(tmp_path / "left.nii.gz"), api.Volume.load(tmp_path / "right.nii.gz")
+    healed = api._heal_volume(left, right, boxes=boxes, shape=volume.shape)
+    assert healed.shape == volume.shape
+    assert np.allclose(healed.origin, volume.origin) and np.allclose(healed.spacing, volume.spacing)
+    assert np.allclose(healed.transform, volume.transform)
+    assert np.array_equal(healed.array, volume.array)
+
+
+@pytest.mark.parametrize("ext", [".mha", ".mhd", ".hdr", ".nii", ".nii.gz"])
+def test_load_mmap(tmp_path, ext):
+    """The voxel data of uncompressed files is memory-mapped, and matches the loaded data."""
+    volume = api.Volume(np.random.default_rng(0).integers(0, 1000, (40, 30, 20), dtype="int16"), **METADATA)
+    volume.save(tmp_path / f"vol{ext}")
+    loaded = api.Volume.load(tmp_path / f"vol{ext}")
+    mapped = api.Volume.load(tmp_path / f"vol{ext}", mmap=True)
+    assert isinstance(mapped.array, np.memmap) == (ext != ".nii.gz")
+    assert mapped.array.dtype == loaded.array.dtype and mapped.array.flags.f_contiguous
+    assert np.array_equal(mapped.array, loaded.array)
+    assert mapped.metadata == loaded.metadata
+
+    # views of the mapped data, copied on write
+    left, right = api._split_volume(mapped, "left+right")
+    assert all(isinstance(half.array, np.memmap) == (ext != ".nii.gz") for half in [left, right])
+    left.array[...] = 0
+    assert np.array_equal(api.Volume.load(tmp_path / f"vol{ext}").array, volume.array)
+
+
+def test_load_mmap_fallback(tmp_path):
+    """Scaled, 4-D, vector and truncated files are not memory-mapped."""
+    volume = api.Volume(np.arange(24, dtype="int16").reshape(4, 3, 2), **METADATA)
+    volume.save(tmp_path / "vol.nii")
+    data = bytearray((tmp_path / "vol.nii").read_bytes())
+    data[112:120] = np.array([2.0, 1.0], dtype="<f4").tobytes()  # scl_slope, scl_inter
+    (tmp_path / "scaled.nii").write_bytes(data)
+    scaled = api.Volume.load(tmp_path / "scaled.nii", mmap=True)
+    assert not isinstance(scaled.array, np.memmap)
+    assert np.array_equal(scaled.array, 2 * volume.array + 1)
+
+    # not a plain 3-D scalar image
+    array = np.arange(120, dtype="int16").reshape(5, 4, 3, 2)
+    sitk.WriteImage(sitk.GetImageFromArray(array, isVector=False), tmp_path / "series.nii")
+    assert struct.unpack("<h", (tmp_path / "series.nii").read_bytes()[40:42]) == (4,)
+    series = api.Volume.load(tmp_path / "series.nii", mmap=True)
+    assert not isinstance(series.array, np.memmap)
+    assert np.array_equal(series.array, api.Volume.load(tmp_path / "series.nii").array)
+    sitk.WriteImage(sitk.GetImageFromArray(array, isVector=True), tmp_path / "vector.nii")
+    vector = api.Volume.load(tmp_path / "vector.nii", mmap=True)
+    assert not isinstance(vector.array, np.memmap)
+    assert np.array_equal(vector.array, api.Volume.load(tmp_path / "vector.nii").array)
+
+    volume.save(tmp_path / "vol.mha")
+    (tmp_path / "truncated.mha").write_bytes((tmp_path / "vol.mha").read_bytes()[:-8])
+    with pytest.raises(RuntimeError):
+        api.Volume.load(tmp_path / "truncated.mha", mmap=True)
+
+
+def make_labels(kind, shape=(40, 30, 20)):
+    """Return a label map of the given kind."""
+    rng = np.random.default_rng(0)
+    array = np.zeros(shape, dtype="uint16")
+    if kind == "muscles":
+        array[5:35, 5:25, 3:16] = np.arange(1, 14)
+    elif kind == "noise":
+        array[2:38, 1:29, 4:18] = rng.integers(0, 14, (36, 28, 14))
+    elif kind == "binary":
+        array = rng.random(shape) < 0.5
+    return api.Volume(array, **METADATA)
+
+
+@pytest.mark.parametrize("kind, encoding", [("muscles", "rle"), ("noise", "bits4"), ("binary", "bits1"), ("empty", "rle")])
+def test_labelmap(tmp_path, kind, encoding):
+    """Label maps are saved compactly with their geometry, and loaded back identically (as `uint8`)."""
+    volume = make_labels(kind)
+    volume.save(tmp_path / "seg.mseg")
+    assert labelmap.load_header(tmp_path / "seg.mseg")["encoding"] == encoding
+    loaded = api.Volume.load(tmp_path / "seg.mseg")
+    assert loaded.array.dtype == np.uint8 and loaded.array.flags.f_contiguous
+    assert np.array_equal(loaded.array, volume.array)
+    assert loaded.metadata == {**volume.metadata, "info": {"extension": ".mseg", "name": "seg"}}
+    header = api.Volume.load_header(tmp_path / "seg.mseg")
+    assert header.shape == volume.shape and header.dtype == np.uint8 and header.metadata == loaded.metadata
+
+    if kind == "muscles":
+        volume.save(tmp_path / "seg.nii.gz")
+        assert (tmp_path / "seg.mseg").stat().st_size < (tmp_path / "seg.nii.gz").stat().st_size
+
+
+def test_labelmap_errors(tmp_path):
+    """Only label maps with labels in [0, 255] are saved in the compact format."""
+    with pytest.raises(ValueError, match="label map"):
+        api.Volume(np.full((4, 3, 2), 0.5), **METADATA).save(tmp_path / "seg.mseg")
+    with pytest.raises(ValueError, match="label map"):
+        api.Volume(np.full((4, 3, 2), 256, dtype="uint16"), **METADATA).save(tmp_path / "seg.mseg")
+    (tmp_path / "other.mseg").write_bytes(b"data")
+    with pytest.raises(ValueError, match="Not a label map"):
+        api.Volume.load(tmp_path / "other.mseg")
@@ -0,0 +1,168 @@
+"""Test the watch mode."""
+
+from __future__ import annotations
+
+import os
+import re
+
+from click.testing import CliRunner
+
+from musegai import api
+from musegai.cli import cli
+from musegai.watch import Watcher, micro_batches
+
+REGEX = re.compile(r"(.+?)(\d+).[\w.]+$")
+
+
+def touch(file, content=b"data", age=100.0):
+    """Write a file, and date it `age` seconds back."""
+    file.write_bytes(content)
+    mtime = file.stat().st_mtime - age
+    os.utime(file, (mtime, mtime))
+
+
+def test_watcher(tmp_path):
+    """Complete pairs are reported once stable, and recorded in the manifest."""
+    root = tmp_path / "in"
+    root.mkdir()
+    manifest = tmp_path / "manifest.json"
+    touch(root / "alpha_0.mha")
+    touch(root / "alpha_1.mha")
+    touch(root / "beta_0.mha")
+    (root / "notes.txt").touch()
+
+    watcher = Watcher(root, manifest, REGEX, settle=10)
+    now = os.stat(root).st_mtime
+    assert not watcher.poll(now)  # first seen now, not yet stable
+    assert watcher.settling == 3
+    cases = watcher.poll(now + 10)
+    assert cases == {"alpha_": [root / "alpha_0.mha", root / "alpha_1.mha"]}
+    assert not watcher.settling
+    assert not watcher.poll(now + 20)  # reported once
+    watcher.done(cases, outputs=[root / "alpha_.mha"])
+
+    # the second file of a pair is still written
+    touch(root / "beta_1.mha", age=0)
+    touch(root / "alpha_.mha")
+    assert not watcher.poll(now + 30)
+    assert watcher.settling == 1
+    touch(root / "beta_1.mha", b"more data", age=0)
+    assert not watcher.poll(now + 45)
+    assert not watcher.poll(now + 50)
+    assert list(watcher.poll(now + 55)) == ["beta_"]
+
+    # restarted: only the new and modified files are reported, with the other file of their pair
+    watcher = Watcher(root, manifest, REGEX, settle=0)
+    cases = watcher.poll()
+    assert list(cases) == ["beta_"]
+    watcher.done(cases)
+    touch(root / "alpha_1.mha", b"new data")
+    watcher = Watcher(root, manifest, REGEX, settle=0)
+    assert watcher.poll() == {"alpha_": [root / "alpha_0.mha", root / "alpha_1.mha"]}
+
+
+def test_watcher_incremental(tmp_path, monkeypatch):
+    """The directory is listed again only when modified, and the known files are not examined."""
+    root = tmp_path / "in"
+    root.mkdir()
+    for name in "abcdefghij":
+        touch(root / f"{name}_0.mha")
+        touch(root / f"{name}_1.mha")
+    watcher = Watcher(root, tmp_path / "manifest.json", REGEX, settle=0)
+    watcher.done(watcher.poll())
+
+    listed = []
+    scandir = os.scandir
+    monkeypatch.setattr(os, "scandir", lambda path: listed.append(path) or scandir(path))
+    stats = []
+    stat = os.stat
+    monkeypatch.setattr(os, "stat", lambda path, **kwargs: stats.append(path) or stat(path, **kwargs))
+    assert not watcher.poll()
+    assert not listed and len(stats) == 1  # the directory only
+
+    touch(root / "new_0.mha")
+    touch(root / "new_1.mha")
+    stats.clear()
+    assert list(watcher.poll()) == ["new_"]
+    assert len(listed) == 1
+    assert len(stats) == 3  # the directory and the new files
+
+
+class FakeWatcher:  # pylint: disable=too-few-public-methods
+    """Watcher reporting given cases at each poll."""
+
+    def __init__(self, polls):
+        """Report the given cases in turn."""
+        self.polls = list(polls)
+        self.settling = 0
+
+    def poll(self):
+        """Return the next cases."""
+        return self.polls.pop(0) if self.polls else {}
+
+
+def test_micro_batches():
+    """Batches are yielded when full, or when their first case waited long enough."""
+    clock = [0.0]
+
+    def sleep(seconds):
+        clock[0] += seconds
+
+    polls = [{"a": [], "b": [], "c": []}, {}, {"d": []}, {}, {}, {}, {}, {"e": []}]
+    batches = micro_batches(FakeWatcher(polls), interval=5, max_cases=2, max_delay=12, sleep=sleep, clock=lambda: clock[0])
+    assert next(batches) == {"a": [], "b": []}
+    assert not clock[0]
+    assert next(batches) == {"c": [], "d": []}
+    assert clock[0] == 10
+    assert next(batches) == {"e": []}
+    assert clock[0] == 50  # added at 35, waited for 12 seconds, yielded at the next poll
+
+    batches = micro_batches(FakeWatcher(polls), max_cases=2, once=True, sleep=lambda _: None)
+    assert list(batches) == [{"a": [], "b": []}, {"c": []}]
+
+
+def test_watch_command(tmp_path, make_volumes):
+    """The new pairs are segmented, the processed ones are not segmented again."""
+    indir = tmp_path / "in"
+    indir.mkdir()
+    for name in ["alpha_", "beta_"]:
+        for i, vol in enumerate(make_volumes()):
+            vol.save(indir / f"{name}{i}.mha")
+    make_volumes()[0].save(indir / "single_0.mha")
+    outdir = tmp_path / "out"
+    args = ["watch", str(indir), "--dest", str(outdir), "--model", "test", "--once", "--settle", "0"]
+
+    result = CliRunner().invoke(cli, args)
+    assert not result.exit_code, result.output
+    assert "Found 2 new volume pair(s): alpha_, beta_" in result.output
+    assert {file.name for file in outdir.iterdir()} == {"alpha_.mha", "beta_.mha", "labels.txt", ".museg-watch.json"}
+    assert api.Volume.load(outdir / "beta_.mha").shape == (20, 12, 8)
+
+    for i, vol in enumerate(make_volumes(seed=1)):
+        vol.save(indir / f"gamma_{i}.mha")
+    result = CliRunner().invoke(cli, args)
+    assert not result.exit_code, result.output
+    assert "Found 1 new volume pair(s): gamma_" in result.output
+
+    # outputs saved next to the inputs are ignored
+    result = CliRunner().invoke(cli, ["watch", str(indir), "--model", "test", "--once", "--settle", "0", "--manifest", str(tmp_path / "manifest.json")])
+    assert not result.exit_code, result.output
+    assert "Found 3 new volume pair(s)" in result.output
+    result = CliRunner().invoke(cli, ["watch", str(indir), "--model", "test", "--once", "--settle", "0", "--manifest", str(tmp_path / "manifest.json")])
+    assert "Found" not in result.output
+
+
+def test_watch_preview(tmp_path, make_volumes):
+    """With previews, the pairs are segmented at full resolution too, and the previews are not taken for new volumes."""
+    for i, vol in enumerate(make_volumes()):
+        vol.save(tmp_path / f"alpha_{i}.mha")
+    (tmp_path / "alpha_.mha").write_bytes(b"stale")
+    os.utime(tmp_path / "alpha_.mha", (0, 0))
+    args = ["watch", str(tmp_path), "--model", "test", "--once", "--settle", "0", "--preview", "--manifest", str(tmp_path / "manifest.json")]
+
+    result = CliRunner().invoke(cli, args)
+    assert not result.exit_code, result.output
+    assert "Full resolution:" in result.output
+    assert api.Volume.load(tmp_path / "alpha_.mha").shape == api.Volume.load(tmp_path / "alpha_preview.mha").shape == (20, 12, 8)
+    result = CliRunner().invoke(cli, args)
+    assert "Found" not in result.output